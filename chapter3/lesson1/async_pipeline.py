@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步流水线版RAG
+
+RAGPipeline.query 在单个线程里串行执行 编码 → 检索 → 重排 → 生成，
+并发请求时模型在等待LLM HTTP响应期间处于空闲。本模块提供基于asyncio的
+AsyncRAGPipeline：
+1. 编码、检索、重排序各由一个微批处理worker负责，把同一时间窗口内
+   多个请求的查询合并成一次模型调用；问题向量只编码一次，
+   语义答案缓存查找和检索共用
+2. LLM调用在线程池中并发等待，不阻塞后续请求的检索和重排
+3. 三个阶段彼此重叠，吞吐量随并发数增长
+"""
+
+import time
+import asyncio
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Optional, Tuple
+
+import numpy as np
+
+from rag_pipeline import QueryRepresentations, RAGPipeline, RetrievalResult
+from vector_index import MetadataIndex
+from rag_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    微批处理器
+
+    请求通过submit()进入队列；worker取到第一个请求后最多再等待max_wait_ms，
+    凑够max_batch_size个请求或超时后，把整批交给batch_fn在专用线程中执行。
+    batch_fn接收请求列表，返回等长的结果列表。
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], name: str,
+                 max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        """
+        Args:
+            batch_fn: 批处理函数（同步，在独立线程中执行）
+            name: worker名称，用于日志和统计
+            max_batch_size: 单批最大请求数
+            max_wait_ms: 凑批的最长等待时间（毫秒）
+        """
+        self.batch_fn = batch_fn
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        # 单线程执行器：模型调用串行化，但与事件循环及其他阶段并行
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"rag-{name}")
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: Any) -> Any:
+        """提交一个请求并等待其结果"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        """取出一批请求"""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self.batch_fn, items)
+            except Exception as e:
+                logger.error(f"{self.name} batch failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(items)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回批处理统计"""
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0
+        }
+
+    async def close(self):
+        """停止worker并释放线程"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=True)
+
+
+class AsyncRAGPipeline:
+    """基于asyncio的流水线RAG，复用RAGPipeline中的模型和索引"""
+
+    def __init__(self, pipeline: RAGPipeline,
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0,
+                 max_concurrent_generations: int = 16):
+        """
+        Args:
+            pipeline: 已加载文档的同步RAGPipeline
+            max_batch_size: 编码/重排序单批最大查询数
+            max_wait_ms: 凑批的最长等待时间（毫秒）
+            max_concurrent_generations: 同时进行的LLM调用上限
+        """
+        self.pipeline = pipeline
+        # 查询编码器只在encode worker的线程中调用
+        self.encode_batcher = MicroBatcher(self._encode_batch, "encode",
+                                           max_batch_size, max_wait_ms)
+        self.retrieval_batcher = MicroBatcher(self._retrieve_batch, "retrieval",
+                                              max_batch_size, max_wait_ms)
+        self.rerank_batcher = MicroBatcher(self._rerank_batch, "rerank",
+                                           max_batch_size, max_wait_ms)
+        self._llm_executor = ThreadPoolExecutor(max_workers=max_concurrent_generations,
+                                                thread_name_prefix="rag-llm")
+
+    def _encode_batch(self, questions: List[str]) -> List[QueryRepresentations]:
+        """整批问题一次编码，拆分为每个问题各自的编码结果"""
+        dense, lexical = self.pipeline.retrieval_system.encode_queries(questions)
+        return [(dense[i:i + 1], None if lexical is None else [lexical[i]]) for i in range(len(questions))]
+
+    def _retrieve_batch(self, items: List[Tuple[str, int, Optional[str], Optional[Dict[str, Any]],
+                                                QueryRepresentations]]
+                        ) -> List[List[RetrievalResult]]:
+        """用已编码的问题一次矩阵乘完成整批检索；集合和过滤条件不同的请求分组检索"""
+        groups: Dict[Tuple[Optional[str], Optional[str]], List[int]] = {}
+        for i, (_, _, collection, where, _) in enumerate(items):
+            groups.setdefault((collection, MetadataIndex.canonical(where)), []).append(i)
+
+        batch_results: List[List[RetrievalResult]] = [[] for _ in items]
+        for indices in groups.values():
+            _, _, collection, where, _ = items[indices[0]]
+            max_top_k = max(items[i][1] for i in indices)
+            dense = np.concatenate([items[i][4][0] for i in indices])
+            lexical = None
+            if items[indices[0]][4][1] is not None:
+                lexical = [items[i][4][1][0] for i in indices]
+            group_results = self.pipeline.retrieval_system.search_batch(
+                [items[i][0] for i in indices], max_top_k, collection, where, (dense, lexical))
+            # 结果已按分数降序，按各请求的top_k截取即可
+            for i, results in zip(indices, group_results):
+                batch_results[i] = results[:items[i][1]]
+        return batch_results
+
+    def _rerank_batch(self, items: List[Tuple[str, List[RetrievalResult], int]]) -> List[List[RetrievalResult]]:
+        """整批文档对一次送入交叉编码器"""
+        queries = [question for question, _, _ in items]
+        results_list = [results for _, results, _ in items]
+        max_top_k = max(top_k for _, _, top_k in items)
+        reranked = self.pipeline.reranker.rerank_batch(queries, results_list, max_top_k)
+        return [results[:top_k] for results, (_, _, top_k) in zip(reranked, items)]
+
+    async def query(self,
+                    question: str,
+                    retrieval_top_k: int = 20,
+                    rerank_top_k: int = 5,
+                    collection: Optional[str] = None,
+                    where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        异步执行RAG查询，参数和返回结构与RAGPipeline.query相同
+        """
+        metrics.inc("rag_queries_total", mode="async")
+        # 每个asyncio任务拥有独立的上下文，trace互不干扰
+        with metrics.trace():
+            return await self._query(question, retrieval_top_k, rerank_top_k, collection, where)
+
+    async def _query(self, question: str, retrieval_top_k: int, rerank_top_k: int,
+                     collection: Optional[str], where: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        total_start_time = time.time()
+        pipeline = self.pipeline
+        loop = asyncio.get_running_loop()
+
+        # 问题经encode worker批量编码一次，语义答案缓存查找和检索共用这份编码
+        representations = await self.encode_batcher.submit(question)
+        cache_key, hit = pipeline._lookup_answer_cache(
+            question, pipeline._cache_params(retrieval_top_k, rerank_top_k, collection, where), representations)
+        if hit is not None:
+            return pipeline._cached_result(question, hit, total_start_time)
+
+        retrieval_results = await self.retrieval_batcher.submit(
+            (question, retrieval_top_k, collection, where, representations))
+        if not retrieval_results:
+            return pipeline._empty_result(question, total_start_time)
+
+        depth, rerank_plan = pipeline._plan_rerank(retrieval_results, rerank_top_k)
+        if depth == 0:
+            reranked_results = pipeline._take_retrieval_order(retrieval_results, rerank_top_k)
+        else:
+            reranked_results = await self.rerank_batcher.submit(
+                (question, retrieval_results[:depth], rerank_top_k))
+
+        # 在复制的上下文中调用LLM，使提示词构建和LLM调用的span计入本次查询的trace；
+        # 编码和重排序由多个查询共享批次，只计入全局直方图
+        context = contextvars.copy_context()
+        generation_result = await loop.run_in_executor(
+            self._llm_executor, context.run, pipeline.llm_generator.generate_answer, question, reranked_results
+        )
+
+        pipeline_stats = pipeline._pipeline_stats(retrieval_results, reranked_results, total_start_time,
+                                                  rerank_plan)
+        pipeline_stats["generation_time"] = generation_result.get("generation_time", 0)
+        if "packing" in generation_result:
+            pipeline_stats["context_packing"] = generation_result["packing"]
+        result = {
+            "question": question,
+            "answer": generation_result["answer"],
+            "sources": generation_result["sources"],
+            "confidence": generation_result["confidence"],
+            "pipeline_stats": pipeline_stats
+        }
+        if "error" in generation_result:
+            result["error"] = generation_result["error"]
+        await loop.run_in_executor(self._llm_executor, pipeline._store_answer, question, cache_key, result)
+        if pipeline.answer_cache is not None:
+            pipeline_stats["answer_cache"] = {"hit": False, **pipeline.answer_cache.stats()}
+        return result
+
+    async def query_many(self,
+                         questions: List[str],
+                         retrieval_top_k: int = 20,
+                         rerank_top_k: int = 5,
+                         collection: Optional[str] = None,
+                         where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """并发执行多个查询，结果顺序与questions一致"""
+        return await asyncio.gather(*(
+            self.query(question, retrieval_top_k, rerank_top_k, collection, where) for question in questions
+        ))
+
+    def stats(self) -> Dict[str, Any]:
+        """返回各阶段的批处理统计"""
+        return {
+            "encode": self.encode_batcher.stats(),
+            "retrieval": self.retrieval_batcher.stats(),
+            "rerank": self.rerank_batcher.stats()
+        }
+
+    async def close(self):
+        """停止worker并释放线程池"""
+        await self.encode_batcher.close()
+        await self.retrieval_batcher.close()
+        await self.rerank_batcher.close()
+        self._llm_executor.shutdown(wait=True)
+
+    async def __aenter__(self) -> "AsyncRAGPipeline":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
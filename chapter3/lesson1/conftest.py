@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线测试夹具
+
+用确定性的假模型代替BGE-m3、BGE-reranker和DashScope，测试不下载模型、不访问网络：
+- FakeBGEM3: 哈希词袋编码器，接口与BGEM3FlagModel.encode一致，共享词越多内积越大
+- FakeReranker: 用同一编码器的内积作为交叉编码器分数
+- FakeGeneration: 记录提示词并返回固定答案，支持流式输出
+"""
+
+import re
+import sys
+import hashlib
+from types import ModuleType, SimpleNamespace
+from typing import List, Dict, Any
+
+import numpy as np
+import pytest
+
+from rag_pipeline import BGERetrievalSystem, RAGPipeline, LLMGenerator, Document
+
+DIM = 256
+
+
+def _tokens(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def _term_hash(token: str) -> int:
+    return int(hashlib.md5(token.encode("utf-8")).hexdigest(), 16)
+
+
+def fake_embed(text: str) -> np.ndarray:
+    """把文本哈希成归一化的词袋向量"""
+    vector = np.zeros(DIM, dtype=np.float32)
+    for token in _tokens(text):
+        h = _term_hash(token)
+        vector[h % DIM] += 1.0 if (h >> 16) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class FakeBGEM3:
+    """BGEM3FlagModel的替身，记录每次encode的输入"""
+
+    def __init__(self, *args, **kwargs):
+        self.calls: List[List[str]] = []
+
+    def encode(self, sentences, batch_size=12, max_length=8192, return_dense=True,
+               return_sparse=False, return_colbert_vecs=False) -> Dict[str, Any]:
+        sentences = list(sentences)
+        self.calls.append(sentences)
+        dense = np.stack([fake_embed(text) for text in sentences]) if sentences else np.zeros((0, DIM), np.float32)
+        output: Dict[str, Any] = {"dense_vecs": dense}
+        if return_sparse:
+            output["lexical_weights"] = [{str(_term_hash(token) % 50000): 0.3 for token in _tokens(text)}
+                                         for text in sentences]
+        return output
+
+
+class FakeReranker:
+    """FlagReranker的替身，记录每次打分的文档对"""
+
+    def __init__(self, *args, **kwargs):
+        self.calls: List[List[List[str]]] = []
+
+    def compute_score(self, sentence_pairs, batch_size=8, normalize=False) -> List[float]:
+        self.calls.append([list(pair) for pair in sentence_pairs])
+        return [float(fake_embed(query) @ fake_embed(passage)) for query, passage in sentence_pairs]
+
+
+class FakeGeneration:
+    """dashscope.Generation的替身"""
+
+    def __init__(self, answer: str = "离线测试答案"):
+        self.answer = answer
+        self.prompts: List[str] = []
+
+    def _response(self, text: str) -> SimpleNamespace:
+        return SimpleNamespace(status_code=200, output=SimpleNamespace(text=text),
+                               usage={"input_tokens": 10, "output_tokens": len(text)})
+
+    def call(self, prompt: str, stream: bool = False, incremental_output: bool = False, **params):
+        self.prompts.append(prompt)
+        if not stream:
+            return self._response(self.answer)
+        return iter([self._response(self.answer[i:i + 2]) for i in range(0, len(self.answer), 2)])
+
+
+def make_corpus() -> List[Document]:
+    """五篇主题互不相同的小文档，带元数据和集合"""
+    return [
+        Document(id="python", title="python", content="python is a programming language with dynamic typing",
+                 metadata={"source": "wiki", "year": 2023, "tags": ["language"]}),
+        Document(id="rust", title="rust", content="rust guarantees memory safety without garbage collection",
+                 metadata={"source": "faq", "year": 2024, "tags": ["language", "systems"]}),
+        Document(id="pandas", title="pandas", content="pandas provides dataframes for tabular data analysis",
+                 metadata={"source": "wiki", "year": 2024, "tags": ["library"]}),
+        Document(id="docker", title="docker", content="docker packages applications into portable containers",
+                 metadata={"source": "blog", "year": 2022}, collection="ops"),
+        Document(id="kafka", title="kafka", content="kafka is a distributed log for streaming events",
+                 metadata={"source": "blog", "year": 2023}, collection="ops"),
+    ]
+
+
+@pytest.fixture
+def corpus() -> List[Document]:
+    return make_corpus()
+
+
+@pytest.fixture
+def make_retrieval_system():
+    """创建注入了FakeBGEM3的检索系统"""
+    def factory(**kwargs) -> BGERetrievalSystem:
+        system = BGERetrievalSystem(**kwargs)
+        system._model = FakeBGEM3()
+        return system
+    return factory
+
+
+@pytest.fixture
+def fake_flag_embedding(monkeypatch) -> ModuleType:
+    """用假模型顶替FlagEmbedding包，走真实的按需导入和模型加载路径"""
+    module = ModuleType("FlagEmbedding")
+    module.BGEM3FlagModel = FakeBGEM3
+    module.FlagReranker = FakeReranker
+    monkeypatch.setitem(sys.modules, "FlagEmbedding", module)
+    return module
+
+
+@pytest.fixture
+def fake_llm(monkeypatch) -> FakeGeneration:
+    """替换DashScope生成接口"""
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test-key")
+    generation = FakeGeneration()
+    monkeypatch.setattr(LLMGenerator, "_generation", staticmethod(lambda: generation))
+    return generation
+
+
+@pytest.fixture
+def make_pipeline(fake_llm):
+    """创建注入了全部假模型的RAGPipeline"""
+    def factory(**kwargs) -> RAGPipeline:
+        pipeline = RAGPipeline(**kwargs)
+        pipeline.retrieval_system._model = FakeBGEM3()
+        pipeline.reranker._reranker = FakeReranker()
+        return pipeline
+    return factory
@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BGE-m3 / BGE-reranker 进程外模型服务
+
+每个RAGPipeline实例都会加载自己的BGEM3FlagModel和FlagReranker，多个worker进程
+各自承担模型加载时间和一份显存/内存。本模块把两个模型放进一个本地HTTP服务：
+1. 请求线程把编码/重排序请求放入队列，由每个模型独占的批处理线程
+   把同一时间窗口内的并发请求合并成一次模型调用（动态批处理）
+2. 凑够max_batch_size条文本/文档对，或等待超过max_wait_ms后立即执行
+3. RemoteBGEM3Model / RemoteReranker 提供与FlagEmbedding相同的encode/compute_score接口，
+   BGERetrievalSystem和BGEReranker通过model_server参数直接使用
+
+启动服务：
+    python embedding_server.py --port 8765 --max-batch-size 64 --max-wait-ms 5
+
+在worker中使用：
+    RAGPipeline(model_server="http://127.0.0.1:8765")
+"""
+
+import json
+import time
+import queue
+import base64
+import logging
+import argparse
+import threading
+import http.client
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Tuple, Any, Optional, Callable
+
+import numpy as np
+
+from rag_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# 批大小直方图的桶（条）
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+metrics.describe("model_server_batch_size", "Texts or pairs per model call in the model server")
+metrics.describe("model_server_requests_total", "Requests served by the model server")
+
+
+def _pack_array(array: np.ndarray) -> Dict[str, Any]:
+    """把向量矩阵编码为base64，比JSON浮点数组体积小且无精度损失"""
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    return {"shape": list(array.shape), "data": base64.b64encode(array.tobytes()).decode("ascii")}
+
+
+def _unpack_array(payload: Dict[str, Any]) -> np.ndarray:
+    data = base64.b64decode(payload["data"])
+    return np.frombuffer(data, dtype=np.float32).reshape(payload["shape"])
+
+
+class _PendingRequest:
+    """等待批处理结果的单个请求"""
+
+    __slots__ = ("item", "size", "done", "result", "error")
+
+    def __init__(self, item: Any, size: int):
+        self.item = item
+        self.size = size
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class DynamicBatcher:
+    """
+    基于线程的动态批处理器
+
+    submit()在调用线程中阻塞等待结果；批处理线程取到第一个请求后最多再等待max_wait_ms，
+    累计文本数达到max_batch_size或超时后，把整批交给batch_fn执行一次。
+    batch_fn接收请求列表，返回等长的结果列表。
+    close()之后submit()直接抛出RuntimeError，不会有请求永远等不到结果。
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], name: str,
+                 max_batch_size: int = 64, max_wait_ms: float = 5.0):
+        """
+        Args:
+            batch_fn: 批处理函数，在批处理线程中执行
+            name: 批处理器名称，用于线程名、日志和指标
+            max_batch_size: 单批累计的最大条数（文本数或文档对数）
+            max_wait_ms: 凑批的最长等待时间（毫秒）
+        """
+        self.batch_fn = batch_fn
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue[Optional[_PendingRequest]]" = queue.Queue()
+        self._stopping = False
+        self._closed = False
+        self._close_lock = threading.Lock()  # 保证关闭标志与停止信号入队的先后顺序
+        self.batches = 0
+        self.items = 0
+        self._thread = threading.Thread(target=self._run, name=f"model-server-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any, size: int = 1) -> Any:
+        """提交一个请求并阻塞等待其结果"""
+        request = _PendingRequest(item, size)
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError(f"{self.name} batcher is closed")
+            self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self) -> List[_PendingRequest]:
+        """取出一批请求；收到停止信号时返回已取到的部分"""
+        first = self._queue.get()
+        if first is None:
+            self._stopping = True
+            return []
+        batch = [first]
+        total = first.size
+        deadline = time.monotonic() + self.max_wait
+        while total < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self._stopping = True
+                break
+            batch.append(request)
+            total += request.size
+        return batch
+
+    def _run(self):
+        while not self._stopping:
+            batch = self._collect()
+            if not batch:
+                continue
+            self._process(batch)
+        self._fail_pending()
+
+    def _fail_pending(self):
+        """停止后让队列中残留的请求立即失败，而不是永远阻塞调用方"""
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if request is not None:
+                request.error = RuntimeError(f"{self.name} batcher is closed")
+                request.done.set()
+
+    def _process(self, batch: List[_PendingRequest]):
+        try:
+            results = self.batch_fn([request.item for request in batch])
+        except Exception as e:
+            logger.error(f"{self.name} batch failed: {e}")
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+
+        size = sum(request.size for request in batch)
+        self.batches += 1
+        self.items += size
+        metrics.observe("model_server_batch_size", size, buckets=BATCH_SIZE_BUCKETS, kind=self.name)
+        for request, result in zip(batch, results):
+            request.result = result
+            request.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回批处理统计"""
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "queued": self._queue.qsize()
+        }
+
+    def close(self):
+        """拒绝新请求，处理完已入队的请求后停止批处理线程"""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+
+
+class EmbeddingServer:
+    """在一个进程中持有BGE-m3和BGE-reranker，供多个worker共享"""
+
+    def __init__(self, model_path: str = "BAAI/bge-m3",
+                 reranker_path: Optional[str] = "BAAI/bge-reranker-v2-m3",
+                 host: str = DEFAULT_HOST,
+                 port: int = DEFAULT_PORT,
+                 max_batch_size: int = 64,
+                 max_wait_ms: float = 5.0,
+                 encode_batch_size: int = 12,
+                 rerank_batch_size: int = 8):
+        """
+        Args:
+            model_path: BGE-m3模型路径
+            reranker_path: BGE-reranker模型路径，为None时不提供重排序接口
+            host: 监听地址，默认只监听本机
+            port: 监听端口
+            max_batch_size: 动态批处理单批累计的最大文本数/文档对数
+            max_wait_ms: 凑批的最长等待时间（毫秒）
+            encode_batch_size: 单次模型调用内部的编码批大小
+            rerank_batch_size: 单次模型调用内部的重排序批大小
+        """
+        # 只有服务端需要FlagEmbedding，客户端进程导入本模块时不加载
+        from FlagEmbedding import BGEM3FlagModel, FlagReranker
+
+        self.model_path = model_path
+        self.reranker_path = reranker_path
+        self.encode_batch_size = encode_batch_size
+        self.rerank_batch_size = rerank_batch_size
+
+        start_time = time.time()
+        logger.info(f"Loading BGE-m3 model: {model_path}")
+        self.model = BGEM3FlagModel(model_path, use_fp16=True)
+        self.reranker = None
+        if reranker_path:
+            logger.info(f"Loading BGE-reranker model: {reranker_path}")
+            self.reranker = FlagReranker(reranker_path, use_fp16=True)
+        logger.info(f"Models loaded in {time.time() - start_time:.2f}s")
+
+        self.encoder_batcher = DynamicBatcher(self._encode_batch, "encode", max_batch_size, max_wait_ms)
+        self.rerank_batcher = DynamicBatcher(self._rerank_batch, "rerank", max_batch_size, max_wait_ms)
+
+        self.httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.app = self
+        self._serve_thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _encode_batch(self, requests: List[Tuple[List[str], int, bool]]) -> List[Dict[str, Any]]:
+        """把参数相同的请求拼接后调用一次encode，再按请求拆分结果"""
+        results: List[Optional[Dict[str, Any]]] = [None] * len(requests)
+        groups: Dict[Tuple[int, bool], List[int]] = {}
+        for i, (_, max_length, return_sparse) in enumerate(requests):
+            groups.setdefault((max_length, return_sparse), []).append(i)
+
+        for (max_length, return_sparse), indices in groups.items():
+            texts = [text for i in indices for text in requests[i][0]]
+            output = self.model.encode(
+                texts,
+                batch_size=self.encode_batch_size,
+                max_length=max_length,
+                return_dense=True,
+                return_sparse=return_sparse,
+                return_colbert_vecs=False
+            )
+            if isinstance(output, dict) and 'dense_vecs' in output:
+                dense = np.atleast_2d(np.asarray(output['dense_vecs'], dtype=np.float32))
+            else:
+                dense = np.atleast_2d(np.asarray(output, dtype=np.float32))
+            lexical = output.get('lexical_weights') if return_sparse and isinstance(output, dict) else None
+
+            offset = 0
+            for i in indices:
+                count = len(requests[i][0])
+                result: Dict[str, Any] = {"dense": dense[offset:offset + count]}
+                if return_sparse:
+                    weights = lexical[offset:offset + count] if lexical is not None else [{}] * count
+                    result["lexical_weights"] = [{str(term): float(weight) for term, weight in w.items()}
+                                                 for w in weights]
+                results[i] = result
+                offset += count
+        return results
+
+    def _rerank_batch(self, requests: List[Tuple[List[List[str]], bool]]) -> List[List[float]]:
+        """把所有请求的文档对合并后调用一次compute_score"""
+        results: List[Optional[List[float]]] = [None] * len(requests)
+        groups: Dict[bool, List[int]] = {}
+        for i, (_, normalize) in enumerate(requests):
+            groups.setdefault(normalize, []).append(i)
+
+        for normalize, indices in groups.items():
+            pairs = [pair for i in indices for pair in requests[i][0]]
+            scores = self.reranker.compute_score(pairs, batch_size=self.rerank_batch_size, normalize=normalize)
+            # 只有一个文档对时FlagReranker返回标量
+            if not isinstance(scores, (list, tuple, np.ndarray)):
+                scores = [scores]
+            scores = [float(score) for score in scores]
+
+            offset = 0
+            for i in indices:
+                count = len(requests[i][0])
+                results[i] = scores[offset:offset + count]
+                offset += count
+        return results
+
+    def encode(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """处理 POST /encode"""
+        texts = payload.get("texts")
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            raise ValueError("texts必须是字符串列表")
+        max_length = int(payload.get("max_length", 8192))
+        return_sparse = bool(payload.get("return_sparse", False))
+        metrics.inc("model_server_requests_total", endpoint="encode")
+        if not texts:
+            return {"dense": _pack_array(np.empty((0, 0), dtype=np.float32))}
+
+        result = self.encoder_batcher.submit((texts, max_length, return_sparse), len(texts))
+        response = {"dense": _pack_array(result["dense"])}
+        if return_sparse:
+            response["lexical_weights"] = result["lexical_weights"]
+        return response
+
+    def rerank(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """处理 POST /rerank"""
+        if self.reranker is None:
+            raise ValueError("服务未加载重排序模型")
+        pairs = payload.get("pairs")
+        if not isinstance(pairs, list) or not all(isinstance(pair, list) and len(pair) == 2 for pair in pairs):
+            raise ValueError("pairs必须是 [query, passage] 列表")
+        metrics.inc("model_server_requests_total", endpoint="rerank")
+        if not pairs:
+            return {"scores": []}
+        normalize = bool(payload.get("normalize", False))
+        return {"scores": self.rerank_batcher.submit((pairs, normalize), len(pairs))}
+
+    def health(self) -> Dict[str, Any]:
+        """处理 GET /health"""
+        return {
+            "status": "ok",
+            "model_path": self.model_path,
+            "reranker_path": self.reranker_path if self.reranker is not None else None,
+            "encode": self.encoder_batcher.stats(),
+            "rerank": self.rerank_batcher.stats()
+        }
+
+    def serve_forever(self):
+        """在当前线程中处理请求，直到shutdown()"""
+        logger.info(f"Model server listening on {self.url}")
+        self.httpd.serve_forever()
+
+    def start(self) -> "EmbeddingServer":
+        """在后台线程中启动服务"""
+        self._serve_thread = threading.Thread(target=self.serve_forever, name="model-server", daemon=True)
+        self._serve_thread.start()
+        return self
+
+    def shutdown(self):
+        """停止接收请求并等待批处理线程退出"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.encoder_batcher.close()
+        self.rerank_batcher.close()
+        if self._serve_thread is not None:
+            self._serve_thread.join()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """JSON over HTTP/1.1，保持长连接以省去每次请求的TCP握手"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        self._send(status, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+    def do_GET(self):
+        app: EmbeddingServer = self.server.app
+        if self.path == "/health":
+            self._send_json(200, app.health())
+        elif self.path == "/metrics":
+            self._send(200, metrics.export_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        app: EmbeddingServer = self.server.app
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self._send_json(400, {"error": f"invalid JSON: {e}"})
+            return
+
+        handlers = {"/encode": app.encode, "/rerank": app.rerank}
+        if self.path not in handlers:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            self._send_json(200, handlers[self.path](payload))
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            logger.exception(f"Model server failed on {self.path}")
+            self._send_json(500, {"error": str(e)})
+
+
+class ModelServerClient:
+    """模型服务的HTTP客户端，每个线程复用一条长连接"""
+
+    def __init__(self, url: str = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", timeout: float = 300.0):
+        """
+        Args:
+            url: 模型服务地址
+            timeout: 单次请求超时（秒），文档批量编码可能耗时较长
+        """
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme != "http" or not parsed.hostname:
+            raise ValueError(f"不支持的模型服务地址: {url}")
+        self.url = url
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _reset_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+        self._local.connection = None
+
+    def _request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        # 服务端可能已关闭空闲的长连接，此时重连重试一次；编码和重排序请求是幂等的
+        for attempt in range(2):
+            try:
+                connection = self._connection()
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                self._reset_connection()
+                if attempt:
+                    raise
+        result = json.loads(data)
+        if response.status != 200:
+            raise RuntimeError(f"模型服务 {path} 返回 {response.status}: {result.get('error')}")
+        return result
+
+    def health(self) -> Dict[str, Any]:
+        return self._request("GET", "/health")
+
+    def encode(self, texts: List[str], max_length: int = 8192,
+               return_sparse: bool = False) -> Tuple[np.ndarray, Optional[List[Dict[str, float]]]]:
+        """返回 (稠密向量矩阵, 词项权重)，未请求稀疏权重时后者为None"""
+        result = self._request("POST", "/encode", {
+            "texts": texts, "max_length": max_length, "return_sparse": return_sparse
+        })
+        return _unpack_array(result["dense"]), result.get("lexical_weights")
+
+    def rerank(self, pairs: List[List[str]], normalize: bool = False) -> List[float]:
+        return self._request("POST", "/rerank", {"pairs": pairs, "normalize": normalize})["scores"]
+
+
+class RemoteBGEM3Model:
+    """与BGEM3FlagModel.encode接口兼容的远程编码器"""
+
+    def __init__(self, client: ModelServerClient):
+        self.client = client
+
+    def encode(self, sentences: List[str], batch_size: Optional[int] = None, max_length: int = 8192,
+               return_dense: bool = True, return_sparse: bool = False,
+               return_colbert_vecs: bool = False) -> Dict[str, Any]:
+        """batch_size由服务端统一决定，这里忽略"""
+        if return_colbert_vecs:
+            raise ValueError("模型服务不支持ColBERT向量")
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        dense, lexical_weights = self.client.encode(list(sentences), max_length, return_sparse)
+        output: Dict[str, Any] = {"dense_vecs": dense}
+        if return_sparse:
+            output["lexical_weights"] = lexical_weights
+        return output
+
+
+class RemoteReranker:
+    """与FlagReranker.compute_score接口兼容的远程重排序器"""
+
+    def __init__(self, client: ModelServerClient):
+        self.client = client
+
+    def compute_score(self, sentence_pairs: List[List[str]], batch_size: Optional[int] = None,
+                      normalize: bool = False) -> List[float]:
+        """batch_size由服务端统一决定，这里忽略"""
+        return self.client.rerank([list(pair) for pair in sentence_pairs], normalize)
+
+
+def connect(url: str) -> Tuple[ModelServerClient, Dict[str, Any]]:
+    """连接模型服务并检查其可用性，返回 (客户端, 健康检查结果)"""
+    client = ModelServerClient(url)
+    try:
+        health = client.health()
+    except (OSError, http.client.HTTPException) as e:
+        raise ConnectionError(f"无法连接模型服务 {url}: {e}") from e
+    logger.info(f"Connected to model server {url} (model={health.get('model_path')}, "
+                f"reranker={health.get('reranker_path')})")
+    return client, health
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BGE-m3 / BGE-reranker model server with dynamic batching")
+    parser.add_argument("--model", default="BAAI/bge-m3")
+    parser.add_argument("--reranker", default="BAAI/bge-reranker-v2-m3", help="Empty string disables reranking")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--max-batch-size", type=int, default=64, help="Max texts/pairs per model call")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="Max time to wait for a batch to fill")
+    parser.add_argument("--encode-batch-size", type=int, default=12)
+    parser.add_argument("--rerank-batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server = EmbeddingServer(args.model, args.reranker or None, args.host, args.port,
+                             args.max_batch_size, args.max_wait_ms,
+                             args.encode_batch_size, args.rerank_batch_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down model server")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RAG检索基准测试
+
+构建指定规模的合成语料（或从JSONL文件采样），让查询集依次经过
+检索、重排序和桩生成（只构建提示词，不调用LLM），输出：
+- 各阶段 p50/p95/p99 延迟
+- 顺序查询QPS与批量检索QPS
+- 进程峰值内存
+- 当前索引相对暴力检索的recall@k
+
+结果写入JSON报告，便于在不同提交之间对比：
+    python rag_benchmark.py --corpus-size 5000 --index-type ivf --output report.json
+    python rag_benchmark.py --corpus-size 5000 --index-type ivf --baseline report.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import subprocess
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+from rag_pipeline import (
+    Document, RetrievalResult, BGERetrievalSystem, BGEReranker, LLMGenerator,
+    load_sample_documents, startup_report
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUERIES = [
+    "Python中有哪些数据类型？",
+    "如何在Python中定义函数？",
+    "Pandas和NumPy有什么区别？",
+    "Flask和Django哪个更适合新手？",
+    "机器学习的基本流程是什么？",
+    "PyTorch和TensorFlow如何选择？",
+    "Matplotlib如何绘制子图？",
+    "Python类的继承如何实现？",
+]
+
+
+class StubGenerator(LLMGenerator):
+    """桩生成器：构建提示词并模拟固定的LLM延迟，不调用DashScope"""
+
+    def __init__(self, latency_ms: float = 0.0, context_token_budget: Optional[int] = 3000):
+        # 占位密钥只用于通过父类校验，桩生成器从不调用DashScope
+        super().__init__(api_key="stub", model="stub", context_token_budget=context_token_budget)
+        self.latency = latency_ms / 1000.0
+
+    def generate_answer(self, query: str, contexts: List[RetrievalResult]) -> Dict[str, Any]:
+        start_time = time.time()
+        prompt, sources = self._build_prompt(query, self._pack_contexts(contexts)[0]) if contexts else ("", [])
+        if self.latency:
+            time.sleep(self.latency)
+        return {
+            "answer": prompt[:50],
+            "sources": sources,
+            "confidence": self._estimate_confidence(contexts) if contexts else 0.0,
+            "generation_time": time.time() - start_time,
+            "context_count": len(contexts)
+        }
+
+
+def build_corpus(size: int, seed: int = 42, corpus_file: Optional[str] = None) -> List[Document]:
+    """
+    构建基准语料
+
+    Args:
+        size: 文档数量
+        seed: 随机种子
+        corpus_file: 可选的JSONL语料文件（每行包含title和content），从中有放回采样；
+                     未提供时把示例文档的段落随机重组为合成文档
+    """
+    rng = random.Random(seed)
+    if corpus_file:
+        with open(corpus_file, 'r', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        return [Document(id=f"bench_{i:07d}", title=record.get("title", ""), content=record["content"],
+                         metadata=record.get("metadata", {}))
+                for i, record in enumerate(rng.choices(records, k=size))]
+
+    samples = load_sample_documents()
+    paragraphs = [(doc.title, paragraph) for doc in samples
+                  for paragraph in doc.content.split("\n\n") if paragraph.strip()]
+    documents = []
+    for i in range(size):
+        picked = rng.sample(paragraphs, k=min(len(paragraphs), rng.randint(3, 8)))
+        documents.append(Document(
+            id=f"bench_{i:07d}",
+            title=f"{picked[0][0]} #{i}",
+            content="\n\n".join(paragraph for _, paragraph in picked)
+        ))
+    return documents
+
+
+def build_queries(num_queries: int, seed: int = 42, query_file: Optional[str] = None) -> List[str]:
+    """构建查询集：从查询文件（每行一个查询）或内置查询中有放回采样"""
+    pool = DEFAULT_QUERIES
+    if query_file:
+        with open(query_file, 'r', encoding='utf-8') as f:
+            pool = [line.strip() for line in f if line.strip()]
+    return random.Random(seed).choices(pool, k=num_queries)
+
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    """把秒级耗时样本汇总为毫秒级分位数"""
+    if not samples:
+        return {}
+    values = np.asarray(samples) * 1000
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(values.mean()),
+        "max": float(values.max()),
+    }
+
+
+def peak_rss_mb() -> Optional[float]:
+    """进程峰值常驻内存（MB），不支持的平台返回None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux以KB为单位，macOS以字节为单位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit() -> Optional[str]:
+    """当前代码的git提交号"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """执行基准测试并返回报告"""
+    documents = build_corpus(args.corpus_size, args.seed, args.corpus_file)
+    queries = build_queries(args.num_queries, args.seed, args.query_file)
+
+    # 关闭缓存，避免重复查询命中缓存导致延迟失真
+    retrieval = BGERetrievalSystem(args.retrieval_model,
+                                   index_type=args.index_type,
+                                   index_params=json.loads(args.index_params),
+                                   query_cache_size=0,
+                                   retrieval_mode=args.retrieval_mode,
+                                   encode_batch_size=args.encode_batch_size,
+                                   chunk_workers=args.chunk_workers,
+                                   model_server=args.model_server)
+    reranker = BGEReranker(args.reranker_model, score_cache_size=0, model_server=args.model_server)
+    generator = StubGenerator(args.llm_latency_ms)
+    # 模型按需加载；先显式加载，避免模型加载时间计入入库耗时
+    retrieval.load_model()
+    reranker.load_model()
+
+    start_time = time.time()
+    retrieval.add_documents(documents)
+    ingest_time = time.time() - start_time
+    rss_after_ingest = peak_rss_mb()
+
+    # 预热，排除首次调用的初始化开销
+    for query in queries[:args.warmup]:
+        reranker.rerank(query, retrieval.search(query, args.retrieval_top_k), args.rerank_top_k)
+
+    stage_samples: Dict[str, List[float]] = {"retrieval": [], "rerank": [], "generation": [], "total": []}
+    start_time = time.time()
+    for query in queries:
+        t0 = time.perf_counter()
+        results = retrieval.search(query, args.retrieval_top_k)
+        t1 = time.perf_counter()
+        reranked = reranker.rerank(query, results, args.rerank_top_k)
+        t2 = time.perf_counter()
+        generator.generate_answer(query, reranked)
+        t3 = time.perf_counter()
+        stage_samples["retrieval"].append(t1 - t0)
+        stage_samples["rerank"].append(t2 - t1)
+        stage_samples["generation"].append(t3 - t2)
+        stage_samples["total"].append(t3 - t0)
+    sequential_time = time.time() - start_time
+
+    start_time = time.time()
+    for begin in range(0, len(queries), args.batch_size):
+        retrieval.search_batch(queries[begin:begin + args.batch_size], args.retrieval_top_k)
+    batch_time = time.time() - start_time
+
+    # 查询集为空时没有可评估的召回
+    recall = (retrieval.evaluate_index(queries, args.retrieval_top_k) if queries
+              else {"top_k": args.retrieval_top_k})
+    embeddings = retrieval.embeddings
+
+    return {
+        "benchmark": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "git_commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "corpus": {
+            "documents": len(documents),
+            "chunks": len(retrieval.documents),
+            "ingest_time": ingest_time,
+            "ingest_stats": retrieval.ingest_stats,
+        },
+        "latency_ms": {stage: latency_summary(samples) for stage, samples in stage_samples.items()},
+        "throughput": {
+            "sequential_qps": len(queries) / sequential_time if sequential_time > 0 else 0.0,
+            "batch_retrieval_qps": len(queries) / batch_time if batch_time > 0 else 0.0,
+        },
+        "recall": recall,
+        "startup_s": startup_report(),
+        "memory": {
+            "peak_rss_mb_after_ingest": rss_after_ingest,
+            "peak_rss_mb": peak_rss_mb(),
+            "embeddings_mb": embeddings.nbytes / 1024 / 1024 if embeddings is not None else 0.0,
+        },
+    }
+
+
+def compare_reports(report: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """对比两份报告的延迟、吞吐和召回，返回可打印的差异行"""
+    lines = []
+    for stage, summary in report["latency_ms"].items():
+        old = baseline.get("latency_ms", {}).get(stage, {})
+        for name in ("p50", "p95", "p99"):
+            if name in summary and old.get(name):
+                change = (summary[name] - old[name]) / old[name] * 100
+                lines.append(f"{stage:<10} {name}: {old[name]:9.2f} -> {summary[name]:9.2f} ms ({change:+.1f}%)")
+    for name, value in report["throughput"].items():
+        old = baseline.get("throughput", {}).get(name)
+        if old:
+            lines.append(f"{name}: {old:.1f} -> {value:.1f} ({(value - old) / old * 100:+.1f}%)")
+    recall_key = f"recall@{report['recall']['top_k']}"
+    if recall_key in report["recall"] and recall_key in baseline.get("recall", {}):
+        lines.append(f"{recall_key}: {baseline['recall'][recall_key]:.4f} -> {report['recall'][recall_key]:.4f}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG retrieval benchmark")
+    parser.add_argument("--corpus-size", type=int, default=1000, help="Number of documents")
+    parser.add_argument("--corpus-file", help="Optional JSONL corpus to sample from (title/content per line)")
+    parser.add_argument("--num-queries", type=int, default=200, help="Number of queries")
+    parser.add_argument("--query-file", help="Optional query file, one query per line")
+    parser.add_argument("--retrieval-model", default="BAAI/bge-m3")
+    parser.add_argument("--reranker-model", default="BAAI/bge-reranker-v2-m3")
+    parser.add_argument("--index-type", default="exact", help="exact / ivf / hnsw / int8 / binary")
+    parser.add_argument("--index-params", default="{}", help='Index parameters as JSON, e.g. \'{"nprobe": 16}\'')
+    parser.add_argument("--retrieval-mode", default="dense", choices=["dense", "hybrid"])
+    parser.add_argument("--retrieval-top-k", type=int, default=20)
+    parser.add_argument("--rerank-top-k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=32, help="Query batch size for search_batch")
+    parser.add_argument("--encode-batch-size", type=int, default=12)
+    parser.add_argument("--chunk-workers", type=int, default=1)
+    parser.add_argument("--model-server", help="Use a shared model server (see embedding_server.py) instead of local models")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="Simulated LLM latency")
+    parser.add_argument("--warmup", type=int, default=3, help="Warm-up queries excluded from timings")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_report.json", help="Where to write the JSON report")
+    parser.add_argument("--baseline", help="Previous JSON report to compare against")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"📊 基准报告已写入 {args.output}")
+    for stage, summary in report["latency_ms"].items():
+        if not summary:
+            print(f"  {stage:<10} 无样本")
+            continue
+        print(f"  {stage:<10} p50={summary['p50']:.2f}ms p95={summary['p95']:.2f}ms p99={summary['p99']:.2f}ms")
+    print(f"  顺序QPS：{report['throughput']['sequential_qps']:.1f}  "
+          f"批量检索QPS：{report['throughput']['batch_retrieval_qps']:.1f}")
+    recall_key = f"recall@{args.retrieval_top_k}"
+    if recall_key in report["recall"]:
+        print(f"  {recall_key}：{report['recall'][recall_key]:.4f}")
+    print(f"  峰值内存：{report['memory']['peak_rss_mb']} MB")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\n🔍 与基线 {args.baseline} 对比：")
+        for line in compare_reports(report, baseline):
+            print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
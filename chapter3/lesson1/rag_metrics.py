@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RAG流水线的结构化耗时追踪与指标导出
+
+- span(): 记录一个阶段（编码、ANN检索、重排序、提示词构建、LLM调用）的耗时，
+  写入进程内直方图，并挂到当前查询的trace上
+- trace(): 为单次查询收集各阶段span，汇总到pipeline_stats
+- traced(): 为生成器开启trace，每一步都在独立的上下文中执行，trace不跨yield泄漏
+- MetricsRegistry: 线程安全的直方图/计数器注册表，可导出Prometheus文本格式或JSON
+"""
+
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import List, Dict, Tuple, Any, Optional, Iterator, TypeVar
+
+# 默认直方图桶（秒），覆盖从亚毫秒级检索到数十秒的LLM生成
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_DURATION = "rag_stage_duration_seconds"
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+T = TypeVar("T")
+
+
+class Histogram:
+    """固定桶的累积直方图"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个为 +Inf 桶
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """按桶内线性插值估计分位数"""
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for i, bound in enumerate(self.buckets):
+            if cumulative + self.counts[i] >= target:
+                fraction = (target - cumulative) / self.counts[i] if self.counts[i] else 0.0
+                return lower + (bound - lower) * fraction
+            cumulative += self.counts[i]
+            lower = bound
+        return self.buckets[-1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)),
+        }
+
+
+class Trace:
+    """单次查询内收集到的span列表"""
+
+    def __init__(self):
+        self.spans: List[Dict[str, Any]] = []
+        self._start = time.perf_counter()
+
+    def add(self, name: str, start: float, duration: float):
+        self.spans.append({"name": name, "start_ms": (start - self._start) * 1000, "duration_ms": duration * 1000})
+
+    def summary(self) -> Dict[str, float]:
+        """按阶段名汇总耗时（毫秒），同名span累加"""
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            totals[span["name"]] = totals.get(span["name"], 0.0) + span["duration_ms"]
+        return totals
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("rag_trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    """返回当前上下文中正在收集的trace，没有时返回None"""
+    return _current_trace.get()
+
+
+class MetricsRegistry:
+    """进程内指标注册表"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._help: Dict[str, str] = {
+            STAGE_DURATION: "Duration of RAG pipeline stages",
+        }
+
+    def describe(self, name: str, help_text: str):
+        """登记指标说明，导出Prometheus格式时写入 # HELP 行"""
+        self._help[name] = help_text
+
+    @staticmethod
+    def _label_key(labels: Dict[str, Any]) -> LabelKey:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels):
+        """向直方图写入一个观测值"""
+        key = self._label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        """计数器累加"""
+        key = self._label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    @contextmanager
+    def span(self, name: str, **labels) -> Iterator[None]:
+        """记录一个阶段的耗时：写入stage直方图，并挂到当前trace"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe(STAGE_DURATION, duration, stage=name, **labels)
+            trace = _current_trace.get()
+            if trace is not None:
+                trace.add(name, start, duration)
+
+    @contextmanager
+    def trace(self) -> Iterator[Trace]:
+        """为一次查询开启trace，期间的span都会被收集"""
+        current = Trace()
+        token = _current_trace.set(current)
+        try:
+            yield current
+        finally:
+            _current_trace.reset(token)
+
+    def traced(self, iterator: Iterator[T]) -> Iterator[T]:
+        """
+        在新trace中驱动生成器
+
+        trace()会在yield期间保持ContextVar已设置，不能包住生成器：trace会泄漏到
+        调用方在两次next()之间执行的代码，且生成器在其他上下文中关闭时reset会失败。
+        这里复制一次上下文并在其中设置trace，生成器的每一步（含关闭）都在该上下文中执行，
+        调用方的上下文始终不受影响。
+        """
+        context = contextvars.copy_context()
+        context.run(_current_trace.set, Trace())
+        try:
+            while True:
+                try:
+                    item = context.run(next, iterator)
+                except StopIteration:
+                    return
+                yield item
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                context.run(close)
+
+    def reset(self):
+        """清空全部指标"""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def export_json(self) -> Dict[str, Any]:
+        """导出为可JSON序列化的字典"""
+        with self._lock:
+            return {
+                "histograms": {
+                    name: [{"labels": dict(key), **histogram.snapshot()} for key, histogram in series.items()]
+                    for name, series in self._histograms.items()
+                },
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self._counters.items()
+                },
+            }
+
+    @staticmethod
+    def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(key) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def export_prometheus(self) -> str:
+        """导出为Prometheus文本格式"""
+        lines = []
+        with self._lock:
+            for name, series in self._histograms.items():
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._format_labels(key, ('le', repr(bound)))} {cumulative}")
+                    lines.append(f"{name}_bucket{self._format_labels(key, ('le', '+Inf'))} {histogram.count}")
+                    lines.append(f"{name}_sum{self._format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{self._format_labels(key)} {histogram.count}")
+            for name, series in self._counters.items():
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{self._format_labels(key)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+# 进程级默认注册表
+metrics = MetricsRegistry()
@@ -15,12 +15,21 @@ BGE-m3 召回 + BGE-reranker 重排 + LLM 生成答案的 RAG 示例
 """
 
 import os
+import sys
 import json
 import time
+import importlib
+import hashlib
+import threading
+import unicodedata
+import math
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from typing import List, Dict, Tuple, Any, Optional
+from typing import List, Dict, Tuple, Any, Optional, Iterator, Callable
 import logging
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
 from pathlib import Path
 
 # 设置日志
@@ -30,15 +39,88 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-try:
-    from FlagEmbedding import BGEM3FlagModel, FlagReranker
-    import dashscope
-    from dashscope import Generation
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-except ImportError as e:
-    logger.error(f"缺少必要的依赖包: {e}")
-    logger.error("请安装: pip install FlagEmbedding dashscope numpy langchain langchain-text-splitters")
-    exit(1)
+from vector_index import VectorIndex, SparseIndex, MetadataIndex, create_index, evaluate_recall, search_rows
+from rag_metrics import metrics, current_trace, STAGE_DURATION
+from embedding_server import RemoteBGEM3Model, RemoteReranker, connect as connect_model_server
+
+metrics.describe("rag_queries_total", "RAG queries served")
+metrics.describe("rag_rerank_pairs_total", "Query-document pairs scored by the reranker")
+metrics.describe("rag_rerank_pairs_saved_total", "Candidate pairs not sent to the reranker by adaptive depth")
+metrics.describe("rag_llm_tokens_total", "LLM tokens consumed, by direction (in/out)")
+metrics.describe("rag_startup_seconds", "Time spent importing dependencies, loading models and warming up")
+
+# 启动耗时：FlagEmbedding(torch)、dashscope、langchain在首次使用时才导入，模型在首次编码/打分时才加载，
+# 只做索引维护或健康检查的进程不承担这些开销。每个步骤的累计耗时记录在这里
+_startup_timings: Dict[str, float] = {}
+_startup_lock = threading.Lock()
+
+
+@contextmanager
+def _startup_step(name: str) -> Iterator[None]:
+    """记录一个启动步骤（依赖导入、模型加载、预热）的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        with _startup_lock:
+            _startup_timings[name] = _startup_timings.get(name, 0.0) + duration
+        metrics.observe("rag_startup_seconds", duration, step=name)
+
+
+def startup_report() -> Dict[str, float]:
+    """返回本进程中各启动步骤的累计耗时（秒）"""
+    with _startup_lock:
+        return dict(_startup_timings)
+
+
+def _require(module_name: str) -> Any:
+    """按需导入重量级依赖，缺失时给出安装提示"""
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    with _startup_step(f"import:{module_name}"):
+        try:
+            return importlib.import_module(module_name)
+        except ImportError as e:
+            logger.error(f"缺少必要的依赖包: {e}")
+            raise ImportError(f"缺少必要的依赖包 {module_name}，请安装: "
+                              "pip install FlagEmbedding dashscope numpy langchain langchain-text-splitters") from e
+
+# 文档切片参数
+CHUNK_SIZE = 1000  # 每个块的最大字符数
+CHUNK_OVERLAP = 200  # 块之间的重叠字符数
+CHUNK_SEPARATORS = ["\n\n", "\n", "。", "！", "？", ";", "；", ":", "：", ".", " ", ""]
+
+# 未指定集合的文档归入默认集合
+DEFAULT_COLLECTION = "default"
+
+# 查询编码结果：(稠密向量矩阵, 混合检索模式下每个查询的词项权重，否则为None)
+QueryRepresentations = Tuple[np.ndarray, Optional[List[Dict[str, float]]]]
+
+
+def _create_text_splitter() -> Any:
+    """创建文档切片器（RecursiveCharacterTextSplitter）"""
+    return _require("langchain_text_splitters").RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        length_function=len,
+        separators=CHUNK_SEPARATORS
+    )
+
+
+# 切片子进程中的切片器，由_init_chunk_worker在每个进程中创建一次
+_worker_splitter = None
+
+
+def _init_chunk_worker():
+    global _worker_splitter
+    _worker_splitter = _create_text_splitter()
+
+
+def _split_text_worker(text: str) -> List[str]:
+    """在切片子进程中切分单个文档"""
+    return _worker_splitter.split_text(text)
 
 @dataclass
 class Document:
@@ -50,6 +132,16 @@ class Document:
     chunk_id: Optional[str] = field(default=None)  # 文档块ID
     parent_id: Optional[str] = field(default=None)  # 父文档ID
     chunk_index: Optional[int] = field(default=None)  # 块索引
+    content_hash: Optional[str] = field(default=None)  # 块内容哈希，用于增量更新
+    collection: str = field(default=DEFAULT_COLLECTION)  # 所属集合（租户/命名空间）
+
+@dataclass
+class AdaptiveRerankConfig:
+    """自适应重排序深度配置"""
+    min_depth: int = 5  # 最少重排的候选数（不少于rerank_top_k）
+    max_depth: Optional[int] = None  # 最多重排的候选数，默认为全部检索结果
+    skip_gap: float = 0.15  # 第一名与第二名的检索分数差不低于该值时跳过重排
+    temperature: float = 0.05  # 计算分数分布熵时softmax的温度
 
 @dataclass
 class RetrievalResult:
@@ -58,47 +150,266 @@ class RetrievalResult:
     score: float
     rank: int
 
+class QueryEmbeddingCache:
+    """
+    查询向量的LRU缓存
+
+    以 (模型名, 归一化后的查询文本) 为键，命中时跳过编码器。
+    可选地把向量写入磁盘目录，进程重启后仍可复用。
+    """
+
+    def __init__(self, model_name: str, capacity: int = 1024, cache_dir: Optional[str] = None):
+        """
+        Args:
+            model_name: 嵌入模型名称，作为缓存键的一部分
+            capacity: 内存中最多缓存的查询数量
+            cache_dir: 可选的磁盘缓存目录
+        """
+        self.model_name = model_name
+        self.capacity = capacity
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """归一化查询文本：统一全半角、合并空白"""
+        return " ".join(unicodedata.normalize("NFKC", query).split())
+
+    def _key(self, query: str, kind: str) -> str:
+        raw = f"{self.model_name}\x00{kind}\x00{self.normalize(query)}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key: str, kind: str) -> Path:
+        # 稠密向量存为.npy，稀疏词项权重存为.json
+        return self.cache_dir / (f"{key}.npy" if kind == "dense" else f"{key}.json")
+
+    def get(self, query: str, kind: str = "dense") -> Optional[Any]:
+        """
+        查找查询表示，未命中返回None
+
+        Args:
+            query: 查询文本
+            kind: "dense"（稠密向量）或 "sparse"（BGE-m3词项权重）
+        """
+        key = self._key(query, kind)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        if self.cache_dir:
+            path = self._disk_path(key, kind)
+            if path.exists():
+                try:
+                    if kind == "dense":
+                        value = np.load(path)
+                    else:
+                        with open(path, 'r', encoding='utf-8') as f:
+                            value = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Failed to read cached query embedding {path}: {e}")
+                else:
+                    with self._lock:
+                        self.disk_hits += 1
+                    self._put(key, value)
+                    return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, query: str, value: Any, kind: str = "dense"):
+        """写入查询表示"""
+        key = self._key(query, kind)
+        self._put(key, value)
+        if self.cache_dir:
+            # 先写临时文件再原子替换，避免并发读到不完整的文件
+            path = self._disk_path(key, kind)
+            tmp_path = path.with_name(f"{key}.{threading.get_ident()}.tmp{path.suffix}")
+            if kind == "dense":
+                np.save(tmp_path, value)
+            else:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(value, f)
+            os.replace(tmp_path, path)
+
+    def _put(self, key: str, vector: Any):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "size": len(self._entries)
+            }
+
 class BGERetrievalSystem:
     """基于BGE-m3的检索系统"""
     
-    def __init__(self, model_path: str = "BAAI/bge-m3"):
+    def __init__(self, model_path: str = "BAAI/bge-m3",
+                 index_type: str = "exact",
+                 index_params: Optional[Dict[str, Any]] = None,
+                 query_cache_size: int = 1024,
+                 query_cache_dir: Optional[str] = None,
+                 retrieval_mode: str = "dense",
+                 dense_weight: float = 1.0,
+                 sparse_weight: float = 0.3,
+                 hybrid_dense_top_k: Optional[int] = None,
+                 encode_batch_size: int = 12,
+                 encode_max_length: int = 8192,
+                 chunk_workers: int = 1,
+                 model_server: Optional[str] = None):
         """
         初始化BGE-m3检索系统
         
         Args:
             model_path: BGE-m3模型路径
+            index_type: 向量索引类型，"exact"（暴力检索）、"ivf"（NumPy倒排索引）、"hnsw"（需faiss），
+                        或量化索引 "int8" / "binary"（量化扫描 + 浮点重打分）
+            index_params: 索引参数，如 {"nprobe": 16}、{"ef_search": 128} 或 {"rescore_factor": 8}
+            query_cache_size: 查询向量LRU缓存容量，为0时关闭缓存
+            query_cache_dir: 可选的查询向量磁盘缓存目录
+            retrieval_mode: "dense"（仅稠密向量）或 "hybrid"（稠密 + BGE-m3稀疏词项权重融合）
+            dense_weight: 混合检索中稠密分数的权重
+            sparse_weight: 混合检索中稀疏分数的权重
+            hybrid_dense_top_k: 混合检索中稠密路召回的候选数，默认与top_k相同；
+                                精确词项由稀疏倒排表召回，稠密候选集可以更小
+            encode_batch_size: 文档编码的批大小
+            encode_max_length: 文档编码的最大token长度
+            chunk_workers: 文档切片的进程数，大于1且文档数足够多时使用进程池并行切片
+            model_server: 可选的模型服务地址（见embedding_server.py），设置后不在本进程加载模型
+
+        模型在首次编码时才加载（或连接模型服务），只加载持久化索引的进程无需加载模型。
         """
-        logger.info(f"Loading BGE-m3 model: {model_path}")
+        if retrieval_mode not in ("dense", "hybrid"):
+            raise ValueError(f"不支持的检索模式: {retrieval_mode}")
+        self.model_path = model_path
+        self.index_type = index_type
+        self.index_params = index_params or {}
+        self.retrieval_mode = retrieval_mode
+        self.dense_weight = dense_weight
+        self.sparse_weight = sparse_weight
+        self.hybrid_dense_top_k = hybrid_dense_top_k
+        self.encode_batch_size = encode_batch_size
+        self.encode_max_length = encode_max_length
+        self.chunk_workers = chunk_workers
+        self.parallel_chunk_min_docs = 256  # 文档数少于该值时进程池的启动开销不划算
+        self.progress_interval = 32  # 每编码这么多个批次输出一次进度
+        # 最近一次入库的吞吐统计
+        self.ingest_stats: Dict[str, Any] = {}
+        self.model_server = model_server
+        self._model = None
+        self._model_lock = threading.Lock()
+            
+        self.documents: List[Document] = []
+        self.embeddings: Optional[np.ndarray] = None
+        self.index: VectorIndex = create_index(index_type, **self.index_params)
+        # 混合检索：每行的BGE-m3词项权重及其倒排索引
+        self.lexical_weights: List[Dict[str, float]] = []
+        self.sparse_index = SparseIndex()
+        self.query_cache: Optional[QueryEmbeddingCache] = None
+        if query_cache_size > 0:
+            self.query_cache = QueryEmbeddingCache(model_path, query_cache_size, query_cache_dir)
+
+        # 增量更新相关状态：逻辑删除的行号、父文档到行号的映射、后台压缩
+        self.compaction_threshold = 0.2  # 逻辑删除行占比超过该阈值时触发后台压缩
+        self._tombstones: set = set()
+        self._parent_rows: Dict[Tuple[str, str], List[int]] = {}  # (集合, 父文档ID) -> 行号
+        # 元数据位图索引：过滤后的行数占比不超过该值时，直接对这些行精确打分，不经过ANN索引
+        self.metadata_index = MetadataIndex()
+        self.prefilter_max_ratio = 0.2
+        self._lock = threading.RLock()  # 保护检索时读取的数据引用
+        self._write_lock = threading.Lock()  # 串行化所有写操作（增量更新、删除、压缩）
+        self._compaction_thread: Optional[threading.Thread] = None
+
+        # 文档切片器在首次切片时创建
+        self._text_splitter = None
+
+    @property
+    def model(self) -> Any:
+        """BGE-m3编码器，首次访问时加载"""
+        return self.load_model()
+
+    def load_model(self) -> Any:
+        """加载模型（或连接模型服务），已加载时直接返回"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = self._load_model()
+        return self._model
+
+    def _load_model(self) -> Any:
+        if self.model_server:
+            with _startup_step("connect_model_server"):
+                client, health = connect_model_server(self.model_server)
+            if health.get("model_path") != self.model_path:
+                logger.warning(f"Model server serves {health.get('model_path')}, but {self.model_path} was requested")
+            return RemoteBGEM3Model(client)
+
+        model_class = _require("FlagEmbedding").BGEM3FlagModel
+        logger.info(f"Loading BGE-m3 model: {self.model_path}")
         try:
-            self.model = BGEM3FlagModel(model_path, use_fp16=True)
+            with _startup_step(f"load_model:{self.model_path}"):
+                model = model_class(self.model_path, use_fp16=True)
             logger.info("BGE-m3 model loaded successfully")
+            return model
         except Exception as e:
             logger.error(f"Failed to load BGE-m3 model: {e}")
             raise
-            
-        self.documents: List[Document] = []
-        self.embeddings: Optional[np.ndarray] = None
-        
-    def add_documents(self, documents: List[Document]):
-        """添加文档到检索系统，包含文档切片"""
-        logger.info(f"Adding {len(documents)} documents to retrieval system")
-        
-        # 初始化文档切片器
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,  # 每个块的最大字符数
-            chunk_overlap=200,  # 块之间的重叠字符数
-            length_function=len,
-            separators=["\n\n", "\n", "。", "！", "？", ";", "；", ":", "：", ".", " ", ""]
-        )
-        
+
+    @property
+    def text_splitter(self) -> Any:
+        if self._text_splitter is None:
+            self._text_splitter = _create_text_splitter()
+        return self._text_splitter
+
+    def warmup(self, sample_text: str = "warmup") -> None:
+        """加载模型并编码一条样例文本，首个真实请求不再承担模型加载和首次推理的开销"""
+        self.load_model()
+        with _startup_step("warmup:retrieval"):
+            self._run_query_encoder([sample_text])
+
+    @staticmethod
+    def _content_hash(doc: Document) -> str:
+        """计算文档块嵌入文本的内容哈希，用于判断块是否需要重新编码"""
+        return hashlib.sha1(f"{doc.title}\n\n{doc.content}".encode('utf-8')).hexdigest()
+
+    def _split_texts(self, texts: List[str]) -> List[List[str]]:
+        """切分文档内容，文档数足够多时使用进程池并行切片"""
+        if self.chunk_workers <= 1 or len(texts) < self.parallel_chunk_min_docs:
+            return [self.text_splitter.split_text(text) for text in texts]
+
+        logger.info(f"Splitting {len(texts)} documents with {self.chunk_workers} processes")
+        chunksize = max(1, len(texts) // (self.chunk_workers * 8))
+        with ProcessPoolExecutor(max_workers=self.chunk_workers,
+                                 initializer=_init_chunk_worker) as executor:
+            return list(executor.map(_split_text_worker, texts, chunksize=chunksize))
+
+    def _split_documents(self, documents: List[Document]) -> List[Document]:
+        """将文档切分为文档块"""
         # 存储所有文档块
         all_chunks = []
+        start_time = time.time()
+        split_texts = self._split_texts([doc.content for doc in documents])
         
-        for doc in documents:
-            logger.info(f"Splitting document: {doc.title}")
-            
-            # 对文档内容进行切片
-            chunks = text_splitter.split_text(doc.content)
+        for doc, chunks in zip(documents, split_texts):
+            logger.debug(f"Splitting document: {doc.title}")
             
             for i, chunk_content in enumerate(chunks):
                 chunk_doc = Document(
@@ -108,16 +419,56 @@ class BGERetrievalSystem:
                     metadata=doc.metadata,
                     chunk_id=f"{doc.id}_chunk_{i}",
                     parent_id=doc.id,
-                    chunk_index=i
+                    chunk_index=i,
+                    collection=doc.collection
                 )
+                chunk_doc.content_hash = self._content_hash(chunk_doc)
                 all_chunks.append(chunk_doc)
         
-        logger.info(f"Created {len(all_chunks)} chunks from {len(documents)} documents")
-        self.documents = all_chunks
-        
+        chunk_time = time.time() - start_time
+        self.ingest_stats = {
+            "documents": len(documents),
+            "chunks": len(all_chunks),
+            "chunk_time": chunk_time
+        }
+        logger.info(f"Created {len(all_chunks)} chunks from {len(documents)} documents in {chunk_time:.2f}s")
+        return all_chunks
+
+    @property
+    def use_sparse(self) -> bool:
+        """是否启用BGE-m3稀疏词项权重"""
+        return self.retrieval_mode == "hybrid"
+
+    @staticmethod
+    def _parse_lexical_weights(result: Any, count: int) -> List[Dict[str, float]]:
+        """把BGE-m3返回的词项权重转换为 {词项ID: float} 字典列表"""
+        if not isinstance(result, dict) or 'lexical_weights' not in result:
+            logger.warning("Encoder did not return lexical weights; sparse scores will be empty")
+            return [{} for _ in range(count)]
+        return [{str(term): float(weight) for term, weight in weights.items()}
+                for weights in result['lexical_weights']]
+
+    def _token_lengths(self, texts: List[str]) -> List[int]:
+        """估计每段文本的token数，模型未暴露分词器时退化为字符数"""
+        tokenizer = getattr(self.model, 'tokenizer', None)
+        if tokenizer is not None:
+            try:
+                input_ids = tokenizer(texts, truncation=True, max_length=self.encode_max_length)['input_ids']
+                return [len(ids) for ids in input_ids]
+            except Exception as e:
+                logger.warning(f"Tokenizer failed, falling back to character lengths: {e}")
+        return [min(len(text), self.encode_max_length) for text in texts]
+
+    def _encode_chunks(self, chunks: List[Document]) -> Tuple[np.ndarray, Optional[List[Dict[str, float]]]]:
+        """
+        为文档块生成稠密向量，混合检索模式下同时返回稀疏词项权重
+
+        文本按长度排序后分批编码，同一批内长度相近，减少padding浪费；
+        结果再按原顺序还原。
+        """
         # 构建文档文本用于嵌入
         doc_texts = []
-        for doc in self.documents:
+        for doc in chunks:
             # 结合标题和内容，但内容已经是切片后的
             full_text = f"{doc.title}\n\n{doc.content}"
             doc_texts.append(full_text)
@@ -125,117 +476,779 @@ class BGERetrievalSystem:
         # 生成嵌入向量
         logger.info("Generating embeddings...")
         start_time = time.time()
-        embedding_result = self.model.encode(
-            doc_texts,
-            batch_size=12,
+        token_lengths = self._token_lengths(doc_texts)
+        order = np.argsort(token_lengths, kind='stable')[::-1]
+        total_tokens = int(sum(token_lengths))
+
+        segment_size = self.encode_batch_size * self.progress_interval
+        embeddings: Optional[np.ndarray] = None
+        lexical_weights: Optional[List[Dict[str, float]]] = [{}] * len(chunks) if self.use_sparse else None
+        encoded_chunks = encoded_tokens = 0
+        for begin in range(0, len(order), segment_size):
+            rows = order[begin:begin + segment_size]
+            embedding_result = self.model.encode(
+                [doc_texts[row] for row in rows],
+                batch_size=self.encode_batch_size,
+                max_length=self.encode_max_length,
+                return_dense=True,
+                return_sparse=self.use_sparse,
+                return_colbert_vecs=False
+            )
+            
+            # 处理BGE-m3的返回结果
+            if isinstance(embedding_result, dict) and 'dense_vecs' in embedding_result:
+                dense = np.asarray(embedding_result['dense_vecs'])
+            else:
+                # 如果直接返回向量数组
+                dense = np.asarray(embedding_result)
+            if embeddings is None:
+                embeddings = np.empty((len(chunks), dense.shape[1]), dtype=dense.dtype)
+            embeddings[rows] = dense
+
+            if self.use_sparse:
+                for row, weights in zip(rows, self._parse_lexical_weights(embedding_result, len(rows))):
+                    lexical_weights[row] = weights
+
+            encoded_chunks += len(rows)
+            encoded_tokens += sum(token_lengths[row] for row in rows)
+            if len(order) > segment_size:
+                elapsed = max(time.time() - start_time, 1e-9)
+                logger.info(f"Encoded {encoded_chunks}/{len(chunks)} chunks "
+                            f"({encoded_chunks / elapsed:.1f} chunks/s, {encoded_tokens / elapsed:.0f} tokens/s)")
+
+        if embeddings is None:
+            embeddings = np.empty((0, 0), dtype=np.float32)
+
+        embedding_time = time.time() - start_time
+        chunks_per_sec = len(chunks) / embedding_time if embedding_time > 0 else 0.0
+        tokens_per_sec = total_tokens / embedding_time if embedding_time > 0 else 0.0
+        self.ingest_stats.update({
+            "encoded_chunks": len(chunks),
+            "tokens": total_tokens,
+            "encode_time": embedding_time,
+            "chunks_per_sec": chunks_per_sec,
+            "tokens_per_sec": tokens_per_sec
+        })
+        logger.info(f"Generated embeddings for {len(chunks)} chunks in {embedding_time:.2f}s "
+                    f"({chunks_per_sec:.1f} chunks/s, {tokens_per_sec:.0f} tokens/s)")
+        return embeddings, lexical_weights
+
+    def _build_index(self, embeddings: np.ndarray) -> VectorIndex:
+        """基于完整向量矩阵构建新的索引对象，构建完成后再由调用方替换，不影响并发检索"""
+        index = create_index(self.index_type, **self.index_params)
+        index.build(embeddings)
+        return index
+
+    def _build_sparse_index(self, lexical_weights: List[Dict[str, float]]) -> SparseIndex:
+        """基于每行的词项权重构建新的倒排索引"""
+        sparse_index = SparseIndex()
+        if self.use_sparse:
+            sparse_index.build(lexical_weights)
+        return sparse_index
+
+    @staticmethod
+    def _metadata_record(doc: Document) -> Dict[str, Any]:
+        """参与过滤的元数据：文档元数据加上所属集合"""
+        return {**(doc.metadata or {}), "collection": doc.collection}
+
+    def _rebuild_row_maps(self):
+        """根据当前文档块列表重建父文档到行号的映射和元数据位图索引"""
+        self._parent_rows = {}
+        records = []
+        for row, doc in enumerate(self.documents):
+            if row in self._tombstones:
+                records.append(None)
+                continue
+            self._parent_rows.setdefault((doc.collection, doc.parent_id), []).append(row)
+            records.append(self._metadata_record(doc))
+        # 新建索引对象后整体替换，并发检索持有的旧对象及其掩码缓存不受影响
+        metadata_index = MetadataIndex()
+        metadata_index.build(records)
+        self.metadata_index = metadata_index
+
+    def add_documents(self, documents: List[Document]):
+        """添加文档到检索系统，包含文档切片（全量重建）"""
+        logger.info(f"Adding {len(documents)} documents to retrieval system")
+        
+        chunks = self._split_documents(documents)
+        embeddings, lexical_weights = self._encode_chunks(chunks)
+        index = self._build_index(embeddings)
+        lexical_weights = lexical_weights or []
+        sparse_index = self._build_sparse_index(lexical_weights)
+
+        with self._write_lock, self._lock:
+            self.documents = chunks
+            self.embeddings = embeddings
+            self.index = index
+            self.lexical_weights = lexical_weights
+            self.sparse_index = sparse_index
+            self._tombstones = set()
+            self._rebuild_row_maps()
+
+    def upsert_documents(self, documents: List[Document]) -> Dict[str, int]:
+        """
+        增量添加或更新文档（按集合和Document.id去重，同一批中重复的ID以最后一个为准）
+
+        仅对内容哈希发生变化的新块进行编码并追加到向量矩阵末尾；
+        内容未变的块直接复用原有向量，已不存在的旧块被逻辑删除。
+
+        Returns:
+            本次更新的统计：新编码块数、复用块数、逻辑删除块数
+        """
+        logger.info(f"Upserting {len(documents)} documents")
+        documents = list({(doc.collection, doc.id): doc for doc in documents}.values())
+        # 没有切出任何块的文档也保留一项，以便逻辑删除它的旧块
+        chunks_by_parent: Dict[Tuple[str, str], List[Document]] = {(doc.collection, doc.id): [] for doc in documents}
+        for chunk in self._split_documents(documents):
+            chunks_by_parent[(chunk.collection, chunk.parent_id)].append(chunk)
+
+        with self._write_lock:
+            reused, retired = [], []
+            to_encode = []
+            # 每个父文档内按内容哈希匹配已有块
+            for key, chunks in chunks_by_parent.items():
+                existing = {}
+                for row in self._parent_rows.get(key, []):
+                    existing.setdefault(self.documents[row].content_hash, []).append(row)
+                for chunk in chunks:
+                    rows = existing.get(chunk.content_hash)
+                    if rows:
+                        # 内容未变：复用向量，仅更新块编号等元数据
+                        reused.append((rows.pop(0), chunk))
+                    else:
+                        to_encode.append(chunk)
+                for rows in existing.values():
+                    retired.extend(rows)
+
+            # 编码和建索引时不持有读锁，避免阻塞并发检索；
+            # 写锁保证这期间没有其他写操作修改下面读取的字段
+            new_embeddings, new_lexical = self._encode_chunks(to_encode) if to_encode else (None, None)
+
+            # 新对象全部在锁外构建，检索线程持有的旧快照（文档、矩阵、索引）始终彼此一致
+            documents = list(self.documents)
+            for row, chunk in reused:
+                documents[row] = chunk
+            embeddings, index = self.embeddings, self.index
+            lexical_weights, sparse_index = self.lexical_weights, self.sparse_index
+            if new_embeddings is not None:
+                start_row = len(documents)
+                # add_documents([])会留下形状为(0, 0)的空矩阵，同样按首次写入处理
+                if self.embeddings is None or len(self.embeddings) == 0:
+                    embeddings = new_embeddings
+                    index = self._build_index(new_embeddings)
+                    lexical_weights = new_lexical or []
+                    sparse_index = self._build_sparse_index(lexical_weights)
+                else:
+                    embeddings = np.vstack([self.embeddings, new_embeddings.astype(self.embeddings.dtype)])
+                    index = self.index.add(embeddings, start_row)
+                    if new_lexical is not None:
+                        lexical_weights = self.lexical_weights + new_lexical
+                        sparse_index = self.sparse_index.add(new_lexical, start_row)
+                documents.extend(to_encode)
+
+            with self._lock:
+                self.documents = documents
+                self.embeddings = embeddings
+                self.index = index
+                self.lexical_weights = lexical_weights
+                self.sparse_index = sparse_index
+                self._tombstones = self._tombstones | set(retired)
+                self._rebuild_row_maps()
+
+        stats = {"encoded": len(to_encode), "reused": len(reused), "deleted": len(retired)}
+        logger.info(f"Upsert finished: {stats}")
+        self._maybe_compact()
+        return stats
+
+    def delete_documents(self, parent_ids: List[str], collection: str = DEFAULT_COLLECTION) -> int:
+        """
+        按父文档ID逻辑删除文档的所有块
+
+        Args:
+            parent_ids: 父文档ID列表
+            collection: 文档所属集合
+
+        Returns:
+            被删除的块数量
+        """
+        with self._write_lock, self._lock:
+            rows = []
+            for parent_id in parent_ids:
+                rows.extend(self._parent_rows.get((collection, parent_id), []))
+            if rows:
+                self._tombstones.update(rows)
+                self._rebuild_row_maps()
+
+        logger.info(f"Deleted {len(rows)} chunks of {len(parent_ids)} documents from collection {collection}")
+        self._maybe_compact()
+        return len(rows)
+
+    def delete_collection(self, collection: str) -> int:
+        """
+        逻辑删除整个集合的所有块
+
+        Returns:
+            被删除的块数量
+        """
+        with self._write_lock, self._lock:
+            rows = [row for (name, _), parent_rows in self._parent_rows.items() if name == collection
+                    for row in parent_rows]
+            if rows:
+                self._tombstones.update(rows)
+                self._rebuild_row_maps()
+
+        logger.info(f"Deleted collection {collection} ({len(rows)} chunks)")
+        self._maybe_compact()
+        return len(rows)
+
+    def collections(self) -> Dict[str, int]:
+        """返回各集合的有效块数量"""
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for (name, _), rows in self._parent_rows.items():
+                counts[name] = counts.get(name, 0) + len(rows)
+        return counts
+
+    def _maybe_compact(self):
+        """逻辑删除行占比超过阈值时，在后台线程中压缩索引"""
+        with self._lock:
+            total = len(self.documents)
+            if not total or len(self._tombstones) / total < self.compaction_threshold:
+                return
+            if self._compaction_thread and self._compaction_thread.is_alive():
+                return
+            self._compaction_thread = threading.Thread(target=self.compact, daemon=True)
+            self._compaction_thread.start()
+
+    def compact(self):
+        """
+        物理移除逻辑删除的行，重建连续的向量矩阵
+
+        新矩阵在读锁外构建，构建期间检索仍使用旧矩阵，完成后原子替换。
+        """
+        with self._write_lock:
+            if not self._tombstones:
+                return
+            start_time = time.time()
+            live_rows = self._live_rows()
+            compacted_docs = [self.documents[row] for row in live_rows]
+            compacted_embeddings = np.ascontiguousarray(self.embeddings[live_rows])
+            compacted_index = self._build_index(compacted_embeddings)
+            compacted_lexical = [self.lexical_weights[row] for row in live_rows] if self.use_sparse else []
+            compacted_sparse = self._build_sparse_index(compacted_lexical)
+
+            with self._lock:
+                removed = len(self._tombstones)
+                self.documents = compacted_docs
+                self.embeddings = compacted_embeddings
+                self.index = compacted_index
+                self.lexical_weights = compacted_lexical
+                self.sparse_index = compacted_sparse
+                self._tombstones = set()
+                self._rebuild_row_maps()
+
+        logger.info(f"Compacted index: removed {removed} rows in {time.time() - start_time:.3f}s")
+
+    def _allowed_mask(self, collection: Optional[str] = None,
+                      where: Optional[Dict[str, Any]] = None) -> Optional[np.ndarray]:
+        """
+        返回可参与检索的行掩码；没有逻辑删除且没有过滤条件时返回None
+
+        元数据位图索引构建时已排除逻辑删除的行，过滤掩码无需再与删除掩码合并。
+        """
+        if collection is not None:
+            where = {"$and": [{"collection": collection}, where]} if where else {"collection": collection}
+        if where:
+            return self.metadata_index.mask(where)
+        if not self._tombstones:
+            return None
+        mask = np.ones(len(self.documents), dtype=bool)
+        mask[list(self._tombstones)] = False
+        return mask
+
+    def _live_rows(self) -> np.ndarray:
+        """返回未被逻辑删除的行号"""
+        mask = self._allowed_mask()
+        return np.arange(len(self.documents)) if mask is None else np.flatnonzero(mask)
+
+    def save_index(self, index_dir: str, dtype: str = "float32"):
+        """
+        将切片元数据和向量矩阵持久化到磁盘
+
+        目录结构：
+        - meta.json: 模型名、向量维度、存储精度、块数量
+        - chunks.jsonl: 每行一个文档块，与向量矩阵按行对齐
+        - embeddings.bin: 连续存储的向量矩阵（行优先），可直接被np.memmap打开
+        - lexical_weights.jsonl: 混合检索模式下每行的BGE-m3词项权重
+
+        Args:
+            index_dir: 索引目录
+            dtype: 向量存储精度，"float32" 或 "float16"（磁盘和page cache占用减半）
+        """
+        if self.embeddings is None:
+            raise ValueError("没有可保存的向量，请先调用add_documents")
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"不支持的存储精度: {dtype}")
+
+        index_path = Path(index_dir)
+        index_path.mkdir(parents=True, exist_ok=True)
+        start_time = time.time()
+
+        # 只保存未被逻辑删除的行
+        with self._lock:
+            live_rows = self._live_rows()
+            documents = [self.documents[row] for row in live_rows]
+            matrix = np.ascontiguousarray(self.embeddings[live_rows], dtype=dtype)
+            lexical_weights = [self.lexical_weights[row] for row in live_rows] if self.use_sparse else None
+        meta = {
+            "model_path": self.model_path,
+            "dim": int(matrix.shape[1]),
+            "count": int(matrix.shape[0]),
+            "dtype": dtype
+        }
+
+        # 先写临时文件再原子替换，避免其他进程读到写了一半的索引
+        tmp_embeddings = index_path / "embeddings.bin.tmp"
+        matrix.tofile(tmp_embeddings)
+        tmp_chunks = index_path / "chunks.jsonl.tmp"
+        with open(tmp_chunks, 'w', encoding='utf-8') as f:
+            for doc in documents:
+                f.write(json.dumps(asdict(doc), ensure_ascii=False) + "\n")
+        if lexical_weights is not None:
+            tmp_lexical = index_path / "lexical_weights.jsonl.tmp"
+            with open(tmp_lexical, 'w', encoding='utf-8') as f:
+                for weights in lexical_weights:
+                    f.write(json.dumps(weights) + "\n")
+        tmp_meta = index_path / "meta.json.tmp"
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+
+        os.replace(tmp_embeddings, index_path / "embeddings.bin")
+        os.replace(tmp_chunks, index_path / "chunks.jsonl")
+        if lexical_weights is not None:
+            os.replace(tmp_lexical, index_path / "lexical_weights.jsonl")
+        os.replace(tmp_meta, index_path / "meta.json")
+
+        logger.info(f"Saved index with {meta['count']} chunks ({dtype}) to {index_dir} "
+                    f"in {time.time() - start_time:.2f}s")
+
+    def load_index(self, index_dir: str, mmap: bool = True):
+        """
+        从磁盘加载索引，无需重新切片和嵌入
+
+        使用np.memmap只读映射向量文件，加载耗时与语料规模基本无关，
+        同一台机器上的多个worker进程共享操作系统page cache中的同一份向量。
+
+        Args:
+            index_dir: save_index写出的索引目录
+            mmap: 是否以内存映射方式打开；为False时将向量完整读入内存
+        """
+        index_path = Path(index_dir)
+        start_time = time.time()
+
+        with open(index_path / "meta.json", 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get("model_path") != self.model_path:
+            logger.warning(f"Index was built with {meta.get('model_path')}, "
+                           f"but current model is {self.model_path}")
+
+        documents = []
+        with open(index_path / "chunks.jsonl", 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    doc = Document(**json.loads(line))
+                    doc.content_hash = doc.content_hash or self._content_hash(doc)
+                    documents.append(doc)
+        if len(documents) != meta["count"]:
+            raise ValueError(f"索引已损坏: chunks.jsonl有{len(documents)}条, meta记录{meta['count']}条")
+
+        shape = (meta["count"], meta["dim"])
+        embeddings = np.memmap(index_path / "embeddings.bin", dtype=meta["dtype"], mode='r', shape=shape)
+        if not mmap:
+            embeddings = np.array(embeddings)
+        index = self._build_index(embeddings)
+
+        lexical_weights = []
+        if self.use_sparse:
+            lexical_path = index_path / "lexical_weights.jsonl"
+            if lexical_path.exists():
+                with open(lexical_path, 'r', encoding='utf-8') as f:
+                    lexical_weights = [json.loads(line) for line in f if line.strip()]
+            if len(lexical_weights) != len(documents):
+                logger.warning("Index has no lexical weights for every chunk; sparse scores disabled for this index")
+                lexical_weights = [{} for _ in documents]
+        sparse_index = self._build_sparse_index(lexical_weights)
+
+        with self._write_lock, self._lock:
+            self.documents = documents
+            self.embeddings = embeddings
+            self.index = index
+            self.lexical_weights = lexical_weights
+            self.sparse_index = sparse_index
+            self._tombstones = set()
+            self._rebuild_row_maps()
+        logger.info(f"Loaded index with {meta['count']} chunks from {index_dir} "
+                    f"(mmap={mmap}) in {(time.time() - start_time) * 1000:.1f}ms")
+
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+        """对查询文本进行嵌入，返回形状为 (len(queries), dim) 的矩阵"""
+        return self._encode_query_representations(queries)[0]
+
+    def encode_queries(self, queries: List[str]) -> QueryRepresentations:
+        """
+        编码查询，结果可传给search/search_batch的representations参数复用
+
+        Returns:
+            (稠密向量矩阵, 混合检索模式下的词项权重列表，否则为None)
+        """
+        with metrics.span("encode"):
+            return self._encode_query_representations(queries)
+
+    def _encode_query_representations(self, queries: List[str]) -> Tuple[np.ndarray, Optional[List[Dict[str, float]]]]:
+        """
+        编码查询文本，返回稠密向量矩阵，混合检索模式下同时返回词项权重；
+        命中缓存的查询跳过编码器
+        """
+        kinds = ["dense", "sparse"] if self.use_sparse else ["dense"]
+        cached = {kind: [None] * len(queries) for kind in kinds}
+        if self.query_cache is not None:
+            for kind in kinds:
+                cached[kind] = [self.query_cache.get(q, kind) for q in queries]
+
+        missing = [i for i in range(len(queries)) if any(cached[kind][i] is None for kind in kinds)]
+        if missing:
+            dense, sparse = self._run_query_encoder([queries[i] for i in missing])
+            for j, i in enumerate(missing):
+                cached["dense"][i] = dense[j]
+                if sparse is not None:
+                    cached["sparse"][i] = sparse[j]
+                if self.query_cache is not None:
+                    for kind in kinds:
+                        self.query_cache.put(queries[i], cached[kind][i], kind)
+
+        return np.stack(cached["dense"]), cached.get("sparse")
+
+    def _run_query_encoder(self, queries: List[str]) -> Tuple[np.ndarray, Optional[List[Dict[str, float]]]]:
+        """调用BGE-m3编码查询文本"""
+        query_result = self.model.encode(
+            queries,
+            batch_size=len(queries),
             max_length=8192,
             return_dense=True,
-            return_sparse=False,
+            return_sparse=self.use_sparse,
             return_colbert_vecs=False
         )
         
-        # 处理BGE-m3的返回结果
-        if isinstance(embedding_result, dict) and 'dense_vecs' in embedding_result:
-            self.embeddings = np.array(embedding_result['dense_vecs'])
+        # 处理查询嵌入结果
+        if isinstance(query_result, dict) and 'dense_vecs' in query_result:
+            dense = np.atleast_2d(np.array(query_result['dense_vecs']))
         else:
-            # 如果直接返回向量数组
-            self.embeddings = np.array(embedding_result)
-        
-        embedding_time = time.time() - start_time
-        logger.info(f"Generated embeddings for {len(documents)} documents in {embedding_time:.2f}s")
-        
-    def search(self, query: str, top_k: int = 10) -> List[RetrievalResult]:
+            dense = np.atleast_2d(np.array(query_result))
+        sparse = self._parse_lexical_weights(query_result, len(queries)) if self.use_sparse else None
+        return dense, sparse
+
+    def search(self, query: str, top_k: int = 10,
+               collection: Optional[str] = None,
+               where: Optional[Dict[str, Any]] = None,
+               representations: Optional[QueryRepresentations] = None) -> List[RetrievalResult]:
         """
         检索相关文档
         
         Args:
             query: 查询文本
             top_k: 返回的文档数量
+            collection: 只在该集合中检索，为None时检索全部集合
+            where: 元数据过滤表达式，语法见MetadataIndex
+            representations: 可选的预先编码结果，见search_batch
             
         Returns:
             检索结果列表
         """
-        if not self.documents or self.embeddings is None:
+        logger.info(f"Searching for query: {query[:50]}...")
+        return self.search_batch([query], top_k, collection, where, representations)[0]
+
+    def search_batch(self, queries: List[str], top_k: int = 10,
+                     collection: Optional[str] = None,
+                     where: Optional[Dict[str, Any]] = None,
+                     representations: Optional[QueryRepresentations] = None) -> List[List[RetrievalResult]]:
+        """
+        批量检索：一次编码全部查询，一次矩阵乘法计算相似度，
+        并用argpartition选出top_k，适用于离线评测和批量问答
+
+        指定collection或where时，先由元数据位图索引求出候选行掩码再打分；
+        候选行足够少时只对这些行精确打分，不扫描全量索引。
+
+        Args:
+            queries: 查询文本列表
+            top_k: 每个查询返回的文档数量
+            collection: 只在该集合中检索，为None时检索全部集合
+            where: 元数据过滤表达式，语法见MetadataIndex
+            representations: 调用方已编码的查询（encode_queries的返回值），传入时不再调用编码器
+
+        Returns:
+            与queries一一对应的检索结果列表
+        """
+        with self._lock:
+            documents = self.documents
+            embeddings = self.embeddings
+            index = self.index
+            sparse_index = self.sparse_index
+            with metrics.span("prefilter"):
+                allowed = self._allowed_mask(collection, where)
+
+        if not documents or embeddings is None:
             logger.warning("No documents or embeddings available")
+            return [[] for _ in queries]
+        if not queries:
             return []
-            
-        logger.info(f"Searching for query: {query[:50]}...")
-        
+        # 过滤后没有候选行时无需编码查询
+        allowed_count = len(documents) if allowed is None else int(np.count_nonzero(allowed))
+        if allowed_count == 0:
+            logger.info("No chunks match the collection/metadata filter")
+            return [[] for _ in queries]
+
         # 对查询进行嵌入
         start_time = time.time()
-        query_result = self.model.encode(
-            [query],
-            batch_size=1,
-            max_length=8192,
-            return_dense=True,
-            return_sparse=False,
-            return_colbert_vecs=False
-        )
+        if representations is None:
+            representations = self.encode_queries(queries)
+        query_embeddings, query_lexical = representations
         
-        # 处理查询嵌入结果
-        if isinstance(query_result, dict) and 'dense_vecs' in query_result:
-            query_embedding = np.array(query_result['dense_vecs'][0])
-        elif isinstance(query_result, (list, np.ndarray)):
-            query_embedding = np.array(query_result[0])
+        # 通过向量索引检索top_k结果，逻辑删除的行不参与排序
+        if self.use_sparse:
+            # 先扫描稀疏倒排表；稠密路只需补足到top_k所需的候选数
+            with metrics.span("sparse_search"):
+                sparse_hits = sparse_index.search(query_lexical, top_k, allowed)
+            dense_top_k = top_k
+            if self.hybrid_dense_top_k:
+                shortfall = max(top_k - len(rows) for rows, _ in sparse_hits)
+                dense_top_k = min(top_k, max(self.hybrid_dense_top_k, shortfall))
+            dense_hits = self._dense_search(index, embeddings, query_embeddings, dense_top_k,
+                                            allowed, allowed_count)
+            with metrics.span("fusion"):
+                hits = [self._fuse_hits(embeddings, query_embeddings[i], dense_hits[i], sparse_hits[i], top_k)
+                        for i in range(len(queries))]
         else:
-            query_embedding = np.array(query_result)
-        
-        # 计算相似度
-        similarities = np.dot(self.embeddings, query_embedding)
-        
-        # 获取top_k结果
-        top_indices = np.argsort(similarities)[::-1][:top_k]
+            hits = self._dense_search(index, embeddings, query_embeddings, top_k, allowed, allowed_count)
         
         search_time = time.time() - start_time
-        logger.info(f"Search completed in {search_time:.3f}s")
+        logger.info(f"Search completed for {len(queries)} queries in {search_time:.3f}s")
         
-        results = []
-        for rank, idx in enumerate(top_indices):
-            result = RetrievalResult(
-                document=self.documents[idx],
-                score=float(similarities[idx]),
-                rank=rank + 1
-            )
-            results.append(result)
+        all_results = []
+        for top_indices, top_scores in hits:
+            results = []
+            for rank, (idx, score) in enumerate(zip(top_indices, top_scores)):
+                result = RetrievalResult(
+                    document=documents[idx],
+                    score=float(score),
+                    rank=rank + 1
+                )
+                results.append(result)
+            all_results.append(results)
             
-        return results
+        return all_results
+
+    def _dense_search(self, index: VectorIndex, embeddings: np.ndarray, query_embeddings: np.ndarray,
+                      top_k: int, allowed: Optional[np.ndarray], allowed_count: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """稠密检索：过滤后候选行占比较小时对候选行精确打分，否则带掩码检索向量索引"""
+        if allowed is not None and allowed_count <= self.prefilter_max_ratio * len(allowed):
+            with metrics.span("filtered_search"):
+                return search_rows(embeddings, query_embeddings, np.flatnonzero(allowed), top_k)
+        with metrics.span("ann_search", index=index.name):
+            return index.search(query_embeddings, top_k, allowed)
+
+    def _fuse_hits(self, embeddings: np.ndarray, query_embedding: np.ndarray,
+                   dense_hits: Tuple[np.ndarray, np.ndarray],
+                   sparse_hits: Tuple[np.ndarray, np.ndarray],
+                   top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        融合稠密与稀疏检索结果：score = dense_weight * dense + sparse_weight * sparse
+
+        候选集为两路结果的并集。仅由稀疏召回的行补算精确的稠密分数；
+        未出现在稀疏倒排表中的行与查询没有共享词项，稀疏分数为0。
+        """
+        dense_rows, dense_scores = dense_hits
+        sparse_rows, sparse_scores = sparse_hits
+        candidates = np.union1d(dense_rows, sparse_rows)
+        if candidates.size == 0:
+            return candidates, np.empty(0, dtype=np.float32)
+
+        dense_part = np.asarray(embeddings[candidates], dtype=np.float32) @ query_embedding.astype(np.float32)
+        sparse_part = np.zeros(candidates.size, dtype=np.float32)
+        sparse_part[np.searchsorted(candidates, sparse_rows)] = sparse_scores
+
+        fused = self.dense_weight * dense_part + self.sparse_weight * sparse_part
+        order = np.argsort(-fused, kind='stable')[:top_k]
+        return candidates[order], fused[order]
+
+    def evaluate_index(self, queries: List[str], top_k: int = 10) -> Dict[str, Any]:
+        """
+        以暴力检索为基准，评估当前向量索引的recall@k和延迟，用于调节nprobe/ef_search
+
+        Args:
+            queries: 评估用的查询文本
+            top_k: 评估的k值
+
+        Returns:
+            recall@k、精确检索与索引检索的平均延迟
+        """
+        with self._lock:
+            embeddings = self.embeddings
+            index = self.index
+            allowed = self._allowed_mask()
+
+        if embeddings is None:
+            raise ValueError("索引为空，请先加载文档")
+
+        report = evaluate_recall(index, embeddings, self._encode_queries(queries), top_k, allowed)
+        logger.info(f"Index evaluation: {report}")
+        return report
+
+class RerankScoreCache:
+    """
+    重排序分数缓存
+
+    以 (模型名, 归一化查询, 文档块文本) 的哈希为键缓存交叉编码器分数，
+    超出容量时按LRU淘汰。重复查询和翻页查询只需为未见过的文档对打分。
+    """
+
+    def __init__(self, model_name: str, capacity: int = 10000):
+        """
+        Args:
+            model_name: 重排序模型名称，作为缓存键的一部分
+            capacity: 最多缓存的文档对数量
+        """
+        self.model_name = model_name
+        self.capacity = capacity
+        self._scores: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, query: str, doc_text: str) -> str:
+        """计算文档对的缓存键"""
+        raw = f"{self.model_name}\x00{QueryEmbeddingCache.normalize(query)}\x00{doc_text}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[float]:
+        """查找分数，未命中返回None"""
+        with self._lock:
+            if key in self._scores:
+                self._scores.move_to_end(key)
+                self.hits += 1
+                return self._scores[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, score: float):
+        """写入分数"""
+        with self._lock:
+            self._scores[key] = score
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.capacity:
+                self._scores.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._scores)
+            }
 
 class BGEReranker:
     """基于BGE-reranker的重排序系统"""
     
-    def __init__(self, model_path: str = "BAAI/bge-reranker-v2-m3"):
+    def __init__(self, model_path: str = "BAAI/bge-reranker-v2-m3", score_cache_size: int = 10000,
+                 model_server: Optional[str] = None):
         """
         初始化BGE重排序器
         
         Args:
             model_path: BGE-reranker模型路径
+            score_cache_size: 文档对分数缓存容量，为0时关闭缓存
+            model_server: 可选的模型服务地址，设置后不在本进程加载模型
+
+        模型在首次打分时才加载（或连接模型服务）。
         """
-        logger.info(f"Loading BGE-reranker model: {model_path}")
+        self.model_path = model_path
+        self.model_server = model_server
+        self._reranker = None
+        self._model_lock = threading.Lock()
+        self.score_cache: Optional[RerankScoreCache] = None
+        if score_cache_size > 0:
+            self.score_cache = RerankScoreCache(model_path, score_cache_size)
+
+    @property
+    def reranker(self) -> Any:
+        """交叉编码器，首次访问时加载"""
+        return self.load_model()
+
+    def load_model(self) -> Any:
+        """加载模型（或连接模型服务），已加载时直接返回"""
+        if self._reranker is None:
+            with self._model_lock:
+                if self._reranker is None:
+                    self._reranker = self._load_model()
+        return self._reranker
+
+    def _load_model(self) -> Any:
+        if self.model_server:
+            with _startup_step("connect_model_server"):
+                client, health = connect_model_server(self.model_server)
+            if not health.get("reranker_path"):
+                raise ValueError(f"模型服务 {self.model_server} 未加载重排序模型")
+            if health.get("reranker_path") != self.model_path:
+                logger.warning(f"Model server serves {health.get('reranker_path')}, "
+                               f"but {self.model_path} was requested")
+            return RemoteReranker(client)
+
+        model_class = _require("FlagEmbedding").FlagReranker
+        logger.info(f"Loading BGE-reranker model: {self.model_path}")
         try:
-            self.reranker = FlagReranker(model_path, use_fp16=True)
+            with _startup_step(f"load_model:{self.model_path}"):
+                reranker = model_class(self.model_path, use_fp16=True)
             logger.info("BGE-reranker model loaded successfully")
+            return reranker
         except Exception as e:
             logger.error(f"Failed to load BGE-reranker model: {e}")
             raise
+
+    def warmup(self, sample_pair: Tuple[str, str] = ("warmup", "warmup")) -> None:
+        """加载模型并为一个样例文档对打分"""
+        self.load_model()
+        with _startup_step("warmup:rerank"):
+            self._compute_scores([list(sample_pair)])
+
+    def _score_pairs(self, sentence_pairs: List[List[str]]) -> List[float]:
+        """为文档对打分，只把缓存未命中的文档对送入交叉编码器"""
+        if self.score_cache is None:
+            return self._compute_scores(sentence_pairs)
+
+        keys = [self.score_cache.key(query, doc_text) for query, doc_text in sentence_pairs]
+        scores: List[Optional[float]] = [self.score_cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            computed = self._compute_scores([sentence_pairs[i] for i in missing])
+            for i, score in zip(missing, computed):
+                self.score_cache.put(keys[i], score)
+                scores[i] = score
+        logger.info(f"Rerank cache: {len(sentence_pairs) - len(missing)} hits, {len(missing)} misses")
+        return scores
+
+    def _compute_scores(self, sentence_pairs: List[List[str]]) -> List[float]:
+        """调用交叉编码器打分"""
+        scores = self.reranker.compute_score(sentence_pairs, batch_size=8)
+        # 只有一个文档对时FlagReranker返回标量
+        if not isinstance(scores, (list, tuple, np.ndarray)):
+            scores = [scores]
+        return [float(score) for score in scores]
     
-    def rerank(self, query: str, results: List[RetrievalResult], top_k: int = 5) -> List[RetrievalResult]:
-        """
-        重排序检索结果
-        
-        Args:
-            query: 查询文本
-            results: 初始检索结果
-            top_k: 返回的重排后结果数量
-            
-        Returns:
-            重排后的结果列表
-        """
-        if not results:
-            return []
-            
-        logger.info(f"Reranking {len(results)} results...")
-        
-        # 准备输入对
+    @staticmethod
+    def _build_pairs(query: str, results: List[RetrievalResult]) -> List[List[str]]:
+        """准备 (查询, 文档文本) 输入对"""
         sentence_pairs = []
         for result in results:
             # 对于切片后的文档，使用块内容进行重排序
@@ -244,14 +1257,11 @@ class BGEReranker:
             if result.document.chunk_id:
                 doc_text = f"{result.document.title} (块 {result.document.chunk_index})\n\n{result.document.content}"
             sentence_pairs.append([query, doc_text])
-        
-        # 进行重排序
-        start_time = time.time()
-        scores = self.reranker.compute_score(sentence_pairs, batch_size=8)
-        rerank_time = time.time() - start_time
-        
-        logger.info(f"Reranking completed in {rerank_time:.3f}s")
-        
+        return sentence_pairs
+
+    @staticmethod
+    def _rank_results(results: List[RetrievalResult], scores: List[float], top_k: int) -> List[RetrievalResult]:
+        """按重排序分数排序并截取top_k"""
         # 创建新的结果列表
         reranked_results = []
         for i, score in enumerate(scores):
@@ -271,45 +1281,292 @@ class BGEReranker:
             result.rank = i + 1
             
         return reranked_results[:top_k]
+    
+    def rerank(self, query: str, results: List[RetrievalResult], top_k: int = 5) -> List[RetrievalResult]:
+        """
+        重排序检索结果
+        
+        Args:
+            query: 查询文本
+            results: 初始检索结果
+            top_k: 返回的重排后结果数量
+            
+        Returns:
+            重排后的结果列表
+        """
+        if not results:
+            return []
+            
+        logger.info(f"Reranking {len(results)} results...")
+        
+        # 进行重排序
+        start_time = time.time()
+        with metrics.span("rerank"):
+            scores = self._score_pairs(self._build_pairs(query, results))
+        metrics.inc("rag_rerank_pairs_total", len(results))
+        rerank_time = time.time() - start_time
+        
+        logger.info(f"Reranking completed in {rerank_time:.3f}s")
+        return self._rank_results(results, scores, top_k)
+
+    def rerank_batch(self, queries: List[str], results_list: List[List[RetrievalResult]],
+                     top_k: int = 5) -> List[List[RetrievalResult]]:
+        """
+        批量重排序：把多个查询的全部文档对合并成一次交叉编码器调用
+
+        Args:
+            queries: 查询文本列表
+            results_list: 与queries一一对应的初始检索结果
+            top_k: 每个查询返回的重排后结果数量
+
+        Returns:
+            与queries一一对应的重排后结果列表
+        """
+        sentence_pairs = []
+        for query, results in zip(queries, results_list):
+            sentence_pairs.extend(self._build_pairs(query, results))
+        if not sentence_pairs:
+            return [[] for _ in queries]
+
+        logger.info(f"Reranking {len(sentence_pairs)} pairs for {len(queries)} queries...")
+        start_time = time.time()
+        with metrics.span("rerank"):
+            scores = self._score_pairs(sentence_pairs)
+        metrics.inc("rag_rerank_pairs_total", len(sentence_pairs))
+        logger.info(f"Batch reranking completed in {time.time() - start_time:.3f}s")
+
+        reranked, offset = [], 0
+        for results in results_list:
+            reranked.append(self._rank_results(results, scores[offset:offset + len(results)], top_k))
+            offset += len(results)
+        return reranked
+
+class SemanticAnswerCache:
+    """
+    语义答案缓存
+
+    以问题的稠密向量为键，在一个小型暴力内积索引中查找相似度超过阈值的历史问题，
+    命中时直接返回其答案和参考来源，跳过检索、重排序和LLM调用。
+    条目在ttl_seconds后过期；语料变化时整体失效。容量满后按写入顺序覆盖最旧条目。
+    """
+
+    def __init__(self, capacity: int = 1024, threshold: float = 0.95, ttl_seconds: float = 3600.0):
+        """
+        Args:
+            capacity: 最多缓存的问答数量
+            threshold: 命中所需的最小余弦相似度
+            ttl_seconds: 条目有效期（秒）
+        """
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self._vectors: Optional[np.ndarray] = None  # (capacity, dim) 环形缓冲区
+        self._entries: List[Optional[Dict[str, Any]]] = [None] * capacity
+        self._expires_at = np.zeros(capacity, dtype=np.float64)  # 0 表示空槽
+        self._next_slot = 0
+        self._lock = threading.Lock()
+        # 每次失效递增；查询开始时记录的代数与写入时不一致，说明期间语料已变化
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, embedding: np.ndarray, params: Tuple) -> Optional[Dict[str, Any]]:
+        """
+        查找语义相近的历史问题
+
+        Args:
+            embedding: 归一化的问题向量
+            params: 影响答案的查询参数（如top_k），只在参数相同的条目中查找
+
+        Returns:
+            命中时返回 {"question", "result", "similarity"}，否则返回None
+        """
+        with self._lock:
+            if self._vectors is not None:
+                live = self._expires_at > time.time()
+                if live.any():
+                    scores = self._vectors @ embedding.astype(self._vectors.dtype)
+                    scores[~live] = -np.inf
+                    for slot in np.argsort(-scores):
+                        if scores[slot] < self.threshold:
+                            break
+                        entry = self._entries[slot]
+                        if entry["params"] == params:
+                            self.hits += 1
+                            return {"question": entry["question"], "result": entry["result"],
+                                    "similarity": float(scores[slot])}
+            self.misses += 1
+            return None
+
+    def put(self, question: str, embedding: np.ndarray, params: Tuple, result: Dict[str, Any],
+            generation: Optional[int] = None):
+        """
+        写入问答结果
+
+        Args:
+            generation: 查询开始时的缓存代数；与当前代数不一致时丢弃该结果
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if self._vectors is None:
+                self._vectors = np.zeros((self.capacity, embedding.shape[0]), dtype=np.float32)
+            slot = self._next_slot
+            self._next_slot = (slot + 1) % self.capacity
+            self._vectors[slot] = embedding
+            self._entries[slot] = {"question": question, "params": params, "result": result}
+            self._expires_at[slot] = time.time() + self.ttl_seconds
+
+    def invalidate(self):
+        """语料变化后清空全部条目"""
+        with self._lock:
+            self._entries = [None] * self.capacity
+            self._expires_at[:] = 0.0
+            self._next_slot = 0
+            self.generation += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": int((self._expires_at > time.time()).sum())
+            }
 
 class LLMGenerator:
     """基于DashScope的答案生成器"""
     
-    def __init__(self, api_key: Optional[str] = None, model: str = "qwen-max"):
+    def __init__(self, api_key: Optional[str] = None, model: str = "qwen-max",
+                 context_token_budget: Optional[int] = 3000,
+                 token_counter: Optional[Callable[[str], int]] = None):
         """
         初始化LLM生成器
         
         Args:
             api_key: DashScope API密钥
             model: 模型名称
+            context_token_budget: 参考资料的token预算，为None时不限制
+            token_counter: 可选的token计数函数，默认按中文字符和其他字符分别估算
         """
         self.api_key = api_key or os.getenv('DASHSCOPE_API_KEY')
         self.model = model
+        self.context_token_budget = context_token_budget
+        self.count_tokens = token_counter or self.estimate_tokens
         
         if not self.api_key:
             raise ValueError("请设置DASHSCOPE_API_KEY环境变量或传入api_key参数")
             
-        dashscope.api_key = self.api_key
         logger.info(f"LLM Generator initialized with model: {model}")
     
-    def generate_answer(self, query: str, contexts: List[RetrievalResult]) -> Dict[str, Any]:
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """粗略估算token数：CJK字符约1个token，其他字符约4个合为1个token"""
+        cjk = sum(1 for ch in text if '\u3000' <= ch <= '\u9fff' or '\uff00' <= ch <= '\uffef')
+        return cjk + math.ceil((len(text) - cjk) / 4)
+
+    @staticmethod
+    def _overlap_length(left: str, right: str, min_overlap: int = 10) -> int:
+        """left末尾与right开头重合的最大长度（切片器的块间重叠），过短的巧合重合不计"""
+        for length in range(min(len(left), len(right), CHUNK_OVERLAP), min_overlap - 1, -1):
+            if left.endswith(right[:length]):
+                return length
+        return 0
+
+    def _merge_adjacent(self, group: List[RetrievalResult]) -> List[RetrievalResult]:
+        """合并同一父文档中序号相邻的块，并去掉块间重叠的文本"""
+        group = sorted(group, key=lambda r: r.document.chunk_index)
+        merged: List[RetrievalResult] = []
+        ranges: List[Tuple[int, int]] = []
+        for result in group:
+            doc = result.document
+            if merged and doc.chunk_index == ranges[-1][1] + 1:
+                last = merged[-1]
+                overlap = self._overlap_length(last.document.content, doc.content)
+                separator = "" if overlap else "\n"
+                ranges[-1] = (ranges[-1][0], doc.chunk_index)
+                last.document = Document(
+                    id=last.document.id,
+                    title=last.document.title,
+                    content=last.document.content + separator + doc.content[overlap:],
+                    metadata={**(last.document.metadata or {}), "chunk_range": ranges[-1]},
+                    chunk_id=last.document.chunk_id,
+                    parent_id=last.document.parent_id,
+                    chunk_index=ranges[-1][0],
+                    collection=last.document.collection
+                )
+                last.score = max(last.score, result.score)
+                continue
+            merged.append(RetrievalResult(document=doc, score=result.score, rank=result.rank))
+            ranges.append((doc.chunk_index, doc.chunk_index))
+        return merged
+
+    def _pack_contexts(self, contexts: List[RetrievalResult]) -> Tuple[List[RetrievalResult], Dict[str, Any]]:
         """
-        基于检索上下文生成答案
-        
-        Args:
-            query: 用户查询
-            contexts: 重排后的上下文文档
-            
+        在token预算内打包参考资料
+
+        1. 去掉内容完全相同的块
+        2. 合并同一父文档中相邻的块，去掉切片器留下的重叠文本
+        3. 按重排序分数从高到低装入，直到达到token预算；
+           放不下的块跳过，继续尝试更短的块
+
         Returns:
-            生成结果包含答案和元数据
+            (打包后的上下文, 打包统计)
         """
-        if not contexts:
-            return {
-                "answer": "抱歉，我没有找到相关的信息来回答您的问题。",
-                "sources": [],
-                "confidence": 0.0
-            }
-        
+        seen_contents = set()
+        groups: Dict[str, List[RetrievalResult]] = {}
+        singles: List[RetrievalResult] = []
+        for result in contexts:
+            doc = result.document
+            if doc.content in seen_contents:
+                continue
+            seen_contents.add(doc.content)
+            if doc.parent_id is not None and doc.chunk_index is not None:
+                groups.setdefault((doc.collection, doc.parent_id), []).append(result)
+            else:
+                singles.append(RetrievalResult(document=doc, score=result.score, rank=result.rank))
+
+        units = singles + [unit for group in groups.values() for unit in self._merge_adjacent(group)]
+        units.sort(key=lambda r: r.score, reverse=True)
+
+        tokens_in = sum(self.count_tokens(r.document.content) for r in contexts)
+        packed: List[RetrievalResult] = []
+        used_tokens = 0
+        dropped = 0
+        for unit in units:
+            unit_tokens = self.count_tokens(unit.document.content)
+            if self.context_token_budget is not None and used_tokens + unit_tokens > self.context_token_budget:
+                # 分数最高的资料单独就超出预算时按比例截断，保证至少有一条上下文
+                if packed:
+                    dropped += 1
+                    continue
+                content = unit.document.content
+                while unit_tokens > self.context_token_budget and content:
+                    content = content[:int(len(content) * self.context_token_budget / unit_tokens)]
+                    unit_tokens = self.count_tokens(content)
+                unit.document = Document(**{**asdict(unit.document), "content": content})
+            packed.append(unit)
+            used_tokens += unit_tokens
+
+        for i, result in enumerate(packed):
+            result.rank = i + 1
+
+        stats = {
+            "chunks_in": len(contexts),
+            "contexts_packed": len(packed),
+            "dropped": dropped,
+            "tokens_in": tokens_in,
+            "tokens_packed": used_tokens,
+            "token_budget": self.context_token_budget
+        }
+        logger.info(f"Packed {len(contexts)} chunks into {len(packed)} contexts "
+                    f"({tokens_in} -> {used_tokens} estimated tokens)")
+        return packed, stats
+
+    def _build_prompt(self, query: str, contexts: List[RetrievalResult]) -> Tuple[str, List[Dict[str, Any]]]:
+        """构建提示词，返回 (提示词, 参考来源列表)"""
         # 构建上下文文本
         context_texts = []
         sources = []
@@ -319,7 +1576,10 @@ class LLMGenerator:
             
             # 构建参考资料信息，包含块信息
             title_info = doc.title
-            if doc.chunk_id and doc.chunk_index is not None:
+            chunk_range = (doc.metadata or {}).get("chunk_range")
+            if chunk_range:
+                title_info = f"{doc.title} (第{chunk_range[0] + 1}-{chunk_range[1] + 1}块)"
+            elif doc.chunk_id and doc.chunk_index is not None:
                 title_info = f"{doc.title} (第{doc.chunk_index + 1}块)"
             
             context_texts.append(
@@ -354,19 +1614,81 @@ class LLMGenerator:
 5. 使用简洁明了的语言
 
 回答："""
+        return prompt, sources
+
+    @staticmethod
+    def _estimate_confidence(contexts: List[RetrievalResult]) -> float:
+        """评估置信度（基于上下文相关性）"""
+        avg_score = sum(r.score for r in contexts) / len(contexts)
+        return min(avg_score * 0.8, 0.95)  # 归一化到合理范围
+
+    @staticmethod
+    def _record_usage(response: Any) -> Dict[str, int]:
+        """从DashScope响应中读取token用量并计入指标"""
+        usage = getattr(response, 'usage', None) or {}
+        tokens = {
+            "input_tokens": int(usage.get('input_tokens', 0) or 0),
+            "output_tokens": int(usage.get('output_tokens', 0) or 0)
+        }
+        metrics.inc("rag_llm_tokens_total", tokens["input_tokens"], direction="in")
+        metrics.inc("rag_llm_tokens_total", tokens["output_tokens"], direction="out")
+        return tokens
+
+    def _call_params(self) -> Dict[str, Any]:
+        """DashScope生成参数"""
+        return {
+            "api_key": self.api_key,
+            "model": self.model,
+            "max_tokens": 2000,
+            "temperature": 0.3,
+            "top_p": 0.8,
+            "repetition_penalty": 1.05
+        }
+
+    @staticmethod
+    def _generation() -> Any:
+        """DashScope生成接口，首次调用LLM时才导入dashscope"""
+        return _require("dashscope").Generation
+
+    def prepare_prompt(self, query: str, contexts: List[RetrievalResult]
+                       ) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        打包上下文并构建提示词
+
+        Returns:
+            (提示词, 参考来源, 打包统计)；可传给generate_answer_stream的prepared参数，避免重复打包
+        """
+        with metrics.span("prompt_build"):
+            packed, packing = self._pack_contexts(contexts)
+            prompt, sources = self._build_prompt(query, packed)
+        return prompt, sources, packing
+
+    def generate_answer(self, query: str, contexts: List[RetrievalResult]) -> Dict[str, Any]:
+        """
+        基于检索上下文生成答案
+        
+        Args:
+            query: 用户查询
+            contexts: 重排后的上下文文档
+            
+        Returns:
+            生成结果包含答案和元数据；LLM调用失败时另含 error 字段（错误信息）
+        """
+        if not contexts:
+            return {
+                "answer": "抱歉，我没有找到相关的信息来回答您的问题。",
+                "sources": [],
+                "confidence": 0.0
+            }
+        
+        prompt, sources, packing = self.prepare_prompt(query, contexts)
 
         logger.info("Generating answer with LLM...")
         start_time = time.time()
         
         try:
-            response = Generation.call(
-                model=self.model,
-                prompt=prompt,
-                max_tokens=2000,
-                temperature=0.3,
-                top_p=0.8,
-                repetition_penalty=1.05
-            )
+            with metrics.span("llm_call", model=self.model):
+                response = self._generation().call(prompt=prompt, **self._call_params())
             
             generation_time = time.time() - start_time
             logger.info(f"Answer generated in {generation_time:.2f}s")
@@ -375,16 +1697,14 @@ class LLMGenerator:
             if hasattr(response, 'status_code') and response.status_code == 200:
                 answer = response.output.text.strip()
                 
-                # 评估置信度（基于上下文相关性）
-                avg_score = sum(r.score for r in contexts) / len(contexts)
-                confidence = min(avg_score * 0.8, 0.95)  # 归一化到合理范围
-                
                 return {
                     "answer": answer,
                     "sources": sources,
-                    "confidence": confidence,
+                    "confidence": self._estimate_confidence(contexts),
                     "generation_time": generation_time,
-                    "context_count": len(contexts)
+                    "context_count": len(contexts),
+                    "usage": self._record_usage(response),
+                    "packing": packing
                 }
             else:
                 error_msg = getattr(response, 'message', 'Unknown error')
@@ -392,7 +1712,8 @@ class LLMGenerator:
                 return {
                     "answer": "抱歉，生成答案时出现错误，请稍后重试。",
                     "sources": sources,
-                    "confidence": 0.0
+                    "confidence": 0.0,
+                    "error": error_msg
                 }
                 
         except Exception as e:
@@ -400,8 +1721,94 @@ class LLMGenerator:
             return {
                 "answer": "抱歉，生成答案时出现错误，请稍后重试。",
                 "sources": sources,
-                "confidence": 0.0
+                "confidence": 0.0,
+                "error": str(e)
+            }
+
+    def generate_answer_stream(self, query: str, contexts: List[RetrievalResult],
+                               prepared: Optional[Tuple[str, List[Dict[str, Any]], Dict[str, Any]]] = None
+                               ) -> Iterator[Dict[str, Any]]:
+        """
+        流式生成答案，边生成边产出增量文本
+
+        Args:
+            query: 用户查询
+            contexts: 重排后的上下文文档
+            prepared: 可选的prepare_prompt()结果，调用方已打包上下文时传入
+
+        Yields:
+            {"type": "token", "text": 增量文本}，最后产出一个
+            {"type": "done", ...} 事件，字段与generate_answer的返回值相同，
+            另含首个token耗时 first_token_time
+        """
+        if not contexts:
+            yield {"type": "done", **self.generate_answer(query, contexts)}
+            return
+
+        prompt, sources, packing = prepared or self.prepare_prompt(query, contexts)
+
+        logger.info("Streaming answer with LLM...")
+        start_time = time.time()
+        first_token_time = None
+        answer_parts = []
+        last_response = None
+
+        try:
+            responses = self._generation().call(prompt=prompt, stream=True, incremental_output=True,
+                                                **self._call_params())
+            for response in responses:
+                last_response = response
+                if getattr(response, 'status_code', None) != 200:
+                    error_msg = getattr(response, 'message', 'Unknown error')
+                    logger.error(f"LLM streaming failed: {error_msg}")
+                    yield {
+                        "type": "done",
+                        "answer": "".join(answer_parts) or "抱歉，生成答案时出现错误，请稍后重试。",
+                        "sources": sources,
+                        "confidence": 0.0,
+                        "error": error_msg
+                    }
+                    return
+
+                text = response.output.text or ""
+                if not text:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.time() - start_time
+                    metrics.observe(STAGE_DURATION, first_token_time, stage="llm_first_token", model=self.model)
+                    logger.info(f"First token received in {first_token_time:.2f}s")
+                answer_parts.append(text)
+                yield {"type": "token", "text": text}
+
+        except Exception as e:
+            logger.error(f"LLM streaming error: {e}")
+            yield {
+                "type": "done",
+                "answer": "".join(answer_parts) or "抱歉，生成答案时出现错误，请稍后重试。",
+                "sources": sources,
+                "confidence": 0.0,
+                "error": str(e)
             }
+            return
+
+        generation_time = time.time() - start_time
+        metrics.observe(STAGE_DURATION, generation_time, stage="llm_call", model=self.model)
+        trace = current_trace()
+        if trace is not None:
+            trace.add("llm_call", time.perf_counter() - generation_time, generation_time)
+        logger.info(f"Answer streamed in {generation_time:.2f}s")
+        yield {
+            "type": "done",
+            "answer": "".join(answer_parts).strip(),
+            "sources": sources,
+            "confidence": self._estimate_confidence(contexts),
+            "generation_time": generation_time,
+            "first_token_time": first_token_time or generation_time,
+            "context_count": len(contexts),
+            # 增量输出模式下最后一个响应携带完整的token用量
+            "usage": self._record_usage(last_response),
+            "packing": packing
+        }
 
 class RAGPipeline:
     """完整的RAG流水线"""
@@ -409,7 +1816,18 @@ class RAGPipeline:
     def __init__(self, 
                  retrieval_model: str = "BAAI/bge-m3",
                  reranker_model: str = "BAAI/bge-reranker-v2-m3",
-                 llm_model: str = "qwen-max"):
+                 llm_model: str = "qwen-max",
+                 query_cache_size: int = 1024,
+                 query_cache_dir: Optional[str] = None,
+                 rerank_cache_size: int = 10000,
+                 retrieval_mode: str = "dense",
+                 answer_cache_size: int = 0,
+                 answer_cache_threshold: float = 0.95,
+                 answer_cache_ttl: float = 3600.0,
+                 context_token_budget: Optional[int] = 3000,
+                 adaptive_rerank: Optional[AdaptiveRerankConfig] = None,
+                 model_server: Optional[str] = None,
+                 warmup: bool = False):
         """
         初始化RAG流水线
         
@@ -417,23 +1835,317 @@ class RAGPipeline:
             retrieval_model: 检索模型路径
             reranker_model: 重排序模型路径
             llm_model: LLM模型名称
+            query_cache_size: 查询向量LRU缓存容量，为0时关闭缓存
+            query_cache_dir: 可选的查询向量磁盘缓存目录
+            rerank_cache_size: 重排序分数缓存容量，为0时关闭缓存
+            retrieval_mode: "dense" 或 "hybrid"（稠密 + BGE-m3稀疏词项权重）
+            answer_cache_size: 语义答案缓存容量，为0时关闭缓存
+            answer_cache_threshold: 语义答案缓存命中所需的最小问题相似度
+            answer_cache_ttl: 语义答案缓存条目有效期（秒）
+            context_token_budget: 提示词中参考资料的token预算，为None时不限制
+            adaptive_rerank: 自适应重排序深度配置，为None时总是重排全部检索结果
+            model_server: 可选的模型服务地址；多个worker进程共享服务中的一份BGE-m3和重排序模型
+            warmup: 是否在构造时立即加载并预热模型；默认在首次使用时加载，构造本身几乎不耗时
         """
         logger.info("Initializing RAG Pipeline...")
+        start_time = time.perf_counter()
         
-        self.retrieval_system = BGERetrievalSystem(retrieval_model)
-        self.reranker = BGEReranker(reranker_model)
-        self.llm_generator = LLMGenerator(model=llm_model)
+        self.retrieval_system = BGERetrievalSystem(retrieval_model,
+                                                   query_cache_size=query_cache_size,
+                                                   query_cache_dir=query_cache_dir,
+                                                   retrieval_mode=retrieval_mode,
+                                                   model_server=model_server)
+        self.reranker = BGEReranker(reranker_model, score_cache_size=rerank_cache_size,
+                                    model_server=model_server)
+        self.llm_generator = LLMGenerator(model=llm_model, context_token_budget=context_token_budget)
+        self.adaptive_rerank = adaptive_rerank
+        self.answer_cache: Optional[SemanticAnswerCache] = None
+        if answer_cache_size > 0:
+            self.answer_cache = SemanticAnswerCache(answer_cache_size, answer_cache_threshold, answer_cache_ttl)
+        self.init_time = time.perf_counter() - start_time
+        if warmup:
+            self.warmup()
         
-        logger.info("RAG Pipeline initialized successfully")
+        logger.info(f"RAG Pipeline initialized in {self.init_time * 1000:.1f}ms")
+
+    def warmup(self, sample_query: str = "warmup") -> Dict[str, Any]:
+        """
+        预热钩子：加载检索和重排序模型并各执行一次推理，不调用LLM
+
+        适合在服务开始接收流量前调用，使首个请求的延迟与稳态一致。
+
+        Returns:
+            启动耗时报告，见startup_report()
+        """
+        start_time = time.perf_counter()
+        self.retrieval_system.warmup(sample_query)
+        self.reranker.warmup((sample_query, sample_query))
+        logger.info(f"Warm-up finished in {time.perf_counter() - start_time:.2f}s")
+        return self.startup_report()
+
+    def startup_report(self) -> Dict[str, Any]:
+        """
+        启动耗时报告
+
+        Returns:
+            init_time: 构造流水线本身的耗时（秒）
+            steps: 本进程中依赖导入、模型加载、预热各步骤的累计耗时（秒）
+            models_loaded: 检索和重排序模型是否已加载
+        """
+        return {
+            "init_time": self.init_time,
+            "steps": startup_report(),
+            "models_loaded": {
+                "retrieval": self.retrieval_system._model is not None,
+                "rerank": self.reranker._reranker is not None
+            }
+        }
     
-    def load_documents(self, documents: List[Document]):
-        """加载文档到检索系统"""
-        self.retrieval_system.add_documents(documents)
+    def load_documents(self, documents: List[Document], index_dir: Optional[str] = None):
+        """
+        加载文档到检索系统
+
+        Args:
+            documents: 待加载的文档
+            index_dir: 可选的持久化索引目录；目录中已有索引时直接加载，
+                       否则嵌入文档后写入该目录，供下次启动复用
+        """
+        if index_dir and (Path(index_dir) / "meta.json").exists():
+            self.retrieval_system.load_index(index_dir)
+        else:
+            self.retrieval_system.add_documents(documents)
+            if index_dir:
+                self.retrieval_system.save_index(index_dir)
+        # 语料变化后，缓存的答案可能引用已不存在或过时的内容
+        self._invalidate_answer_cache()
+
+    def upsert_documents(self, documents: List[Document]) -> Dict[str, int]:
+        """增量添加或更新文档，仅编码内容变化的块"""
+        stats = self.retrieval_system.upsert_documents(documents)
+        if stats["encoded"] or stats["deleted"]:
+            self._invalidate_answer_cache()
+        return stats
+
+    def delete_documents(self, parent_ids: List[str], collection: str = DEFAULT_COLLECTION) -> int:
+        """按父文档ID删除指定集合中的文档"""
+        deleted = self.retrieval_system.delete_documents(parent_ids, collection)
+        if deleted:
+            self._invalidate_answer_cache()
+        return deleted
+
+    def delete_collection(self, collection: str) -> int:
+        """删除整个集合"""
+        deleted = self.retrieval_system.delete_collection(collection)
+        if deleted:
+            self._invalidate_answer_cache()
+        return deleted
+
+    def _invalidate_answer_cache(self):
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate()
+
+    def _encode_question(self, question: str) -> Optional[QueryRepresentations]:
+        """
+        开启答案缓存时预先编码问题，同一份编码供缓存查找和检索共用；
+        未开启时返回None，由检索阶段自行编码
+        """
+        if self.answer_cache is None:
+            return None
+        return self.retrieval_system.encode_queries([question])
+
+    def _lookup_answer_cache(self, question: str, params: Tuple,
+                             representations: Optional[QueryRepresentations]
+                             ) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """
+        用_encode_question的编码结果在语义答案缓存中查找，返回 (写回缓存所需的键, 命中条目)
+        """
+        if self.answer_cache is None or representations is None:
+            return None, None
+        with metrics.span("answer_cache_lookup"):
+            cache_key = {
+                "embedding": representations[0][0],
+                "params": params,
+                "generation": self.answer_cache.generation
+            }
+            return cache_key, self.answer_cache.get(cache_key["embedding"], params)
+
+    def _cached_result(self, question: str, hit: Dict[str, Any], total_start_time: float) -> Dict[str, Any]:
+        """由语义缓存条目构造查询结果"""
+        cached = hit["result"]
+        pipeline_stats = {
+            "retrieval_count": 0,
+            "rerank_count": 0,
+            "total_time": time.time() - total_start_time,
+            "generation_time": 0.0,
+            "query_embedding_cache": self._query_cache_stats(),
+            "answer_cache": {
+                "hit": True,
+                "similarity": hit["similarity"],
+                "matched_question": hit["question"],
+                **self.answer_cache.stats()
+            }
+        }
+        trace = current_trace()
+        if trace is not None:
+            pipeline_stats["spans"] = trace.summary()
+        logger.info(f"Semantic answer cache hit (similarity {hit['similarity']:.3f}): {hit['question'][:50]}")
+        return {
+            "question": question,
+            "answer": cached["answer"],
+            "sources": cached["sources"],
+            "confidence": cached["confidence"],
+            "pipeline_stats": pipeline_stats
+        }
+
+    def _store_answer(self, question: str, cache_key: Optional[Dict[str, Any]], result: Dict[str, Any]):
+        """把成功生成的答案写入语义缓存；带error字段的失败结果不缓存"""
+        if cache_key is None or "error" in result:
+            return
+        self.answer_cache.put(question, cache_key["embedding"], cache_key["params"], {
+            "answer": result["answer"],
+            "sources": result["sources"],
+            "confidence": result["confidence"]
+        }, cache_key["generation"])
     
+    def export_metrics(self, fmt: str = "prometheus") -> Any:
+        """
+        导出进程内的阶段耗时直方图和计数器
+
+        Args:
+            fmt: "prometheus"（文本格式）或 "json"（字典）
+        """
+        if fmt == "json":
+            return metrics.export_json()
+        if fmt != "prometheus":
+            raise ValueError(f"不支持的指标格式: {fmt}")
+        return metrics.export_prometheus()
+
+    def _query_cache_stats(self) -> Dict[str, Any]:
+        """查询向量缓存的累计命中统计"""
+        cache = self.retrieval_system.query_cache
+        return cache.stats() if cache else {}
+
+    def _plan_rerank(self, retrieval_results: List[RetrievalResult],
+                     rerank_top_k: int) -> Tuple[int, Optional[Dict[str, Any]]]:
+        """
+        根据检索分数分布决定重排序深度
+
+        第一名与第二名分差足够大时认为答案明确，跳过重排（深度为0）；
+        否则按softmax分布的归一化熵在 [min_depth, max_depth] 之间插值：
+        分数越平坦，越需要交叉编码器来区分，重排的候选越多。
+
+        Returns:
+            (重排深度, 决策信息)；未开启自适应模式时返回 (全部候选数, None)
+        """
+        n = len(retrieval_results)
+        config = self.adaptive_rerank
+        if config is None:
+            return n, None
+
+        scores = np.array([r.score for r in retrieval_results], dtype=np.float64)
+        gap = float(scores[0] - scores[1]) if n > 1 else float('inf')
+        entropy = 0.0
+        if n > 1:
+            logits = (scores - scores.max()) / config.temperature
+            probs = np.exp(logits) / np.exp(logits).sum()
+            entropy = float(-(probs * np.log(np.maximum(probs, 1e-12))).sum() / np.log(n))
+
+        min_depth = min(n, max(config.min_depth, rerank_top_k))
+        max_depth = max(min_depth, min(n, config.max_depth or n))
+        if gap >= config.skip_gap:
+            depth = 0
+        else:
+            depth = min(max_depth, min_depth + math.ceil((max_depth - min_depth) * entropy))
+
+        metrics.inc("rag_rerank_pairs_saved_total", n - depth)
+        return depth, {
+            "candidates": n,
+            "depth": depth,
+            "skipped": depth == 0,
+            "score_gap": gap if n > 1 else None,
+            "entropy": entropy,
+            "pairs_saved": n - depth,
+            "saved_ratio": (n - depth) / n
+        }
+
+    @staticmethod
+    def _take_retrieval_order(retrieval_results: List[RetrievalResult], top_k: int) -> List[RetrievalResult]:
+        """跳过重排时直接沿用检索排序"""
+        return [RetrievalResult(document=r.document, score=r.score, rank=i + 1)
+                for i, r in enumerate(retrieval_results[:top_k])]
+
+    @staticmethod
+    def _cache_params(retrieval_top_k: int, rerank_top_k: int, collection: Optional[str],
+                      where: Optional[Dict[str, Any]]) -> Tuple:
+        """影响答案的查询参数；不同集合和过滤条件的答案互不复用"""
+        return (retrieval_top_k, rerank_top_k, collection, MetadataIndex.canonical(where))
+
+    def _retrieve_and_rerank(self, question: str, retrieval_top_k: int, rerank_top_k: int,
+                             collection: Optional[str] = None, where: Optional[Dict[str, Any]] = None,
+                             representations: Optional[QueryRepresentations] = None
+                             ) -> Tuple[List[RetrievalResult], List[RetrievalResult], Optional[Dict[str, Any]]]:
+        """执行检索和重排序两个阶段，返回 (检索结果, 重排结果, 自适应重排决策)"""
+        # 步骤1: BGE-m3检索
+        logger.info("Step 1: BGE-m3 Retrieval...")
+        retrieval_results = self.retrieval_system.search(question, retrieval_top_k, collection, where,
+                                                         representations)
+        if not retrieval_results:
+            return [], [], None
+        
+        logger.info(f"Retrieved {len(retrieval_results)} documents")
+        
+        # 步骤2: BGE-reranker重排序
+        depth, rerank_plan = self._plan_rerank(retrieval_results, rerank_top_k)
+        if depth == 0:
+            logger.info("Step 2: Skipping rerank, retrieval scores show a clear winner")
+            return retrieval_results, self._take_retrieval_order(retrieval_results, rerank_top_k), rerank_plan
+
+        logger.info(f"Step 2: BGE-reranker Reranking top {depth} of {len(retrieval_results)}...")
+        reranked_results = self.reranker.rerank(question, retrieval_results[:depth], rerank_top_k)
+        logger.info(f"Reranked to top {len(reranked_results)} documents")
+        return retrieval_results, reranked_results, rerank_plan
+
+    def _empty_result(self, question: str, total_start_time: float) -> Dict[str, Any]:
+        """没有检索到任何文档时的返回结果"""
+        return {
+            "question": question,
+            "answer": "抱歉，没有找到相关文档。",
+            "sources": [],
+            "confidence": 0.0,
+            "pipeline_stats": {
+                "retrieval_count": 0,
+                "rerank_count": 0,
+                "total_time": time.time() - total_start_time,
+                "query_embedding_cache": self._query_cache_stats()
+            }
+        }
+
+    def _pipeline_stats(self, retrieval_results: List[RetrievalResult],
+                        reranked_results: List[RetrievalResult],
+                        total_start_time: float,
+                        rerank_plan: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """检索与重排序阶段的统计信息"""
+        stats = {
+            "retrieval_count": len(retrieval_results),
+            "rerank_count": len(reranked_results),
+            "total_time": time.time() - total_start_time,
+            "query_embedding_cache": self._query_cache_stats(),
+            "rerank_cache": self.reranker.score_cache.stats() if self.reranker.score_cache else {}
+        }
+        if rerank_plan is not None:
+            stats["adaptive_rerank"] = rerank_plan
+        trace = current_trace()
+        if trace is not None:
+            # 本次查询各阶段耗时（毫秒）
+            stats["spans"] = trace.summary()
+        return stats
+
     def query(self, 
              question: str,
              retrieval_top_k: int = 20,
-             rerank_top_k: int = 5) -> Dict[str, Any]:
+             rerank_top_k: int = 5,
+             collection: Optional[str] = None,
+             where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
         执行完整的RAG查询流程
         
@@ -441,60 +2153,133 @@ class RAGPipeline:
             question: 用户问题
             retrieval_top_k: 检索阶段返回的文档数量
             rerank_top_k: 重排序后保留的文档数量
+            collection: 只在该集合中检索，为None时检索全部集合
+            where: 元数据过滤表达式，如 {"source": "wiki", "year": {"$gte": 2023}}
             
         Returns:
-            完整的查询结果
+            完整的查询结果，pipeline_stats["spans"] 中包含各阶段耗时；
+            答案生成失败时含 error 字段
         """
+        metrics.inc("rag_queries_total", mode="blocking")
+        with metrics.trace(), metrics.span("query"):
+            return self._query(question, retrieval_top_k, rerank_top_k, collection, where)
+
+    def _query(self, question: str, retrieval_top_k: int, rerank_top_k: int,
+               collection: Optional[str], where: Optional[Dict[str, Any]]) -> Dict[str, Any]:
         logger.info(f"Processing RAG query: {question[:50]}...")
         total_start_time = time.time()
+
+        representations = self._encode_question(question)
+        cache_key, hit = self._lookup_answer_cache(
+            question, self._cache_params(retrieval_top_k, rerank_top_k, collection, where), representations)
+        if hit is not None:
+            return self._cached_result(question, hit, total_start_time)
         
-        # 步骤1: BGE-m3检索
-        logger.info("Step 1: BGE-m3 Retrieval...")
-        retrieval_results = self.retrieval_system.search(question, retrieval_top_k)
-        
+        retrieval_results, reranked_results, rerank_plan = self._retrieve_and_rerank(
+            question, retrieval_top_k, rerank_top_k, collection, where, representations)
         if not retrieval_results:
-            return {
-                "question": question,
-                "answer": "抱歉，没有找到相关文档。",
-                "sources": [],
-                "confidence": 0.0,
-                "pipeline_stats": {
-                    "retrieval_count": 0,
-                    "rerank_count": 0,
-                    "total_time": time.time() - total_start_time
-                }
-            }
-        
-        logger.info(f"Retrieved {len(retrieval_results)} documents")
-        
-        # 步骤2: BGE-reranker重排序
-        logger.info("Step 2: BGE-reranker Reranking...")
-        reranked_results = self.reranker.rerank(question, retrieval_results, rerank_top_k)
-        logger.info(f"Reranked to top {len(reranked_results)} documents")
+            return self._empty_result(question, total_start_time)
         
         # 步骤3: LLM生成答案
         logger.info("Step 3: LLM Answer Generation...")
         generation_result = self.llm_generator.generate_answer(question, reranked_results)
         
-        total_time = time.time() - total_start_time
-        
         # 整合结果
+        pipeline_stats = self._pipeline_stats(retrieval_results, reranked_results, total_start_time, rerank_plan)
+        pipeline_stats["generation_time"] = generation_result.get("generation_time", 0)
+        if "packing" in generation_result:
+            pipeline_stats["context_packing"] = generation_result["packing"]
         result = {
             "question": question,
             "answer": generation_result["answer"],
             "sources": generation_result["sources"],
             "confidence": generation_result["confidence"],
-            "pipeline_stats": {
-                "retrieval_count": len(retrieval_results),
-                "rerank_count": len(reranked_results),
-                "total_time": total_time,
-                "generation_time": generation_result.get("generation_time", 0)
-            }
+            "pipeline_stats": pipeline_stats
         }
+        if "error" in generation_result:
+            result["error"] = generation_result["error"]
+        self._store_answer(question, cache_key, result)
+        if self.answer_cache is not None:
+            pipeline_stats["answer_cache"] = {"hit": False, **self.answer_cache.stats()}
         
-        logger.info(f"RAG query completed in {total_time:.2f}s")
+        logger.info(f"RAG query completed in {pipeline_stats['total_time']:.2f}s")
         return result
 
+    def query_stream(self,
+                     question: str,
+                     retrieval_top_k: int = 20,
+                     rerank_top_k: int = 5,
+                     collection: Optional[str] = None,
+                     where: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        流式RAG查询：检索和重排序完成后立即产出参考来源，随后逐段产出答案
+        （collection和where的含义与query()相同）
+
+        Yields:
+            1. {"type": "sources", "sources": [...], "pipeline_stats": {...}}
+            2. 若干 {"type": "token", "text": "..."}
+            3. {"type": "done", ...}，字段与query()的返回值相同
+        """
+        metrics.inc("rag_queries_total", mode="stream")
+        yield from metrics.traced(self._query_stream(question, retrieval_top_k, rerank_top_k, collection, where))
+
+    def _query_stream(self, question: str, retrieval_top_k: int, rerank_top_k: int,
+                      collection: Optional[str], where: Optional[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        logger.info(f"Processing streaming RAG query: {question[:50]}...")
+        total_start_time = time.time()
+
+        representations = self._encode_question(question)
+        cache_key, hit = self._lookup_answer_cache(
+            question, self._cache_params(retrieval_top_k, rerank_top_k, collection, where), representations)
+        if hit is not None:
+            result = self._cached_result(question, hit, total_start_time)
+            yield {"type": "sources", "sources": result["sources"], "pipeline_stats": result["pipeline_stats"]}
+            yield {"type": "token", "text": result["answer"]}
+            yield {"type": "done", **result}
+            return
+
+        retrieval_results, reranked_results, rerank_plan = self._retrieve_and_rerank(
+            question, retrieval_top_k, rerank_top_k, collection, where, representations)
+        if not retrieval_results:
+            result = self._empty_result(question, total_start_time)
+            yield {"type": "sources", "sources": [], "pipeline_stats": result["pipeline_stats"]}
+            yield {"type": "done", **result}
+            return
+
+        # 只打包一次：参考来源先行产出，同一份提示词随后交给流式生成
+        prepared = self.llm_generator.prepare_prompt(question, reranked_results)
+        sources = prepared[1]
+        retrieval_stats = self._pipeline_stats(retrieval_results, reranked_results, total_start_time, rerank_plan)
+        yield {"type": "sources", "sources": sources, "pipeline_stats": retrieval_stats}
+
+        # 步骤3: LLM流式生成答案
+        logger.info("Step 3: LLM Streaming Answer Generation...")
+        for event in self.llm_generator.generate_answer_stream(question, reranked_results, prepared):
+            if event["type"] != "done":
+                yield event
+                continue
+
+            pipeline_stats = self._pipeline_stats(retrieval_results, reranked_results, total_start_time,
+                                                  rerank_plan)
+            pipeline_stats["generation_time"] = event.get("generation_time", 0)
+            if "packing" in event:
+                pipeline_stats["context_packing"] = event["packing"]
+            pipeline_stats["time_to_first_token"] = (
+                retrieval_stats["total_time"] + event.get("first_token_time", 0)
+            )
+            result = {
+                "question": question,
+                "answer": event["answer"],
+                "sources": event["sources"],
+                "confidence": event["confidence"],
+                "pipeline_stats": pipeline_stats
+            }
+            if "error" in event:
+                result["error"] = event["error"]
+            self._store_answer(question, cache_key, result)
+            yield {"type": "done", **result}
+            logger.info(f"Streaming RAG query completed in {pipeline_stats['total_time']:.2f}s")
+
 def load_sample_documents() -> List[Document]:
     """加载示例文档数据"""
     
@@ -1017,6 +2802,10 @@ def main():
         print(f"  语义检索：✅ BGE-m3多语言嵌入")
         print(f"  精确重排：✅ BGE-reranker二次排序") 
         print(f"  智能生成：✅ 通义千问qwen-max")
+
+        print(f"\n⏱️  启动耗时：")
+        for step, seconds in startup_report().items():
+            print(f"  {step}：{seconds:.2f}秒")
         
     except Exception as e:
         logger.error(f"RAG系统初始化失败: {e}")
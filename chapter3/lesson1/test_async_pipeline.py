@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""async_pipeline的离线测试"""
+
+import asyncio
+import threading
+
+import pytest
+
+from async_pipeline import AsyncRAGPipeline, MicroBatcher
+
+QUESTIONS = ["memory safety in rust", "portable containers", "streaming events", "dataframes for tabular data"]
+
+
+@pytest.mark.parametrize("retrieval_mode", ["dense", "hybrid"])
+def test_concurrent_queries_share_batches_and_match_sync(make_pipeline, corpus, retrieval_mode):
+    pipeline = make_pipeline(retrieval_mode=retrieval_mode)
+    pipeline.load_documents(corpus)
+    expected = [pipeline.query(question, retrieval_top_k=4, rerank_top_k=2) for question in QUESTIONS]
+
+    async def run():
+        async with AsyncRAGPipeline(pipeline, max_wait_ms=50) as async_pipeline:
+            results = await async_pipeline.query_many(QUESTIONS, retrieval_top_k=4, rerank_top_k=2)
+            return results, async_pipeline.stats()
+
+    results, stats = asyncio.run(run())
+    for result, sync_result in zip(results, expected):
+        assert result["question"] == sync_result["question"]
+        assert result["answer"] == sync_result["answer"]
+        assert [s["parent_id"] for s in result["sources"]] == [s["parent_id"] for s in sync_result["sources"]]
+    assert stats["retrieval"]["items"] == len(QUESTIONS)
+    assert stats["retrieval"]["batches"] < len(QUESTIONS)
+
+
+def test_batched_requests_keep_their_own_filters(make_pipeline, corpus):
+    pipeline = make_pipeline()
+    pipeline.load_documents(corpus)
+
+    async def run():
+        async with AsyncRAGPipeline(pipeline, max_wait_ms=50) as async_pipeline:
+            return await asyncio.gather(
+                async_pipeline.query("programming language", rerank_top_k=5, collection="ops"),
+                async_pipeline.query("programming language", rerank_top_k=5, where={"source": "wiki"}),
+            )
+
+    ops, wiki = asyncio.run(run())
+    assert {s["parent_id"] for s in ops["sources"]} == {"docker", "kafka"}
+    assert {s["parent_id"] for s in wiki["sources"]} == {"python", "pandas"}
+
+
+def test_micro_batcher_propagates_batch_errors():
+    def fail(items):
+        raise RuntimeError("model crashed")
+
+    async def run():
+        batcher = MicroBatcher(fail, "test", max_wait_ms=20)
+        try:
+            return await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+        finally:
+            await batcher.close()
+
+    errors = asyncio.run(run())
+    assert all(isinstance(error, RuntimeError) for error in errors)
+
+
+def test_micro_batcher_caps_batch_size():
+    sizes = []
+
+    def record(items):
+        sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(record, "test", max_batch_size=3, max_wait_ms=50)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(7)))
+        finally:
+            await batcher.close()
+
+    assert asyncio.run(run()) == [i * 2 for i in range(7)]
+    assert max(sizes) <= 3 and sum(sizes) == 7
+
+
+def test_async_queries_share_the_answer_cache(make_pipeline, fake_llm, corpus):
+    pipeline = make_pipeline(answer_cache_size=16)
+    pipeline.load_documents(corpus)
+    pipeline.query("memory safety in rust")
+
+    async def run():
+        async with AsyncRAGPipeline(pipeline) as async_pipeline:
+            cached = await async_pipeline.query("memory safety in rust")
+            fresh = await async_pipeline.query("portable containers")
+            return cached, fresh
+
+    cached, fresh = asyncio.run(run())
+    assert cached["pipeline_stats"]["answer_cache"]["hit"] is True
+    assert fresh["pipeline_stats"]["answer_cache"]["hit"] is False
+    assert len(fake_llm.prompts) == 2
+    # 异步路径生成的答案同样写回缓存
+    assert pipeline.query("portable containers")["pipeline_stats"]["answer_cache"]["hit"] is True
+
+
+def test_questions_are_encoded_once_by_the_encode_worker(make_pipeline, corpus):
+    pipeline = make_pipeline(answer_cache_size=16, query_cache_size=0)
+    pipeline.load_documents(corpus)
+    model = pipeline.retrieval_system._model
+    encode = model.encode
+    threads = []
+
+    def recording_encode(sentences, **kwargs):
+        threads.append(threading.current_thread().name)
+        return encode(sentences, **kwargs)
+
+    model.encode = recording_encode
+
+    async def run():
+        async with AsyncRAGPipeline(pipeline, max_wait_ms=50) as async_pipeline:
+            await async_pipeline.query_many(QUESTIONS)
+            return async_pipeline.stats()
+
+    stats = asyncio.run(run())
+    # 缓存查找和检索共用一次编码，模型只在encode worker线程中被调用
+    assert len(threads) == stats["encode"]["batches"] < len(QUESTIONS)
+    assert all(name.startswith("rag-encode") for name in threads)
+    assert stats["encode"]["items"] == stats["retrieval"]["items"] == len(QUESTIONS)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""embedding_server的离线测试：FlagEmbedding由conftest中的假模型顶替，服务监听本机随机端口"""
+
+import threading
+
+import numpy as np
+import pytest
+
+from conftest import fake_embed
+from embedding_server import DynamicBatcher, EmbeddingServer, ModelServerClient
+
+
+def test_dynamic_batcher_merges_concurrent_requests():
+    sizes = []
+
+    def double(items):
+        sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    batcher = DynamicBatcher(double, "test", max_batch_size=8, max_wait_ms=50)
+    results = {}
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, batcher.submit(i))) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+    assert results == {i: i * 2 for i in range(8)}
+    assert len(sizes) < 8 and batcher.stats()["items"] == 8
+
+
+def test_dynamic_batcher_errors_and_close():
+    def fail(items):
+        raise ValueError("bad batch")
+
+    batcher = DynamicBatcher(fail, "test", max_wait_ms=1)
+    with pytest.raises(ValueError):
+        batcher.submit(1)
+    batcher.close()
+    batcher.close()  # 重复关闭无副作用
+    with pytest.raises(RuntimeError):
+        batcher.submit(2)
+
+
+@pytest.fixture
+def server(fake_flag_embedding):
+    server = EmbeddingServer(port=0, max_wait_ms=20).start()
+    yield server
+    server.shutdown()
+
+
+def test_server_encodes_and_reranks(server):
+    client = ModelServerClient(server.url)
+    assert client.health()["model_path"] == "BAAI/bge-m3"
+
+    dense, lexical = client.encode(["memory safety", "portable containers"], return_sparse=True)
+    assert np.allclose(dense[0], fake_embed("memory safety"))
+    assert len(lexical) == 2 and lexical[0]
+    assert client.rerank([["rust", "rust is safe"], ["rust", "docker"]]) == pytest.approx(
+        [float(fake_embed("rust") @ fake_embed("rust is safe")), float(fake_embed("rust") @ fake_embed("docker"))])
+
+    with pytest.raises(RuntimeError, match="400"):
+        client.rerank([["only one"]])
+
+
+def test_concurrent_clients_share_model_calls(server):
+    texts = [f"text number {i}" for i in range(6)]
+    results = {}
+
+    def encode(i):
+        results[i] = ModelServerClient(server.url).encode([texts[i]])[0]
+
+    threads = [threading.Thread(target=encode, args=(i,)) for i in range(len(texts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i, text in enumerate(texts):
+        assert np.allclose(results[i][0], fake_embed(text))
+    stats = server.health()["encode"]
+    assert stats["items"] == len(texts) and stats["batches"] < len(texts)
+
+
+def test_pipeline_uses_the_model_server(server, make_retrieval_system, corpus):
+    from rag_pipeline import BGERetrievalSystem, BGEReranker
+
+    remote = BGERetrievalSystem(model_server=server.url, retrieval_mode="hybrid")
+    remote.add_documents(corpus)
+    local = make_retrieval_system(retrieval_mode="hybrid")
+    local.add_documents(corpus)
+    results = remote.search("memory safety in rust", top_k=3)
+    assert [r.document.id for r in results] == [r.document.id for r in local.search("memory safety in rust", top_k=3)]
+
+    reranked = BGEReranker(model_server=server.url).rerank("memory safety in rust", results, top_k=1)
+    assert reranked[0].document.parent_id == "rust"
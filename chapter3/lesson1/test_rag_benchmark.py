@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""rag_benchmark的离线测试，FlagEmbedding由conftest中的假模型顶替"""
+
+import argparse
+
+import pytest
+
+from rag_benchmark import StubGenerator, build_corpus, build_queries, compare_reports, latency_summary, run_benchmark
+
+
+def _args(**overrides) -> argparse.Namespace:
+    args = dict(corpus_size=20, corpus_file=None, num_queries=5, query_file=None,
+                retrieval_model="BAAI/bge-m3", reranker_model="BAAI/bge-reranker-v2-m3",
+                index_type="exact", index_params="{}", retrieval_mode="dense",
+                retrieval_top_k=5, rerank_top_k=2, batch_size=4, encode_batch_size=12, chunk_workers=1,
+                model_server=None, llm_latency_ms=0.0, warmup=1, seed=7)
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def test_benchmark_report(fake_flag_embedding):
+    report = run_benchmark(_args(index_type="ivf", index_params='{"n_lists": 4, "nprobe": 4}'))
+    assert report["corpus"]["documents"] == 20
+    assert report["corpus"]["chunks"] >= 20
+    for stage in ("retrieval", "rerank", "generation", "total"):
+        assert report["latency_ms"][stage]["p50"] <= report["latency_ms"][stage]["p99"]
+    assert report["recall"]["recall@5"] == 1.0
+    assert report["throughput"]["batch_retrieval_qps"] > 0
+
+    # 与自身对比时各项变化为0
+    lines = compare_reports(report, report)
+    assert any(line.startswith("recall@5") for line in lines)
+    assert all("+0.0%" in line for line in lines if "%" in line)
+
+
+def test_benchmark_without_queries(fake_flag_embedding):
+    report = run_benchmark(_args(num_queries=0))
+    assert report["latency_ms"]["total"] == {}
+    assert report["recall"] == {"top_k": 5}
+    assert compare_reports(report, report) == []
+
+
+def test_corpus_and_queries_are_reproducible(tmp_path):
+    assert build_corpus(10, seed=1) == build_corpus(10, seed=1)
+    assert build_queries(10, seed=1) == build_queries(10, seed=1)
+
+    corpus_file = tmp_path / "corpus.jsonl"
+    corpus_file.write_text('{"title": "t", "content": "c"}\n', encoding="utf-8")
+    assert {doc.content for doc in build_corpus(3, corpus_file=str(corpus_file))} == {"c"}
+
+
+def test_latency_summary():
+    assert latency_summary([]) == {}
+    summary = latency_summary([0.001, 0.002, 0.003])
+    assert summary["p50"] == pytest.approx(2.0)
+    assert summary["max"] == pytest.approx(3.0)
+
+
+def test_stub_generator_never_calls_the_llm(monkeypatch):
+    monkeypatch.delenv("DASHSCOPE_API_KEY", raising=False)
+    result = StubGenerator().generate_answer("question", [])
+    assert result["confidence"] == 0.0 and result["sources"] == []
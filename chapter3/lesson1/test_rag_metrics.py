@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""rag_metrics的离线测试"""
+
+import threading
+
+import pytest
+
+from rag_metrics import Histogram, MetricsRegistry, STAGE_DURATION, current_trace
+
+
+def test_histogram_quantiles():
+    histogram = Histogram((1.0, 2.0, 4.0))
+    for value in (0.5, 1.5, 1.5, 3.0, 10.0):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.quantile(0.5) == pytest.approx(1.75)
+    assert histogram.quantile(0.99) == 4.0
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_spans_feed_histograms_and_the_current_trace():
+    registry = MetricsRegistry()
+    with registry.trace() as trace:
+        with registry.span("encode"):
+            pass
+        with registry.span("encode"):
+            pass
+    assert current_trace() is None
+    assert set(trace.summary()) == {"encode"} and len(trace.spans) == 2
+    [series] = registry.export_json()["histograms"][STAGE_DURATION]
+    assert series["labels"] == {"stage": "encode"} and series["count"] == 2
+
+    # trace之外的span只写入直方图
+    with registry.span("rerank"):
+        pass
+    assert len(registry.export_json()["histograms"][STAGE_DURATION]) == 2
+
+
+def test_traced_generator_does_not_leak_its_trace():
+    registry = MetricsRegistry()
+
+    def stages():
+        for name in ("encode", "rerank"):
+            with registry.span(name):
+                yield current_trace()
+
+    stream = registry.traced(stages())
+    first = next(stream)
+    # 两次next之间调用方看不到生成器的trace
+    assert first is not None and current_trace() is None
+    assert next(stream) is first
+    stream.close()
+    assert set(first.summary()) == {"encode", "rerank"}
+
+
+def test_traced_generator_can_be_closed_from_another_thread():
+    registry = MetricsRegistry()
+    closed = []
+
+    def stages():
+        try:
+            yield 1
+            yield 2
+        finally:
+            closed.append(True)
+
+    stream = registry.traced(stages())
+    next(stream)
+    errors = []
+
+    def close():
+        try:
+            stream.close()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=close)
+    thread.start()
+    thread.join()
+    assert not errors and closed == [True]
+
+
+def test_prometheus_export():
+    registry = MetricsRegistry()
+    registry.describe("requests_total", "Requests served")
+    registry.inc("requests_total", 2, mode='say "hi"')
+    registry.observe("latency_seconds", 0.003, buckets=(0.001, 0.01))
+    text = registry.export_prometheus()
+    assert "# HELP requests_total Requests served" in text
+    assert 'requests_total{mode="say \\"hi\\""} 2' in text
+    assert 'latency_seconds_bucket{le="0.001"} 0' in text
+    assert 'latency_seconds_bucket{le="0.01"} 1' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 1' in text
+    registry.reset()
+    assert registry.export_json() == {"histograms": {}, "counters": {}}
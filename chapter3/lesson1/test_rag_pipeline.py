@@ -0,0 +1,688 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""rag_pipeline的离线测试，模型和LLM由conftest中的假实现代替"""
+
+import json
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from conftest import FakeReranker, fake_embed
+
+from rag_pipeline import (AdaptiveRerankConfig, BGERetrievalSystem, BGEReranker, Document, LLMGenerator, QueryEmbeddingCache,
+                          RerankScoreCache, RetrievalResult, SemanticAnswerCache)
+
+
+def _ids(results):
+    return [result.document.parent_id for result in results]
+
+
+# --- 持久化索引 -----------------------------------------------------------------------
+
+def test_saved_index_loads_without_encoding(tmp_path, make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.add_documents(corpus)
+    expected = _ids(system.search("memory safety in rust", top_k=3))
+    system.save_index(str(tmp_path / "index"))
+
+    # 加载索引不需要模型，只有编码查询时才会用到
+    restored = BGERetrievalSystem()
+    restored.load_index(str(tmp_path / "index"))
+    assert restored._model is None
+    assert isinstance(restored.embeddings, np.memmap)
+    assert len(restored.documents) == len(system.documents)
+
+    restored._model = system._model
+    assert _ids(restored.search("memory safety in rust", top_k=3)) == expected
+
+
+def test_float16_index_halves_the_vector_file(tmp_path, make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.add_documents(corpus)
+    system.save_index(str(tmp_path / "f32"))
+    system.save_index(str(tmp_path / "f16"), dtype="float16")
+    assert (tmp_path / "f16" / "embeddings.bin").stat().st_size * 2 == \
+        (tmp_path / "f32" / "embeddings.bin").stat().st_size
+
+    restored = make_retrieval_system()
+    restored.load_index(str(tmp_path / "f16"), mmap=False)
+    assert restored.embeddings.dtype == np.float16
+    assert _ids(restored.search("dataframes for tabular data", top_k=1)) == ["pandas"]
+
+
+def test_saved_index_skips_deleted_rows(tmp_path, make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.compaction_threshold = 1.1  # 不触发后台压缩
+    system.add_documents(corpus)
+    system.delete_documents(["rust"])
+    system.save_index(str(tmp_path / "index"))
+
+    meta = json.loads((tmp_path / "index" / "meta.json").read_text())
+    assert meta["count"] == len(corpus) - 1
+    restored = make_retrieval_system()
+    restored.load_index(str(tmp_path / "index"))
+    assert "rust" not in {doc.parent_id for doc in restored.documents}
+
+
+def test_corrupt_index_is_rejected(tmp_path, make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.add_documents(corpus)
+    system.save_index(str(tmp_path / "index"))
+    chunks = tmp_path / "index" / "chunks.jsonl"
+    chunks.write_text("".join(chunks.read_text(encoding="utf-8").splitlines(keepends=True)[:-1]), encoding="utf-8")
+    with pytest.raises(ValueError):
+        make_retrieval_system().load_index(str(tmp_path / "index"))
+
+
+# --- 增量更新与删除 ---------------------------------------------------------------------
+
+def _long_document(paragraphs):
+    # 每段约600字符，切片后每段单独成块
+    return Document(id="manual", title="manual", content="\n\n".join(
+        (f"{topic} " * 100).strip() for topic in paragraphs))
+
+
+def test_upsert_only_encodes_changed_chunks(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.compaction_threshold = 1.1
+    system.add_documents(corpus + [_long_document(["alpha", "bravo", "charlie"])])
+    rows = len(system.documents)
+
+    stats = system.upsert_documents([_long_document(["alpha", "bravo", "delta"])])
+    assert stats == {"encoded": 1, "reused": 2, "deleted": 1}
+    assert system.embeddings.shape[0] == rows + 1
+    assert _ids(system.search("delta delta", top_k=1)) == ["manual"]
+    assert all("charlie" not in result.document.content for result in system.search("charlie", top_k=10))
+
+    # 内容不变时不重新编码
+    calls = len(system._model.calls)
+    assert system.upsert_documents([_long_document(["alpha", "bravo", "delta"])])["encoded"] == 0
+    assert len(system._model.calls) == calls
+
+
+def test_upsert_adds_new_documents(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.add_documents(corpus[:2])
+    stats = system.upsert_documents([corpus[2]])
+    assert stats == {"encoded": 1, "reused": 0, "deleted": 0}
+    assert _ids(system.search("dataframes for tabular data", top_k=1)) == ["pandas"]
+
+
+def test_upsert_keeps_the_last_duplicate_in_a_batch(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.compaction_threshold = 1.1
+    system.add_documents(corpus)
+    first = Document(id="x", title="x", content="first version of x")
+    second = Document(id="x", title="x", content="second version of x")
+    # 其他集合中的同名文档是另一篇文档
+    other = Document(id="x", title="x", content="x in ops", collection="ops")
+    assert system.upsert_documents([first, other, second])["encoded"] == 2
+    assert sorted(doc.content for doc in system.documents if doc.parent_id == "x") == ["second version of x", "x in ops"]
+
+    # 没有切出块的新版本仍会删除旧块
+    assert system.upsert_documents([Document(id="x", title="x", content="")])["deleted"] == 1
+    assert system.search("second version", top_k=10, collection="default")[0].document.parent_id != "x"
+
+def test_upsert_into_empty_system(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.add_documents([])
+    system.upsert_documents(corpus)
+    assert _ids(system.search("portable containers", top_k=1)) == ["docker"]
+
+
+def test_deleted_documents_disappear_and_compact(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.compaction_threshold = 1.1
+    system.add_documents(corpus)
+    assert system.delete_documents(["rust"]) == 1
+    assert "rust" not in _ids(system.search("memory safety in rust", top_k=10))
+
+    before = _ids(system.search("programming language", top_k=10))
+    system.compact()
+    assert not system._tombstones
+    assert len(system.documents) == system.embeddings.shape[0] == len(corpus) - 1
+    assert _ids(system.search("programming language", top_k=10)) == before
+
+
+def test_background_compaction_after_threshold(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.compaction_threshold = 0.2
+    system.add_documents(corpus)
+    system.delete_documents(["python", "rust"])
+    system._compaction_thread.join(timeout=5)
+    assert len(system.documents) == len(corpus) - 2
+    assert not system._tombstones
+
+
+# --- 可插拔近似近邻索引 -------------------------------------------------------------------
+
+def test_ivf_backend_finds_the_same_documents(make_retrieval_system, corpus):
+    exact = make_retrieval_system()
+    exact.add_documents(corpus)
+    ivf = make_retrieval_system(index_type="ivf", index_params={"n_lists": 2, "nprobe": 2})
+    ivf.add_documents(corpus)
+    query = "memory safety in rust"
+    assert _ids(ivf.search(query, top_k=3)) == _ids(exact.search(query, top_k=3))
+    assert ivf.evaluate_index([query, "streaming events"], top_k=3)["recall@3"] == 1.0
+
+
+
+def test_ivf_backend_handles_empty_batches_and_deleting_everything(make_retrieval_system, corpus):
+    system = make_retrieval_system(index_type="ivf")
+    system.add_documents([])
+    assert system.search("rust") == []
+
+    system.compaction_threshold = 0.5
+    system.add_documents(corpus)
+    system.delete_documents(["python", "rust", "pandas"])
+    system._compaction_thread.join(timeout=5)
+    system.delete_documents(["docker", "kafka"], collection="ops")
+    system._compaction_thread.join(timeout=5)
+    assert not system._tombstones and system.documents == []
+    assert system.search("rust") == []
+
+    # 清空后重新添加文档时重新训练聚类中心
+    system.add_documents(corpus)
+    assert _ids(system.search("memory safety in rust", top_k=1)) == ["rust"]
+
+@pytest.mark.parametrize("index_type", ["exact", "ivf"])
+def test_search_during_upserts_sees_consistent_snapshots(make_retrieval_system, corpus, index_type):
+    system = make_retrieval_system(index_type=index_type, index_params={"n_lists": 2} if index_type == "ivf" else {})
+    system.compaction_threshold = 1.1
+    system.add_documents(corpus)
+    errors = []
+    stop = threading.Event()
+
+    def search():
+        while not stop.is_set():
+            try:
+                for result in system.search("programming language", top_k=5):
+                    assert result.document.content
+            except Exception as e:  # 索引与文档列表不一致时会出现IndexError
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=search) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(30):
+        system.upsert_documents([Document(id=f"extra{i}", title="extra", content=f"extra document number {i}")])
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+# --- 批量检索 ----------------------------------------------------------------------------
+
+def test_search_batch_matches_single_searches_with_one_encode(make_retrieval_system, corpus):
+    queries = ["memory safety in rust", "portable containers", "streaming events"]
+    system = make_retrieval_system(query_cache_size=0)
+    system.add_documents(corpus)
+    calls = len(system._model.calls)
+    batch = system.search_batch(queries, top_k=3)
+    assert len(system._model.calls) == calls + 1
+    for query, results in zip(queries, batch):
+        single = system.search(query, top_k=3)
+        assert _ids(results) == _ids(single)
+        assert [r.rank for r in results] == [1, 2, 3]
+        assert [r.score for r in results] == pytest.approx([r.score for r in single])
+
+
+def test_search_batch_edge_cases(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    assert system.search_batch(["anything"], top_k=3) == [[]]
+    system.add_documents(corpus)
+    assert system.search_batch([], top_k=3) == []
+    assert len(system.search_batch(["python"], top_k=100)[0]) == len(corpus)
+
+
+# --- 查询向量缓存 ---------------------------------------------------------------------------
+
+def test_repeated_queries_skip_the_encoder(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.add_documents(corpus)
+    first = _ids(system.search("memory safety in rust", top_k=3))
+    calls = len(system._model.calls)
+    # 全角字符和多余空白归一化后命中同一条缓存
+    assert _ids(system.search("  memory   safety in ｒｕｓｔ ", top_k=3)) == first
+    assert len(system._model.calls) == calls
+    assert system.query_cache.stats()["hits"] == 1
+
+
+def test_query_cache_evicts_least_recently_used():
+    cache = QueryEmbeddingCache("model", capacity=2)
+    for query in ("a", "b"):
+        cache.put(query, np.full(4, len(query), dtype=np.float32))
+    cache.get("a")
+    cache.put("c", np.zeros(4, dtype=np.float32))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["size"] == 2
+
+
+def test_query_cache_survives_restart_on_disk(tmp_path):
+    cache = QueryEmbeddingCache("model", cache_dir=str(tmp_path))
+    cache.put("query", np.arange(4, dtype=np.float32))
+    cache.put("query", {"42": 0.5}, kind="sparse")
+
+    restarted = QueryEmbeddingCache("model", cache_dir=str(tmp_path))
+    assert np.array_equal(restarted.get("query"), np.arange(4, dtype=np.float32))
+    assert restarted.get("query", kind="sparse") == {"42": 0.5}
+    assert restarted.stats()["disk_hits"] == 2
+    # 模型名是缓存键的一部分
+    assert QueryEmbeddingCache("other-model", cache_dir=str(tmp_path)).get("query") is None
+
+
+# --- 重排序分数缓存 -------------------------------------------------------------------------
+
+def _reranker(cache_size=100):
+    reranker = BGEReranker(score_cache_size=cache_size)
+    reranker._reranker = FakeReranker()
+    return reranker
+
+
+def test_rerank_scores_are_cached_per_query_and_chunk(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.add_documents(corpus)
+    candidates = system.search("memory safety in rust", top_k=5)
+    reranker = _reranker()
+
+    first = reranker.rerank("memory safety in rust", candidates, top_k=3)
+    assert len(reranker.reranker.calls) == 1
+    # 翻页：只有未见过的文档对送入交叉编码器
+    assert reranker.rerank("memory safety in rust", candidates, top_k=3) == first
+    assert len(reranker.reranker.calls) == 1
+    reranker.rerank("a different question", candidates[:2], top_k=2)
+    assert len(reranker.reranker.calls[-1]) == 2
+    assert reranker.score_cache.stats()["hits"] == len(candidates)
+
+
+def test_rerank_batch_matches_single_reranks(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.add_documents(corpus)
+    queries = ["memory safety in rust", "portable containers"]
+    candidates = system.search_batch(queries, top_k=4)
+    batched = _reranker(0).rerank_batch(queries, candidates, top_k=2)
+    for query, results, reranked in zip(queries, candidates, batched):
+        assert _ids(reranked) == _ids(_reranker(0).rerank(query, results, top_k=2))
+
+
+def test_rerank_cache_key_and_eviction():
+    cache = RerankScoreCache("model", capacity=1)
+    assert cache.key("Query", "doc") == cache.key(" Query ", "doc")
+    assert cache.key("query", "doc") != cache.key("query", "other doc")
+    assert RerankScoreCache("other").key("query", "doc") != cache.key("query", "doc")
+    cache.put("a", 1.0)
+    cache.put("b", 2.0)
+    assert cache.get("a") is None and cache.get("b") == 2.0
+
+
+# --- 稀疏+稠密混合检索 ----------------------------------------------------------------------
+
+def test_hybrid_scores_add_weighted_sparse_matches(make_retrieval_system, corpus):
+    dense = make_retrieval_system()
+    dense.add_documents(corpus)
+    hybrid = make_retrieval_system(retrieval_mode="hybrid", sparse_weight=0.3)
+    hybrid.add_documents(corpus)
+
+    dense_top = dense.search("kafka", top_k=1)[0]
+    hybrid_top = hybrid.search("kafka", top_k=1)[0]
+    assert hybrid_top.document.parent_id == dense_top.document.parent_id == "kafka"
+    # 假模型中每个共享词项的权重乘积为 0.3 * 0.3
+    assert hybrid_top.score == pytest.approx(dense_top.score + 0.3 * 0.09, abs=1e-5)
+
+
+def test_hybrid_sparse_candidates_beyond_dense_top_k(make_retrieval_system, corpus):
+    system = make_retrieval_system(retrieval_mode="hybrid", hybrid_dense_top_k=1)
+    system.add_documents(corpus)
+    # 稠密路只取1个候选，共享词项的文档由稀疏倒排表补足
+    assert set(_ids(system.search("language programming memory", top_k=2))) == {"python", "rust"}
+
+
+def test_hybrid_index_upserts_and_round_trips(tmp_path, make_retrieval_system, corpus):
+    system = make_retrieval_system(retrieval_mode="hybrid")
+    system.add_documents(corpus[:3])
+    system.upsert_documents(corpus[3:])
+    assert len(system.lexical_weights) == len(system.documents)
+    assert system.sparse_index.num_rows == len(system.documents)
+    system.save_index(str(tmp_path / "index"))
+
+    restored = make_retrieval_system(retrieval_mode="hybrid")
+    restored.load_index(str(tmp_path / "index"))
+    assert restored.lexical_weights == system.lexical_weights
+    assert _ids(restored.search("streaming events", top_k=2)) == _ids(system.search("streaming events", top_k=2))
+
+
+def test_unknown_retrieval_mode():
+    with pytest.raises(ValueError):
+        BGERetrievalSystem(retrieval_mode="colbert")
+
+
+# --- 流式生成 ------------------------------------------------------------------------------
+
+def test_query_stream_yields_sources_tokens_then_done(make_pipeline, fake_llm, corpus):
+    pipeline = make_pipeline()
+    pipeline.load_documents(corpus)
+    events = list(pipeline.query_stream("memory safety in rust", retrieval_top_k=5, rerank_top_k=2))
+
+    assert events[0]["type"] == "sources" and events[0]["sources"]
+    assert events[-1]["type"] == "done"
+    tokens = [event["text"] for event in events[1:-1]]
+    assert all(event["type"] == "token" for event in events[1:-1]) and len(tokens) > 1
+    assert "".join(tokens) == events[-1]["answer"] == fake_llm.answer
+    assert events[-1]["sources"] == events[0]["sources"]
+    assert events[-1]["pipeline_stats"]["time_to_first_token"] > 0
+    assert len(fake_llm.prompts) == 1
+
+
+def test_query_stream_reports_llm_errors(make_pipeline, fake_llm, corpus):
+    pipeline = make_pipeline()
+    pipeline.load_documents(corpus)
+
+    def broken_stream():
+        yield fake_llm._response("部分")
+        raise ConnectionError("connection reset")
+
+    fake_llm.call = lambda prompt, **params: broken_stream()
+    done = list(pipeline.query_stream("memory safety in rust"))[-1]
+    assert done["type"] == "done"
+    assert done["answer"] == "部分" and done["confidence"] == 0.0
+
+
+def test_query_stream_without_documents(make_pipeline, fake_llm):
+    pipeline = make_pipeline()
+    events = list(pipeline.query_stream("anything"))
+    assert [event["type"] for event in events] == ["sources", "done"]
+    assert events[0]["sources"] == [] and not fake_llm.prompts
+
+
+# --- 并行切片与分批编码 --------------------------------------------------------------------
+
+def test_parallel_chunking_matches_serial(make_retrieval_system, corpus):
+    documents = corpus + [_long_document(["alpha", "bravo", "charlie", "delta"])]
+    serial = make_retrieval_system()._split_documents(documents)
+
+    parallel_system = make_retrieval_system(chunk_workers=2)
+    parallel_system.parallel_chunk_min_docs = 1
+    parallel = parallel_system._split_documents(documents)
+    assert [(c.id, c.content, c.content_hash) for c in parallel] == [(c.id, c.content, c.content_hash) for c in serial]
+
+
+def test_length_sorted_encoding_restores_row_order(make_retrieval_system, corpus):
+    system = make_retrieval_system(encode_batch_size=2)
+    system.progress_interval = 1  # 每次encode只处理一个批次
+    system.add_documents(corpus + [_long_document(["alpha", "bravo"])])
+
+    for row, chunk in enumerate(system.documents):
+        assert np.allclose(system.embeddings[row], fake_embed(f"{chunk.title}\n\n{chunk.content}"))
+    lengths = [len(text) for call in system._model.calls for text in call]
+    assert lengths == sorted(lengths, reverse=True)
+    assert len(system._model.calls) == (len(system.documents) + 1) // 2
+    assert system.ingest_stats["encoded_chunks"] == len(system.documents)
+    assert system.ingest_stats["chunks_per_sec"] > 0
+
+
+# --- 量化向量存储 -------------------------------------------------------------------------
+
+@pytest.mark.parametrize("index_type", ["int8", "binary"])
+def test_quantized_backends_in_retrieval(make_retrieval_system, corpus, index_type):
+    system = make_retrieval_system(index_type=index_type)
+    system.add_documents(corpus)
+    assert _ids(system.search("memory safety in rust", top_k=1)) == ["rust"]
+    report = system.evaluate_index(["portable containers", "streaming events"], top_k=2)
+    assert report["code_bytes"] < report["float_bytes"]
+
+
+# --- 分阶段耗时追踪 -------------------------------------------------------------------------
+
+def test_query_reports_stage_spans(make_pipeline, corpus):
+    pipeline = make_pipeline()
+    pipeline.load_documents(corpus)
+    spans = pipeline.query("memory safety in rust")["pipeline_stats"]["spans"]
+    assert {"encode", "ann_search", "rerank", "prompt_build", "llm_call"} <= set(spans)
+
+    done = list(pipeline.query_stream("portable containers"))[-1]
+    assert {"encode", "rerank", "prompt_build", "llm_call"} <= set(done["pipeline_stats"]["spans"])
+    assert 'stage="llm_call"' in pipeline.export_metrics()
+    assert pipeline.export_metrics("json")["counters"]["rag_queries_total"]
+    with pytest.raises(ValueError):
+        pipeline.export_metrics("xml")
+
+
+# --- 语义答案缓存 ---------------------------------------------------------------------------
+
+def test_repeat_question_is_answered_from_cache(make_pipeline, fake_llm, corpus):
+    pipeline = make_pipeline(answer_cache_size=16)
+    pipeline.load_documents(corpus)
+    first = pipeline.query("memory safety in rust")
+    assert first["pipeline_stats"]["answer_cache"]["hit"] is False
+
+    second = pipeline.query("Memory safety in Rust")
+    assert second["pipeline_stats"]["answer_cache"]["hit"] is True
+    assert second["answer"] == first["answer"] and second["sources"] == first["sources"]
+    assert len(fake_llm.prompts) == 1
+
+    # 影响答案的参数不同时不复用
+    pipeline.query("memory safety in rust", rerank_top_k=2)
+    assert len(fake_llm.prompts) == 2
+    # 流式查询同样命中缓存
+    assert list(pipeline.query_stream("memory safety in rust"))[-1]["pipeline_stats"]["answer_cache"]["hit"]
+    assert len(fake_llm.prompts) == 2
+
+
+def test_answer_cache_and_retrieval_share_one_encode(make_pipeline, corpus):
+    pipeline = make_pipeline(answer_cache_size=16, query_cache_size=0)
+    pipeline.load_documents(corpus)
+    calls = pipeline.retrieval_system._model.calls
+    before = len(calls)
+    pipeline.query("memory safety in rust")
+    list(pipeline.query_stream("portable containers"))
+    assert calls[before:] == [["memory safety in rust"], ["portable containers"]]
+
+def test_corpus_changes_invalidate_cached_answers(make_pipeline, fake_llm, corpus):
+    pipeline = make_pipeline(answer_cache_size=16)
+    pipeline.load_documents(corpus)
+    pipeline.query("memory safety in rust")
+    pipeline.upsert_documents([Document(id="rust", title="rust", content="rust has a borrow checker")])
+    assert pipeline.query("memory safety in rust")["pipeline_stats"]["answer_cache"]["hit"] is False
+    pipeline.delete_documents(["rust"])
+    assert pipeline.query("memory safety in rust")["pipeline_stats"]["answer_cache"]["hit"] is False
+    assert len(fake_llm.prompts) == 3
+
+
+def test_failed_answers_are_not_cached(make_pipeline, fake_llm, corpus):
+    pipeline = make_pipeline(answer_cache_size=16)
+    pipeline.load_documents(corpus)
+    fake_llm.call = lambda prompt, **params: SimpleNamespace(status_code=500, message="overloaded")
+    result = pipeline.query("memory safety in rust")
+    assert result["error"] == "overloaded"
+    assert pipeline.answer_cache.stats()["size"] == 0
+
+    def failing_stream(prompt, **params):
+        raise ConnectionError("reset")
+    fake_llm.call = failing_stream
+    assert list(pipeline.query_stream("memory safety in rust"))[-1]["error"] == "reset"
+    assert pipeline.answer_cache.stats()["size"] == 0
+
+
+def test_answers_with_negative_rerank_scores_are_cached(make_pipeline, fake_llm, corpus):
+    # 交叉编码器输出原始logit，置信度可以为负，但答案依然有效
+    pipeline = make_pipeline(answer_cache_size=16)
+    pipeline.reranker._reranker.compute_score = lambda pairs, **kwargs: [-3.0 - i for i in range(len(pairs))]
+    pipeline.load_documents(corpus)
+    first = pipeline.query("memory safety in rust")
+    assert first["confidence"] < 0 and "error" not in first
+    assert pipeline.query("memory safety in rust")["pipeline_stats"]["answer_cache"]["hit"] is True
+    assert len(fake_llm.prompts) == 1
+
+
+def test_semantic_answer_cache_threshold_ttl_and_generation(monkeypatch):
+    cache = SemanticAnswerCache(capacity=2, threshold=0.9, ttl_seconds=60)
+    a, b = np.eye(2, dtype=np.float32)
+    near = (a + 0.1 * b) / np.linalg.norm(a + 0.1 * b)
+    cache.put("a", a, (5,), {"answer": "A"})
+    assert cache.get(near, (5,))["result"] == {"answer": "A"}
+    assert cache.get(b, (5,)) is None
+    assert cache.get(a, (6,)) is None
+
+    # 查询开始后语料发生变化，结果不写入
+    generation = cache.generation
+    cache.invalidate()
+    cache.put("b", b, (5,), {"answer": "B"}, generation)
+    assert cache.get(b, (5,)) is None and cache.get(a, (5,)) is None
+
+    cache.put("a", a, (5,), {"answer": "A"})
+    monkeypatch.setattr("rag_pipeline.time.time", lambda: 1e12)
+    assert cache.get(a, (5,)) is None
+
+
+# --- 按token预算打包上下文 ------------------------------------------------------------------
+
+def _chunk(parent, index, content, score):
+    doc = Document(id=f"{parent}_chunk_{index}", title=parent, content=content, chunk_id=f"{parent}_chunk_{index}",
+                   parent_id=parent, chunk_index=index)
+    return RetrievalResult(document=doc, score=score, rank=0)
+
+
+def test_packing_merges_adjacent_chunks_and_drops_overlap():
+    overlap = "shared overlap text"
+    contexts = [
+        _chunk("a", 1, overlap + " second half", 0.8),
+        _chunk("a", 0, "first half " + overlap, 0.9),
+        _chunk("b", 0, "first half " + overlap, 0.5),  # 内容重复
+        _chunk("c", 3, "unrelated chunk", 0.7),
+    ]
+    packed, stats = LLMGenerator(api_key="test", context_token_budget=None)._pack_contexts(contexts)
+
+    assert [r.document.parent_id for r in packed] == ["a", "c"]
+    assert packed[0].document.content == "first half " + overlap + " second half"
+    assert packed[0].document.metadata["chunk_range"] == (0, 1)
+    assert packed[0].score == 0.9 and [r.rank for r in packed] == [1, 2]
+    assert stats["chunks_in"] == 4 and stats["contexts_packed"] == 2
+
+
+def test_packing_respects_the_token_budget():
+    contexts = [_chunk("a", 0, "x" * 400, 0.9), _chunk("b", 0, "y" * 400, 0.8), _chunk("c", 0, "z" * 40, 0.7)]
+    generator = LLMGenerator(api_key="test", context_token_budget=120)
+    packed, stats = generator._pack_contexts(contexts)
+    # 放不下的块被跳过，继续尝试更短的块
+    assert [r.document.parent_id for r in packed] == ["a", "c"]
+    assert stats["dropped"] == 1 and stats["tokens_packed"] <= 120
+
+    # 分数最高的资料单独超出预算时被截断，而不是返回空上下文
+    packed, stats = LLMGenerator(api_key="test", context_token_budget=50)._pack_contexts(contexts[:1])
+    assert len(packed) == 1 and 0 < stats["tokens_packed"] <= 50
+
+
+def test_streamed_query_packs_contexts_once(make_pipeline, corpus, monkeypatch):
+    pipeline = make_pipeline()
+    pipeline.load_documents(corpus)
+    pack = pipeline.llm_generator._pack_contexts
+    calls = []
+    monkeypatch.setattr(pipeline.llm_generator, "_pack_contexts", lambda contexts: calls.append(1) or pack(contexts))
+    done = list(pipeline.query_stream("memory safety in rust"))[-1]
+    assert len(calls) == 1
+    assert done["pipeline_stats"]["context_packing"]["contexts_packed"] == len(done["sources"])
+
+
+# --- 自适应重排序深度 -----------------------------------------------------------------------
+
+def _scored(scores):
+    return [_chunk(f"d{i}", 0, f"content {i}", score) for i, score in enumerate(scores)]
+
+
+def test_rerank_depth_follows_the_score_distribution(make_pipeline):
+    pipeline = make_pipeline(adaptive_rerank=AdaptiveRerankConfig(min_depth=5, max_depth=15, skip_gap=0.15))
+
+    depth, plan = pipeline._plan_rerank(_scored([0.9, 0.5] + [0.4] * 18), rerank_top_k=5)
+    assert depth == 0 and plan["skipped"] and plan["pairs_saved"] == 20
+
+    depth, plan = pipeline._plan_rerank(_scored([0.5] * 20), rerank_top_k=5)
+    assert depth == 15 and plan["entropy"] == pytest.approx(1.0)
+
+    depth, _ = pipeline._plan_rerank(_scored([0.8, 0.7, 0.6] + [0.1] * 17), rerank_top_k=5)
+    assert 5 <= depth < 15
+
+    # 未开启时总是重排全部候选
+    assert make_pipeline()._plan_rerank(_scored([0.9, 0.1]), rerank_top_k=5) == (2, None)
+
+
+def test_clear_winner_skips_the_reranker(make_pipeline, corpus):
+    pipeline = make_pipeline(adaptive_rerank=AdaptiveRerankConfig(skip_gap=0.0))
+    pipeline.load_documents(corpus)
+    result = pipeline.query("memory safety in rust", rerank_top_k=2)
+    assert result["pipeline_stats"]["adaptive_rerank"]["skipped"]
+    assert not pipeline.reranker.reranker.calls
+    assert [source["parent_id"] for source in result["sources"]][0] == "rust"
+
+
+# --- 多租户集合与元数据预过滤 ----------------------------------------------------------------
+
+def test_collection_and_metadata_filters(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.add_documents(corpus)
+    assert system.collections() == {"default": 3, "ops": 2}
+    assert set(_ids(system.search("programming language", top_k=10, collection="ops"))) == {"docker", "kafka"}
+    assert set(_ids(system.search("programming language", top_k=10, where={"source": "wiki"}))) == {"python", "pandas"}
+    assert _ids(system.search("python", top_k=10, collection="ops", where={"year": {"$gte": 2023}})) == ["kafka"]
+    assert system.search("python", top_k=10, where={"source": "nowhere"}) == []
+
+
+@pytest.mark.parametrize("index_type", ["exact", "ivf", "int8", "hnsw"])
+def test_prefiltered_and_masked_search_agree(make_retrieval_system, corpus, index_type):
+    if index_type == "hnsw":
+        pytest.importorskip("faiss")
+    system = make_retrieval_system(index_type=index_type)
+    system.add_documents(corpus)
+    where = {"tags": "language"}
+    system.prefilter_max_ratio = 1.0  # 只对过滤出的行精确打分
+    prefiltered = system.search("memory safety", top_k=5, where=where)
+    system.prefilter_max_ratio = 0.0  # 带掩码检索向量索引
+    masked = system.search("memory safety", top_k=5, where=where)
+    assert _ids(prefiltered) == _ids(masked) == ["rust", "python"]
+
+
+def test_collections_are_isolated(make_retrieval_system, corpus):
+    system = make_retrieval_system()
+    system.compaction_threshold = 1.1
+    system.add_documents(corpus)
+    system.upsert_documents([Document(id="python", title="python", content="python in ops", collection="ops")])
+    assert system.collections() == {"default": 3, "ops": 3}
+
+    assert system.delete_collection("ops") == 3
+    assert system.collections() == {"default": 3}
+    assert system.search("python", top_k=10, collection="ops") == []
+    assert "python" in _ids(system.search("python", top_k=10))
+
+
+# --- 按需加载与预热 -------------------------------------------------------------------------
+
+def test_pipeline_construction_loads_no_models(fake_flag_embedding, fake_llm):
+    from rag_pipeline import RAGPipeline
+
+    pipeline = RAGPipeline()
+    assert pipeline.startup_report()["models_loaded"] == {"retrieval": False, "rerank": False}
+
+    report = pipeline.warmup()
+    assert report["models_loaded"] == {"retrieval": True, "rerank": True}
+    assert {f"load_model:{pipeline.retrieval_system.model_path}", "warmup:retrieval", "warmup:rerank"} <= set(report["steps"])
+    # 预热只做一次编码和一次打分，不调用LLM
+    assert pipeline.retrieval_system._model.calls == [["warmup"]]
+    assert len(pipeline.reranker._reranker.calls) == 1
+    assert fake_llm.prompts == []
+
+
+def test_saved_index_loads_before_the_model(tmp_path, fake_flag_embedding, make_retrieval_system, corpus):
+    builder = make_retrieval_system()
+    builder.add_documents(corpus)
+    builder.save_index(str(tmp_path / "index"))
+
+    system = BGERetrievalSystem()
+    system.load_index(str(tmp_path / "index"))
+    assert system._model is None
+    # 首次检索时才加载模型，结果与构建索引的系统一致
+    assert _ids(system.search("memory safety", top_k=2)) == _ids(builder.search("memory safety", top_k=2))
+    assert system._model is not None
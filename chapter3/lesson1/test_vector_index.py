@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""vector_index的离线测试，使用随机生成的聚类向量"""
+
+import numpy as np
+import pytest
+
+from vector_index import (ExactIndex, IVFIndex, MetadataIndex, SparseIndex, create_index, evaluate_recall, search_rows,
+                          _top_k, _top_k_rows)
+
+
+def _normalize(vectors):
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def clustered_vectors(n=2000, dim=32, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    return _normalize(centers[rng.integers(clusters, size=n)] + 0.3 * rng.normal(size=(n, dim)))
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    return clustered_vectors()
+
+
+@pytest.fixture(scope="module")
+def queries(vectors):
+    rng = np.random.default_rng(1)
+    return _normalize(vectors[rng.choice(len(vectors), 50, replace=False)] + 0.1 * rng.normal(size=(50, 32)))
+
+
+# --- 近似近邻索引 ---------------------------------------------------------------------
+
+def test_exact_index_matches_brute_force(vectors, queries):
+    index = ExactIndex(max_block_elements=len(vectors) * 7)  # 强制分块计算
+    index.build(vectors)
+    for (rows, scores), query in zip(index.search(queries, 10), queries):
+        expected = np.argsort(-(vectors @ query), kind="stable")[:10]
+        assert set(rows) == set(expected)
+        assert np.all(np.diff(scores) <= 0)
+
+
+def test_ivf_recall(vectors, queries):
+    index = IVFIndex(n_lists=32, nprobe=32)
+    index.build(vectors)
+    assert evaluate_recall(index, vectors, queries, 10)["recall@10"] == 1.0
+
+    index.nprobe = 4
+    assert evaluate_recall(index, vectors, queries, 10)["recall@10"] >= 0.8
+
+
+
+def test_ivf_builds_an_empty_index(vectors, queries):
+    index = IVFIndex()
+    index.build(vectors[:0])
+    assert index.centroids is None
+    assert [rows.size for rows, _ in index.search(queries[:3], 10)] == [0, 0, 0]
+
+    grown = index.add(vectors, 0)  # 首次添加数据时训练
+    assert grown.search(vectors[:1], 1)[0][0][0] == 0
+
+@pytest.mark.parametrize("index_type", ["exact", "ivf", "int8", "binary"])
+def test_add_returns_new_index_and_keeps_the_old_one(vectors, index_type):
+    n = len(vectors) // 2
+    old = create_index(index_type)
+    old.build(vectors[:n])
+    new = old.add(vectors, n)
+    assert new is not old
+
+    query = vectors[n + 10]
+    new_rows, _ = new.search(query[None], 1)[0]
+    assert new_rows[0] == n + 10
+    # 旧对象仍只包含前n行，并发检索持有的旧快照与旧矩阵一致
+    old_rows, _ = old.search(query[None], 5)[0]
+    assert np.all(old_rows < n)
+
+
+@pytest.mark.parametrize("index_type", ["exact", "ivf", "int8", "binary", "hnsw"])
+def test_allowed_mask_is_respected(vectors, queries, index_type):
+    if index_type == "hnsw":
+        pytest.importorskip("faiss")
+    index = create_index(index_type)
+    index.build(vectors)
+    allowed = np.zeros(len(vectors), dtype=bool)
+    allowed[::3] = True
+    for rows, _ in index.search(queries, 10, allowed):
+        assert len(rows) and np.all(allowed[rows])
+
+
+def test_hnsw_recall(vectors, queries):
+    pytest.importorskip("faiss")
+    index = create_index("hnsw", ef_search=128)
+    index.build(vectors)
+    assert evaluate_recall(index, vectors, queries, 10)["recall@10"] >= 0.9
+
+
+@pytest.mark.parametrize("step,min_recall", [(50, 1.0), (3, 0.9)])
+def test_hnsw_filtered_search(vectors, queries, step, min_recall):
+    # 2%的行（选择性很强的租户过滤）走精确打分，33%的行由faiss位图选择器在图遍历中过滤
+    pytest.importorskip("faiss")
+    index = create_index("hnsw", ef_search=128)
+    index.build(vectors)
+    allowed = np.zeros(len(vectors), dtype=bool)
+    allowed[::step] = True
+    expected = search_rows(vectors, queries, np.flatnonzero(allowed), 10)
+    found = 0
+    for (rows, scores), (exact_rows, _) in zip(index.search(queries, 10, allowed), expected):
+        assert len(rows) == 10 and np.all(allowed[rows])
+        assert np.all(np.diff(scores) <= 1e-6)
+        found += len(set(rows) & set(exact_rows))
+    assert found / (10 * len(queries)) >= min_recall
+
+    assert [rows.size for rows, _ in index.search(queries[:2], 10, np.zeros(len(vectors), dtype=bool))] == [0, 0]
+
+
+def test_unknown_index_type():
+    with pytest.raises(ValueError):
+        create_index("annoy")
+
+
+# --- top-k选择 ---------------------------------------------------------------------------
+
+def test_top_k_is_sorted_and_clamped():
+    scores = np.array([0.1, 0.9, 0.5, 0.7, 0.3], dtype=np.float32)
+    assert _top_k(scores, 3).tolist() == [1, 3, 2]
+    assert _top_k(scores, 10).tolist() == [1, 3, 2, 4, 0]
+    assert _top_k(scores, 0).size == 0
+    assert _top_k_rows(np.stack([scores, -scores]), 2).tolist() == [[1, 3], [0, 4]]
+
+
+# --- 稀疏倒排索引 -------------------------------------------------------------------------
+
+def test_sparse_index_scores_shared_terms():
+    index = SparseIndex()
+    index.build([{"a": 1.0, "b": 0.5}, {"b": 1.0}, {"c": 2.0}])
+    rows, scores = index.search([{"a": 1.0, "b": 1.0}], 10)[0]
+    assert rows.tolist() == [0, 1]
+    assert scores.tolist() == pytest.approx([1.5, 1.0])
+    assert index.search([{"zzz": 1.0}], 10)[0][0].size == 0
+
+    allowed = np.array([False, True, True])
+    assert index.search([{"a": 1.0, "b": 1.0}], 10, allowed)[0][0].tolist() == [1]
+
+
+def test_sparse_add_returns_new_index():
+    old = SparseIndex()
+    old.build([{"a": 1.0}])
+    new = old.add([{"a": 2.0}], 1)
+    assert new.search([{"a": 1.0}], 10)[0][0].tolist() == [1, 0]
+    assert old.search([{"a": 1.0}], 10)[0][0].tolist() == [0]
+    assert (old.num_rows, new.num_rows) == (1, 2)
+
+
+# --- 量化索引 ----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("index_type,min_recall,compression", [("int8", 0.95, 4), ("binary", 0.7, 32)])
+def test_quantized_recall_and_memory(vectors, queries, index_type, min_recall, compression):
+    index = create_index(index_type)
+    index.build(vectors)
+    report = evaluate_recall(index, vectors, queries, 10)
+    assert report["recall@10"] >= min_recall
+    assert report["code_bytes"] * compression == report["float_bytes"]
+
+
+def test_quantized_index_rescores_from_memmap(tmp_path, vectors, queries):
+    path = tmp_path / "embeddings.bin"
+    vectors.tofile(path)
+    mapped = np.memmap(path, dtype=np.float32, mode="r", shape=vectors.shape)
+    index = create_index("int8", block_size=256)
+    index.build(mapped)
+
+    exact = ExactIndex()
+    exact.build(vectors)
+    for query, (rows, scores), (exact_rows, _) in zip(queries, index.search(queries, 1), exact.search(queries, 1)):
+        assert rows[0] == exact_rows[0]
+        # 第二阶段使用浮点向量重打分，分数是精确内积
+        assert scores[0] == pytest.approx(float(vectors[rows[0]] @ query), abs=1e-5)
+
+
+# --- 元数据位图索引 -------------------------------------------------------------------------
+
+@pytest.fixture
+def metadata_index():
+    index = MetadataIndex()
+    index.build([
+        {"source": "wiki", "year": 2023, "tags": ["a", "b"]},
+        {"source": "faq", "year": 2024, "tags": ["b"]},
+        None,  # 已删除的行
+        {"source": "blog", "year": "unknown"},
+    ])
+    return index
+
+
+@pytest.mark.parametrize("where,rows", [
+    ({"source": "wiki"}, [0]),
+    ({"source": {"$in": ["wiki", "blog"]}}, [0, 3]),
+    ({"source": {"$nin": ["wiki"]}}, [1, 3]),
+    ({"source": {"$ne": "faq"}}, [0, 3]),
+    ({"year": {"$gte": 2023, "$lt": 2024}}, [0]),
+    ({"year": {"$gt": 2000}}, [0, 1]),  # 类型不可比的取值视为不匹配
+    ({"tags": "b"}, [0, 1]),
+    ({"tags": {"$exists": False}}, [3]),
+    ({"$or": [{"source": "faq"}, {"tags": "a"}]}, [0, 1]),
+    ({"$and": [{"tags": "b"}, {"$not": {"source": "wiki"}}]}, [1]),
+])
+def test_metadata_filters(metadata_index, where, rows):
+    mask = metadata_index.mask(where)
+    assert np.flatnonzero(mask).tolist() == rows
+    assert not mask.flags.writeable
+    assert metadata_index.mask(where) is mask  # 同一条件命中掩码缓存
+
+
+def test_metadata_filter_rejects_unknown_operators(metadata_index):
+    with pytest.raises(ValueError):
+        metadata_index.mask({"year": {"$regex": "20"}})
+    with pytest.raises(ValueError):
+        metadata_index.mask({"$xor": []})
+    assert MetadataIndex.canonical({"b": 1, "a": 2}) == MetadataIndex.canonical({"a": 2, "b": 1})
@@ -0,0 +1,781 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+向量索引后端
+
+为BGERetrievalSystem提供可插拔的近邻检索实现：
+1. ExactIndex: 暴力内积检索，作为精确基线和兜底方案
+2. IVFIndex: 基于NumPy的倒排文件索引（k-means聚类 + nprobe探测），无额外依赖
+3. HNSWIndex: 基于faiss的HNSW图索引（可选依赖 faiss-cpu）
+4. Int8Index / BinaryIndex: 量化向量扫描 + 浮点重打分的两阶段检索
+
+所有索引都假设向量已归一化，使用内积作为相似度。
+MetadataIndex为元数据过滤表达式预先计算行位图，在打分前缩小候选行。
+"""
+
+import copy
+import json
+import time
+import logging
+import operator
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, Optional, Dict, Any
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 单次搜索结果：(行号数组, 分数数组)，按分数降序
+SearchHits = Tuple[np.ndarray, np.ndarray]
+
+# 每个uint8取值的置位数，用于NumPy<2.0时计算汉明距离
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _require_faiss() -> Any:
+    """按需导入faiss，只有使用HNSW索引的进程才承担其导入开销"""
+    try:
+        import faiss
+    except ImportError as e:
+        raise ImportError("HNSW索引需要faiss，请安装: pip install faiss-cpu") from e
+    return faiss
+
+
+def _popcount(bits: np.ndarray) -> np.ndarray:
+    """逐元素统计uint8数组中置位的比特数"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bits)
+    return _POPCOUNT_TABLE[bits]
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """返回分数最高的k个位置，按分数降序
+
+    先用argpartition在O(N)内选出k个候选，再只对这k个结果排序。
+    """
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < scores.shape[0]:
+        top = np.argpartition(scores, -k)[-k:]
+    else:
+        top = np.arange(scores.shape[0])
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def _top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """对分数矩阵的每一行执行_top_k，返回形状为 (n_rows, k) 的列号矩阵"""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    # 逐行argpartition比在二维矩阵上沿axis=1划分更快，且无需整体取负
+    return np.stack([_top_k(row, k) for row in scores])
+
+
+class VectorIndex:
+    """向量索引基类"""
+
+    name = "base"
+
+    def build(self, embeddings: np.ndarray):
+        """基于完整向量矩阵构建索引"""
+        raise NotImplementedError
+
+    def add(self, embeddings: np.ndarray, start_row: int) -> "VectorIndex":
+        """
+        增量追加向量，返回包含新行的新索引对象
+
+        原索引保持不变，并发检索持有的旧对象仍与其行数一致；
+        调用方构建完成后再替换引用。
+
+        Args:
+            embeddings: 完整向量矩阵（包含新追加的行）
+            start_row: 新行的起始行号
+        """
+        index = copy.copy(self)
+        index.build(embeddings)
+        return index
+
+    def search(self, queries: np.ndarray, top_k: int,
+               allowed: Optional[np.ndarray] = None) -> List[SearchHits]:
+        """
+        检索每个查询向量的top_k近邻
+
+        Args:
+            queries: 查询向量矩阵，形状 (n_queries, dim)
+            top_k: 每个查询返回的结果数
+            allowed: 可选的行掩码（布尔数组），False的行不会出现在结果中
+
+        Returns:
+            每个查询对应的 (行号数组, 分数数组)
+        """
+        raise NotImplementedError
+
+
+class ExactIndex(VectorIndex):
+    """暴力内积检索，结果精确"""
+
+    name = "exact"
+
+    def __init__(self, max_block_elements: int = 16 * 1024 * 1024):
+        """
+        Args:
+            max_block_elements: 单次矩阵乘法产生的分数矩阵元素上限，
+                                查询较多时按块计算以限制峰值内存
+        """
+        self.max_block_elements = max_block_elements
+        self.embeddings: Optional[np.ndarray] = None
+
+    def build(self, embeddings: np.ndarray):
+        self.embeddings = embeddings
+
+    def add(self, embeddings: np.ndarray, start_row: int) -> "ExactIndex":
+        index = copy.copy(self)
+        index.embeddings = embeddings
+        return index
+
+    def search(self, queries: np.ndarray, top_k: int,
+               allowed: Optional[np.ndarray] = None) -> List[SearchHits]:
+        queries = np.atleast_2d(queries)
+        block = max(1, self.max_block_elements // max(self.embeddings.shape[0], 1))
+        results = []
+        # 每个查询块只做一次矩阵乘法，得到 (block, N) 的分数矩阵
+        for start in range(0, queries.shape[0], block):
+            scores = queries[start:start + block] @ self.embeddings.T
+            if allowed is not None:
+                scores[:, ~allowed] = -np.inf
+            top = _top_k_rows(scores, top_k)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            for rows, row_scores in zip(top, top_scores):
+                keep = np.isfinite(row_scores)
+                results.append((rows[keep], row_scores[keep]))
+        return results
+
+
+class IVFIndex(VectorIndex):
+    """
+    倒排文件索引（IVF-Flat）
+
+    训练阶段用球面k-means把向量划分为n_lists个簇；查询时只扫描
+    与查询最相似的nprobe个簇中的向量。nprobe越大召回越高、延迟越大。
+    """
+
+    name = "ivf"
+
+    def __init__(self, n_lists: Optional[int] = None, nprobe: int = 8,
+                 train_iters: int = 10, max_train_points: int = 100000, seed: int = 42):
+        """
+        Args:
+            n_lists: 聚类中心数量，默认取 4*sqrt(N)
+            nprobe: 查询时探测的簇数量（召回/延迟调节旋钮）
+            train_iters: k-means迭代次数
+            max_train_points: 参与训练的最大采样点数
+            seed: 随机种子
+        """
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.train_iters = train_iters
+        self.max_train_points = max_train_points
+        self.seed = seed
+        self.embeddings: Optional[np.ndarray] = None
+        self.centroids: Optional[np.ndarray] = None
+        self.lists: List[np.ndarray] = []
+
+    def _assign(self, vectors: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        """分块计算每个向量所属的簇，避免一次性生成 N x n_lists 的矩阵"""
+        assignments = np.empty(vectors.shape[0], dtype=np.int64)
+        for start in range(0, vectors.shape[0], block_size):
+            block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+            assignments[start:start + block_size] = np.argmax(block @ self.centroids.T, axis=1)
+        return assignments
+
+    def _train(self, embeddings: np.ndarray):
+        """球面k-means训练聚类中心"""
+        n = embeddings.shape[0]
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(n)))
+        n_lists = min(n_lists, n)
+        rng = np.random.default_rng(self.seed)
+
+        sample_size = min(n, self.max_train_points)
+        sample = np.asarray(embeddings[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+        for _ in range(self.train_iters):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            # 空簇保留原中心
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty]
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            centroids = centroids / np.maximum(norms, 1e-12)
+
+        self.centroids = centroids
+
+    def _build_lists(self, assignments: np.ndarray, offset: int = 0):
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        new_lists = [order[bounds[i]:bounds[i + 1]] + offset for i in range(len(self.centroids))]
+        if offset and self.lists:
+            # 新建列表而非原地拼接，旧索引对象的倒排表保持不变
+            self.lists = [np.concatenate([old, new]) for old, new in zip(self.lists, new_lists)]
+        else:
+            self.lists = new_lists
+
+    def build(self, embeddings: np.ndarray):
+        start_time = time.time()
+        self.embeddings = embeddings
+        if embeddings.shape[0] == 0:
+            # 空索引没有可训练的数据：不建簇，检索返回空结果，首次add时再训练
+            self.centroids = None
+            self.lists = []
+            return
+        self._train(embeddings)
+        self._build_lists(self._assign(embeddings))
+        logger.info(f"IVF index built: {embeddings.shape[0]} vectors, {len(self.centroids)} lists "
+                    f"in {time.time() - start_time:.2f}s")
+
+    def add(self, embeddings: np.ndarray, start_row: int) -> "IVFIndex":
+        # 复用已训练的聚类中心，只为新行分配簇
+        index = copy.copy(self)
+        if self.centroids is None:
+            index.build(embeddings)
+            return index
+        index.embeddings = embeddings
+        index._build_lists(index._assign(embeddings[start_row:]), offset=start_row)
+        return index
+
+    def search(self, queries: np.ndarray, top_k: int,
+               allowed: Optional[np.ndarray] = None) -> List[SearchHits]:
+        queries = np.atleast_2d(queries)
+        if self.centroids is None:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+        nprobe = min(self.nprobe, len(self.centroids))
+        # 所有查询与聚类中心的相似度一次性计算
+        probes = _top_k_rows(queries @ self.centroids.T, nprobe)
+        results = []
+        for query, probe in zip(queries, probes):
+            candidates = np.concatenate([self.lists[i] for i in probe])
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+            if candidates.size == 0:
+                results.append((candidates, np.empty(0, dtype=np.float32)))
+                continue
+            # 按行号排序后读取，提升memmap场景下的访问局部性
+            candidates = np.sort(candidates)
+            scores = np.dot(self.embeddings[candidates], query)
+            top = _top_k(scores, top_k)
+            results.append((candidates[top], scores[top]))
+        return results
+
+
+class HNSWIndex(VectorIndex):
+    """
+    基于faiss的HNSW图索引（需安装 faiss-cpu）
+
+    ef_search越大召回越高、延迟越大。带掩码检索时，允许的行占比不超过
+    exact_filter_ratio则直接对这些行精确打分；否则把掩码作为位图选择器
+    交给faiss，在图遍历过程中过滤。
+    """
+
+    name = "hnsw"
+
+    def __init__(self, m: int = 32, ef_construction: int = 200, ef_search: int = 64,
+                 exact_filter_ratio: float = 0.05):
+        self._faiss = _require_faiss()
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.exact_filter_ratio = exact_filter_ratio
+        self.index = None
+        # 复制图结构（clone_index）与其他线程的复制互斥
+        self._lock = threading.Lock()
+
+    def build(self, embeddings: np.ndarray):
+        start_time = time.time()
+        self.index = self._faiss.IndexHNSWFlat(embeddings.shape[1], self.m, self._faiss.METRIC_INNER_PRODUCT)
+        self.index.hnsw.efConstruction = self.ef_construction
+        self.index.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+        logger.info(f"HNSW index built: {embeddings.shape[0]} vectors in {time.time() - start_time:.2f}s")
+
+    def add(self, embeddings: np.ndarray, start_row: int) -> "HNSWIndex":
+        # faiss只能原地追加，先复制图结构再追加，旧对象继续服务并发检索
+        index = copy.copy(self)
+        index._lock = threading.Lock()
+        if self.index is None:
+            index.build(embeddings)
+            return index
+        with self._lock:
+            index.index = self._faiss.clone_index(self.index)
+        index.index.add(np.ascontiguousarray(embeddings[start_row:], dtype=np.float32))
+        return index
+
+    def search(self, queries: np.ndarray, top_k: int,
+               allowed: Optional[np.ndarray] = None) -> List[SearchHits]:
+        queries = np.ascontiguousarray(np.atleast_2d(queries), dtype=np.float32)
+        faiss = self._faiss
+        fetch_k = min(top_k, self.index.ntotal)
+        # efSearch通过单次检索参数传入，不修改共享的索引对象
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = max(self.ef_search, fetch_k)
+        if allowed is not None:
+            allowed = allowed[:self.index.ntotal]
+            allowed_count = int(np.count_nonzero(allowed))
+            if allowed_count <= self.exact_filter_ratio * self.index.ntotal:
+                # 选择性很强的过滤在图上难以找满top_k，只取出允许的行精确打分
+                rows = np.flatnonzero(allowed)
+                vectors = self.index.reconstruct_batch(rows) if rows.size else np.empty((0, self.index.d), np.float32)
+                return [(rows[hit_rows], hit_scores)
+                        for hit_rows, hit_scores in search_rows(vectors, queries, np.arange(rows.size), top_k)]
+            fetch_k = min(fetch_k, allowed_count)
+            # 掩码按位打包后交给faiss，图遍历时只返回允许的行，无需扩大检索量再后过滤
+            bitmap = np.packbits(allowed, bitorder="little")
+            selector = faiss.IDSelectorBitmap(self.index.ntotal, faiss.swig_ptr(bitmap))
+            params.sel = selector
+        if fetch_k <= 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+        scores, indices = self.index.search(queries, fetch_k, params=params)
+
+        results = []
+        for row_scores, row_indices in zip(scores, indices):
+            keep = row_indices >= 0
+            results.append((row_indices[keep], row_scores[keep]))
+        return results
+
+
+class QuantizedIndex(VectorIndex):
+    """
+    量化向量索引基类：两阶段检索
+
+    第一阶段在量化编码上全量扫描，选出 top_k * rescore_factor 个候选；
+    第二阶段从浮点向量矩阵中只读取这些候选行做精确内积重打分。
+    浮点矩阵可以是np.memmap，此时常驻内存的只有量化编码。
+    """
+
+    def __init__(self, rescore_factor: int = 4, block_size: int = 65536,
+                 max_block_elements: int = 16 * 1024 * 1024):
+        """
+        Args:
+            rescore_factor: 候选集大小相对top_k的倍数（召回/延迟调节旋钮）
+            block_size: 第一阶段每次扫描的行数，用于限制临时内存
+            max_block_elements: 近似分数矩阵的元素上限，查询较多时分组扫描
+        """
+        self.rescore_factor = rescore_factor
+        self.block_size = block_size
+        self.max_block_elements = max_block_elements
+        self.embeddings: Optional[np.ndarray] = None
+        self.codes: Optional[np.ndarray] = None
+
+    def _fit(self, embeddings: np.ndarray):
+        """根据完整向量矩阵确定量化参数"""
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        """把浮点向量编码为量化表示"""
+        raise NotImplementedError
+
+    def _scan(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """在一块量化编码上计算近似分数，返回形状 (n_queries, n_codes)"""
+        raise NotImplementedError
+
+    def _encode_blocks(self, vectors: np.ndarray) -> np.ndarray:
+        return np.concatenate([
+            self._encode(np.asarray(vectors[start:start + self.block_size], dtype=np.float32))
+            for start in range(0, vectors.shape[0], self.block_size)
+        ]) if vectors.shape[0] else self._encode(np.empty((0, vectors.shape[1]), dtype=np.float32))
+
+    def build(self, embeddings: np.ndarray):
+        start_time = time.time()
+        self.embeddings = embeddings
+        self._fit(embeddings)
+        self.codes = self._encode_blocks(embeddings)
+        logger.info(f"{self.name} index built: {embeddings.shape[0]} vectors, "
+                    f"{self.memory_bytes() / 1024 / 1024:.1f} MB codes in {time.time() - start_time:.2f}s")
+
+    def add(self, embeddings: np.ndarray, start_row: int) -> "QuantizedIndex":
+        # 沿用已有的量化参数，只编码新行
+        index = copy.copy(self)
+        if self.codes is None:
+            index.build(embeddings)
+            return index
+        index.embeddings = embeddings
+        index.codes = np.concatenate([self.codes[:start_row], self._encode_blocks(embeddings[start_row:])])
+        return index
+
+    def memory_bytes(self) -> int:
+        """量化编码占用的内存字节数"""
+        return int(self.codes.nbytes) if self.codes is not None else 0
+
+    def search(self, queries: np.ndarray, top_k: int,
+               allowed: Optional[np.ndarray] = None) -> List[SearchHits]:
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        shortlist_k = max(top_k, top_k * self.rescore_factor)
+        n = self.codes.shape[0]
+        group = max(1, self.max_block_elements // max(n, 1))
+        results = []
+        for group_start in range(0, queries.shape[0], group):
+            group_queries = queries[group_start:group_start + group]
+            # 第一阶段：量化编码全量扫描，每块编码只解码一次，供组内所有查询共用
+            approx = np.empty((group_queries.shape[0], n), dtype=np.float32)
+            for start in range(0, n, self.block_size):
+                approx[:, start:start + self.block_size] = self._scan(self.codes[start:start + self.block_size],
+                                                                      group_queries)
+            if allowed is not None:
+                approx[:, ~allowed] = -np.inf
+
+            for query, row_scores in zip(group_queries, approx):
+                candidates = _top_k(row_scores, shortlist_k)
+                candidates = candidates[np.isfinite(row_scores[candidates])]
+                if candidates.size == 0:
+                    results.append((candidates, np.empty(0, dtype=np.float32)))
+                    continue
+
+                # 第二阶段：按行号排序后读取浮点向量精确重打分，提升memmap访问局部性
+                candidates = np.sort(candidates)
+                scores = np.asarray(self.embeddings[candidates], dtype=np.float32) @ query
+                top = _top_k(scores, top_k)
+                results.append((candidates[top], scores[top]))
+        return results
+
+
+class Int8Index(QuantizedIndex):
+    """逐维对称int8标量量化，内存为float32的1/4"""
+
+    name = "int8"
+
+    def __init__(self, rescore_factor: int = 4, block_size: int = 65536,
+                 max_block_elements: int = 16 * 1024 * 1024):
+        super().__init__(rescore_factor, block_size, max_block_elements)
+        self.scale: Optional[np.ndarray] = None
+
+    def _fit(self, embeddings: np.ndarray):
+        max_abs = np.zeros(embeddings.shape[1], dtype=np.float32)
+        for start in range(0, embeddings.shape[0], self.block_size):
+            block = np.abs(np.asarray(embeddings[start:start + self.block_size], dtype=np.float32))
+            max_abs = np.maximum(max_abs, block.max(axis=0))
+        self.scale = np.maximum(max_abs, 1e-12) / 127.0
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def _scan(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        # 把缩放系数并入查询向量：x·q ≈ codes·(scale*q)
+        return (queries * self.scale) @ codes.astype(np.float32).T
+
+
+class BinaryIndex(QuantizedIndex):
+    """符号位二值量化，内存为float32的1/32，以汉明距离近似内积"""
+
+    name = "binary"
+
+    def __init__(self, rescore_factor: int = 10, block_size: int = 65536,
+                 max_block_elements: int = 16 * 1024 * 1024):
+        super().__init__(rescore_factor, block_size, max_block_elements)
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.packbits(vectors > 0, axis=1)
+
+    def _scan(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        query_bits = np.packbits(queries > 0, axis=1)
+        hamming = np.stack([_popcount(codes ^ bits).sum(axis=1, dtype=np.int32) for bits in query_bits])
+        # 汉明距离越小越相似，取负数使分数越大越相似
+        return -hamming.astype(np.float32)
+
+
+class SparseIndex:
+    """
+    稀疏向量倒排索引
+
+    存储BGE-m3的词项权重（lexical weights）：词项ID -> 倒排表（行号数组, 权重数组）。
+    查询时只扫描查询词项对应的倒排表，打分为共享词项的权重乘积之和。
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.num_rows = 0
+
+    @staticmethod
+    def _collect(weights: List[Dict[str, float]], start_row: int) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        rows: Dict[str, List[int]] = {}
+        values: Dict[str, List[float]] = {}
+        for offset, row_weights in enumerate(weights):
+            for term, weight in row_weights.items():
+                rows.setdefault(term, []).append(start_row + offset)
+                values.setdefault(term, []).append(weight)
+        return {
+            term: (np.array(rows[term], dtype=np.int64), np.array(values[term], dtype=np.float32))
+            for term in rows
+        }
+
+    def build(self, weights: List[Dict[str, float]]):
+        """基于每行的词项权重构建倒排索引"""
+        start_time = time.time()
+        self.postings = self._collect(weights, 0)
+        self.num_rows = len(weights)
+        logger.info(f"Sparse index built: {self.num_rows} rows, {len(self.postings)} terms "
+                    f"in {time.time() - start_time:.2f}s")
+
+    def add(self, weights: List[Dict[str, float]], start_row: int) -> "SparseIndex":
+        """追加新行的词项权重，返回新的索引对象，原对象保持不变"""
+        postings = dict(self.postings)
+        for term, (rows, values) in self._collect(weights, start_row).items():
+            if term in postings:
+                old_rows, old_values = postings[term]
+                postings[term] = (np.concatenate([old_rows, rows]), np.concatenate([old_values, values]))
+            else:
+                postings[term] = (rows, values)
+        index = SparseIndex()
+        index.postings = postings
+        index.num_rows = start_row + len(weights)
+        return index
+
+    def search(self, queries: List[Dict[str, float]], top_k: int,
+               allowed: Optional[np.ndarray] = None) -> List[SearchHits]:
+        """
+        检索每个查询词项权重的top_k匹配行
+
+        Args:
+            queries: 每个查询的词项权重
+            top_k: 每个查询返回的结果数
+            allowed: 可选的行掩码
+
+        Returns:
+            每个查询对应的 (行号数组, 分数数组)
+        """
+        postings = self.postings
+        results = []
+        for query_weights in queries:
+            row_parts, score_parts = [], []
+            for term, query_weight in query_weights.items():
+                if term in postings:
+                    rows, values = postings[term]
+                    row_parts.append(rows)
+                    score_parts.append(values * query_weight)
+            if not row_parts:
+                results.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)))
+                continue
+
+            rows = np.concatenate(row_parts)
+            partial_scores = np.concatenate(score_parts)
+            if allowed is not None:
+                keep = allowed[rows]
+                rows, partial_scores = rows[keep], partial_scores[keep]
+            # 按行号聚合各词项的得分
+            unique_rows, inverse = np.unique(rows, return_inverse=True)
+            scores = np.bincount(inverse, weights=partial_scores).astype(np.float32)
+            top = _top_k(scores, top_k)
+            results.append((unique_rows[top], scores[top]))
+        return results
+
+
+def search_rows(embeddings: np.ndarray, queries: np.ndarray, rows: np.ndarray,
+                top_k: int) -> List[SearchHits]:
+    """
+    只对给定行做精确内积检索
+
+    元数据过滤后候选行很少时，直接取出这些行的向量打分，
+    比在全量索引上带掩码检索访问的数据少得多，且结果精确。
+    """
+    queries = np.atleast_2d(queries).astype(np.float32)
+    if rows.size == 0:
+        return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+    # 对memmap做花式索引只会读取这些行
+    scores = queries @ np.asarray(embeddings[rows], dtype=np.float32).T
+    top = _top_k_rows(scores, top_k)
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    return [(rows[cols], row_scores) for cols, row_scores in zip(top, top_scores)]
+
+
+class MetadataIndex:
+    """
+    元数据位图索引
+
+    为每个 (字段, 取值) 维护行号数组，过滤表达式在检索前被求值为布尔行掩码，
+    作为allowed传给向量索引和稀疏倒排索引。同一过滤条件的掩码会被缓存，
+    多租户场景下重复的租户过滤无需重新求值。
+
+    过滤表达式采用类Mongo的字典语法：
+        {"tenant": "acme"}                                  等值
+        {"source": {"$in": ["wiki", "faq"]}}                集合
+        {"date": {"$gte": "2024-01-01", "$lt": "2025-01-01"}} 范围
+        {"$or": [{...}, {...}]} / {"$and": [...]} / {"$not": {...}}
+    取值为列表的字段（如标签）对其中每个元素建立倒排，等值条件表示包含。
+    """
+
+    _COMPARISONS = {"$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+    def __init__(self, cache_size: int = 128):
+        """
+        Args:
+            cache_size: 缓存的过滤掩码数量
+        """
+        self.postings: Dict[str, Dict[Any, np.ndarray]] = {}
+        self.num_rows = 0
+        self.live = np.zeros(0, dtype=bool)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    @staticmethod
+    def canonical(where: Optional[Dict[str, Any]]) -> Optional[str]:
+        """过滤表达式的规范化字符串，用作缓存键"""
+        if not where:
+            return None
+        return json.dumps(where, sort_keys=True, ensure_ascii=False, default=str)
+
+    def build(self, records: List[Optional[Dict[str, Any]]]):
+        """基于每行的元数据构建倒排表，不参与检索的行（如已逻辑删除）传入None"""
+        postings: Dict[str, Dict[Any, List[int]]] = {}
+        self.live = np.array([record is not None for record in records], dtype=bool)
+        for row, record in enumerate(records):
+            if record is None:
+                continue
+            for field_name, value in record.items():
+                values = value if isinstance(value, (list, tuple, set)) else [value]
+                for item in values:
+                    if isinstance(item, (str, int, float, bool)) or item is None:
+                        postings.setdefault(field_name, {}).setdefault(item, []).append(row)
+        self.postings = {
+            field_name: {value: np.array(rows, dtype=np.int64) for value, rows in values.items()}
+            for field_name, values in postings.items()
+        }
+        self.num_rows = len(records)
+        with self._cache_lock:
+            self._cache.clear()
+
+    def mask(self, where: Dict[str, Any]) -> np.ndarray:
+        """
+        求值过滤表达式，返回只读的布尔行掩码
+
+        Raises:
+            ValueError: 表达式包含不支持的操作符
+        """
+        key = self.canonical(where)
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        # 取反类条件（$ne/$nin/$not）不能选中不参与检索的行
+        mask = self._evaluate(where) & self.live
+        mask.flags.writeable = False
+        with self._cache_lock:
+            self._cache[key] = mask
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return mask
+
+    def _rows_mask(self, row_arrays: List[np.ndarray]) -> np.ndarray:
+        mask = np.zeros(self.num_rows, dtype=bool)
+        for rows in row_arrays:
+            mask[rows] = True
+        return mask
+
+    def _evaluate(self, where: Dict[str, Any]) -> np.ndarray:
+        mask = np.ones(self.num_rows, dtype=bool)
+        for key, condition in where.items():
+            if key == "$and":
+                for sub in condition:
+                    mask &= self._evaluate(sub)
+            elif key == "$or":
+                any_mask = np.zeros(self.num_rows, dtype=bool)
+                for sub in condition:
+                    any_mask |= self._evaluate(sub)
+                mask &= any_mask
+            elif key == "$not":
+                mask &= ~self._evaluate(condition)
+            elif key.startswith("$"):
+                raise ValueError(f"不支持的过滤操作符: {key}")
+            else:
+                if not isinstance(condition, dict):
+                    condition = {"$eq": condition}
+                for op, operand in condition.items():
+                    mask &= self._field_mask(key, op, operand)
+        return mask
+
+    def _field_mask(self, field_name: str, op: str, operand: Any) -> np.ndarray:
+        values = self.postings.get(field_name, {})
+        if op in ("$eq", "$ne"):
+            mask = self._rows_mask([values[operand]] if operand in values else [])
+            return mask if op == "$eq" else ~mask
+        if op in ("$in", "$nin"):
+            mask = self._rows_mask([values[v] for v in operand if v in values])
+            return mask if op == "$in" else ~mask
+        if op == "$exists":
+            mask = self._rows_mask(list(values.values()))
+            return mask if operand else ~mask
+        if op in self._COMPARISONS:
+            compare = self._COMPARISONS[op]
+            matched = []
+            # 对去重后的取值比较，取值数通常远小于行数；类型不可比的取值视为不匹配
+            for value, rows in values.items():
+                try:
+                    if value is not None and compare(value, operand):
+                        matched.append(rows)
+                except TypeError:
+                    continue
+            return self._rows_mask(matched)
+        raise ValueError(f"不支持的过滤操作符: {op}")
+
+
+INDEX_TYPES = {
+    "exact": ExactIndex,
+    "ivf": IVFIndex,
+    "hnsw": HNSWIndex,
+    "int8": Int8Index,
+    "binary": BinaryIndex,
+}
+
+
+def create_index(index_type: str = "exact", **params) -> VectorIndex:
+    """按名称创建向量索引"""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支持的索引类型: {index_type}，可选: {list(INDEX_TYPES)}")
+    return INDEX_TYPES[index_type](**params)
+
+
+def evaluate_recall(index: VectorIndex, embeddings: np.ndarray, queries: np.ndarray,
+                    top_k: int = 10, allowed: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """
+    以暴力检索为基准评估近似索引的recall@k和延迟
+
+    Args:
+        index: 待评估的索引（已构建）
+        embeddings: 完整向量矩阵
+        queries: 查询向量矩阵
+        top_k: 评估的k值
+        allowed: 可选的行掩码
+
+    Returns:
+        包含recall@k和两种检索平均延迟的字典
+    """
+    exact = ExactIndex()
+    exact.build(embeddings)
+
+    start_time = time.time()
+    exact_hits = exact.search(queries, top_k, allowed)
+    exact_time = time.time() - start_time
+
+    start_time = time.time()
+    approx_hits = index.search(queries, top_k, allowed)
+    approx_time = time.time() - start_time
+
+    recalls = []
+    for (exact_rows, _), (approx_rows, _) in zip(exact_hits, approx_hits):
+        if len(exact_rows):
+            recalls.append(len(set(exact_rows.tolist()) & set(approx_rows.tolist())) / len(exact_rows))
+
+    n_queries = max(len(queries), 1)
+    report = {
+        "index_type": index.name,
+        "top_k": top_k,
+        "num_queries": len(queries),
+        f"recall@{top_k}": float(np.mean(recalls)) if recalls else 0.0,
+        "exact_latency_ms": exact_time * 1000 / n_queries,
+        "index_latency_ms": approx_time * 1000 / n_queries,
+    }
+    if isinstance(index, QuantizedIndex):
+        report["float_bytes"] = int(embeddings.shape[0] * embeddings.shape[1] * 4)
+        report["code_bytes"] = index.memory_bytes()
+    return report
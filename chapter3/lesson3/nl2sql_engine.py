@@ -19,13 +19,20 @@ License: MIT
 """
 
 import os
+import re
 import sqlite3
 import json
+import time
+import hashlib
 import logging
-from typing import List, Dict, Any, Optional, Tuple
-from dataclasses import dataclass
+import weakref
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple, Callable
+from dataclasses import dataclass, field
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
 # Conditional imports for LLM providers
 try:
@@ -38,8 +45,33 @@ except ImportError:
 CONFIG = {
     "database": {
         "path": "enterprise_bi.db",
+        "wal": False,                  # True converts the file to WAL mode (persistent, adds -wal/-shm files)
+        "busy_timeout": 5.0,           # seconds to wait on a locked database
+        "statement_cache_size": 128,   # compiled statements kept per connection
+        # Result limits for generated queries; None disables a limit
+        "fetch_chunk_size": 500,       # rows pulled per fetchmany()
+        "max_rows": 10000,
+        "max_result_bytes": 16 * 1024 * 1024,
+        "query_timeout": 30.0,         # seconds before a running statement is interrupted
     },
     "embedding_model": "text-embedding-v4",
+    "embedding": {
+        "backend": "dashscope",      # or "local": deterministic offline stand-in, no API calls
+        "dimensions": 1024,
+        "batch_size": 10,            # texts per embeddings request (DashScope allows up to 10)
+        "cache_dir": ".nl2sql_cache/embeddings",  # None keeps the cache in memory only
+        "cache_size": 4096,          # vectors kept in memory (LRU); the disk cache is not bounded
+    },
+    "query_cache": {
+        "enabled": True,
+        "max_entries": 256,
+        "semantic_threshold": None,  # e.g. 0.95 also reuses answers for near-identical wording
+    },
+    "schema_pruning": {
+        "enabled": True,
+        "max_columns_per_table": 8,  # narrower tables are always sent in full
+        "lexical_weight": 0.2,       # score bonus for columns sharing words with the question
+    },
     "llm": {
         "provider": "dashscope",  # or "openai"
         "api_key_env": "DASHSCOPE_API_KEY", # or "OPENAI_API_KEY"
@@ -129,38 +161,365 @@ class TableSchema:
     name: str
     ddl: str
     description: str
+
+@dataclass
+class ColumnSchema:
+    """A single column parsed from a table's DDL."""
+    table: str
+    name: str
+    definition: str       # DDL text of the column without trailing comma or comment
+    comment: str = ""
+    primary_key: bool = False
+
+@dataclass
+class ForeignKey:
+    """A foreign-key edge `table.column -> ref_table.ref_column`."""
+    table: str
+    column: str
+    ref_table: str
+    ref_column: str
+
+    def join_condition(self) -> str:
+        return f"{self.table}.{self.column} = {self.ref_table}.{self.ref_column}"
     
 @dataclass
 class QueryResult:
-    """Represents the result of a SQL query execution."""
+    """
+    Represents the result of a SQL query execution.
+
+    Rows are stored column-wise: `column_values[i]` holds every value of
+    `columns[i]`. `data` builds the row-dict view on demand.
+    """
     success: bool
-    data: List[Dict[str, Any]]
     sql: str
+    columns: List[str] = field(default_factory=list)
+    column_values: List[List[Any]] = field(default_factory=list)
     error: Optional[str] = None
+    row_count: int = 0
+    truncation_reason: Optional[str] = None  # "max_rows", "max_bytes" or "timeout"
+
+    @property
+    def truncated(self) -> bool:
+        return self.truncation_reason is not None
+
+    @property
+    def data(self) -> List[Dict[str, Any]]:
+        """Row-oriented view of the result, one dict per row."""
+        return [dict(zip(self.columns, values)) for values in zip(*self.column_values)]
 
 # --- Modular Components -----------------------------------------------------
 
+_CONSTRAINT_KEYWORDS = {"FOREIGN", "PRIMARY", "UNIQUE", "CHECK", "CONSTRAINT"}
+_REFERENCES = re.compile(r"REFERENCES\s+[\"`\[]?(\w+)[\"`\]]?\s*\(\s*[\"`\[]?(\w+)", re.IGNORECASE)
+_TABLE_FOREIGN_KEY = re.compile(r"FOREIGN\s+KEY\s*\(\s*[\"`\[]?(\w+)", re.IGNORECASE)
+
+
+def _parse_ddl(table: str, ddl: str) -> Tuple[List[ColumnSchema], List[ForeignKey]]:
+    """
+    Parses a CREATE TABLE statement into columns and foreign keys.
+
+    Expects one column or constraint per line, as in the DDL this module creates;
+    `-- comments` after a column are kept as its description.
+    """
+    columns: List[ColumnSchema] = []
+    foreign_keys: List[ForeignKey] = []
+    if "(" not in ddl:
+        return columns, foreign_keys
+    body = ddl[ddl.index("(") + 1:ddl.rindex(")")]
+    for line in body.split("\n"):
+        definition, _, comment = line.partition("--")
+        definition = definition.strip().rstrip(",").strip()
+        if not definition:
+            continue
+        keyword = definition.split()[0].upper()
+        references = _REFERENCES.search(definition)
+        if keyword in _CONSTRAINT_KEYWORDS:
+            column = _TABLE_FOREIGN_KEY.match(definition)
+            if column and references:
+                foreign_keys.append(ForeignKey(table, column.group(1), references.group(1), references.group(2)))
+            continue
+        name = definition.split()[0].strip('"`[]')
+        if references:
+            foreign_keys.append(ForeignKey(table, name, references.group(1), references.group(2)))
+        columns.append(ColumnSchema(table, name, definition, comment.strip(),
+                                    primary_key="PRIMARY KEY" in definition.upper()))
+    return columns, foreign_keys
+
+
+def _approximate_size(value: Any) -> int:
+    """Rough in-memory size of a SQLite value, for result byte limits."""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return 8
+
+
+class QueryStream:
+    """
+    Iterates over the result of one SQL statement in chunks of row tuples.
+
+    Rows are pulled with `fetchmany(chunk_size)`, so only one chunk is materialized
+    at a time. Iteration stops early and sets `truncation_reason` once `max_rows`
+    rows or about `max_bytes` bytes have been produced. A statement still running
+    after `timeout` seconds is interrupted by a SQLite progress handler: if rows were
+    already produced the stream ends as truncated, otherwise an OperationalError is
+    raised.
+
+    Streams are read-only by default: the connection is switched to
+    `PRAGMA query_only` for the statement, so any write (DML or DDL) fails, and
+    closing rolls back. Pass `read_only=False` to run a write that is committed
+    on a clean close.
+
+    The stream owns the connection's progress handler until it is closed, so only
+    one stream per connection (i.e. per thread) should be open at a time.
+    """
+    PROGRESS_INTERVAL = 1000  # SQLite VM instructions between deadline checks
+
+    def __init__(self, conn: sqlite3.Connection, sql: str,
+                 chunk_size: int = 500,
+                 max_rows: Optional[int] = None,
+                 max_bytes: Optional[int] = None,
+                 timeout: Optional[float] = None,
+                 read_only: bool = True,
+                 on_close: Optional[Callable[["QueryStream"], None]] = None):
+        self.sql = sql
+        self.chunk_size = chunk_size
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.read_only = read_only
+        self.row_count = 0
+        self.byte_count = 0
+        self.truncation_reason: Optional[str] = None
+        self.modified = False
+        self.columns: Optional[List[str]] = None
+        self._conn = conn
+        self._on_close = on_close
+        self._timed_out = False
+        self._deadline = time.monotonic() + timeout if timeout else None
+        self._changes_before = conn.total_changes
+        if self._deadline is not None:
+            conn.set_progress_handler(self._check_deadline, self.PROGRESS_INTERVAL)
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+        try:
+            self._cursor: Optional[sqlite3.Cursor] = conn.execute(sql)
+        except sqlite3.OperationalError:
+            self._cursor = None
+            self._finish(commit=False)
+            if self._timed_out:
+                raise self._timeout_error() from None
+            raise
+        except Exception:
+            self._cursor = None
+            self._finish(commit=False)
+            raise
+        self.columns = [column[0] for column in self._cursor.description or []]
+
+    def _check_deadline(self) -> int:
+        # A non-zero return makes SQLite abort the statement with "interrupted"
+        if time.monotonic() > self._deadline:
+            self._timed_out = True
+            return 1
+        return 0
+
+    def _timeout_error(self) -> sqlite3.OperationalError:
+        return sqlite3.OperationalError(f"Query exceeded the time limit of {self.timeout}s")
+
+    def __iter__(self) -> "QueryStream":
+        return self
+
+    def __next__(self) -> List[tuple]:
+        if self._cursor is None:
+            raise StopIteration
+        try:
+            size = self.chunk_size
+            if self.max_rows is not None:
+                size = min(size, self.max_rows - self.row_count)
+                if size <= 0:
+                    # Only report truncation if there really was another row
+                    if self._cursor.fetchone() is not None:
+                        self.truncation_reason = "max_rows"
+                    self.close()
+                    raise StopIteration
+            rows = self._cursor.fetchmany(size)
+        except sqlite3.OperationalError:
+            if not self._timed_out:
+                self._finish(commit=False)
+                raise
+            if not self.row_count:
+                self._finish(commit=False)
+                raise self._timeout_error() from None
+            self.truncation_reason = "timeout"
+            rows = []
+
+        if self.max_bytes is not None:
+            for i, row in enumerate(rows):
+                self.byte_count += sum(_approximate_size(value) for value in row)
+                if self.byte_count > self.max_bytes:
+                    rows = rows[:i]
+                    self.truncation_reason = "max_bytes"
+                    break
+        self.row_count += len(rows)
+        if self.truncation_reason is not None or not rows:
+            self.close()
+            if not rows:
+                raise StopIteration
+        return rows
+
+    def close(self):
+        """Finalizes the statement; commits a write stream, rolls back a read-only one."""
+        self._finish(commit=not self.read_only)
+
+    def _finish(self, commit: bool):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+        if self._deadline is not None:
+            conn.set_progress_handler(None, 0)
+        if self.read_only:
+            conn.execute("PRAGMA query_only = OFF")
+        # Keep the pooled connection free of open transactions between calls
+        if conn.in_transaction:
+            if commit:
+                conn.commit()
+            else:
+                conn.rollback()
+        # total_changes also counts rolled-back rows, so only a commit can modify
+        self.modified = commit and conn.total_changes != self._changes_before
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def __enter__(self) -> "QueryStream":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._finish(commit=not self.read_only and exc_type is None)
+
+
+class _ConnectionHolder:
+    """Thread-local owner of a pooled connection; freed when its thread exits."""
+    __slots__ = ("conn", "__weakref__")
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+
+def _release_connection(lock: threading.Lock, connections: List[sqlite3.Connection],
+                        conn: sqlite3.Connection):
+    """Removes a pooled connection from the pool and closes it."""
+    with lock:
+        if conn in connections:
+            connections.remove(conn)
+    conn.close()
+
+
 class DBManager:
     """
     Manages all database interactions, including schema creation and querying.
-    In a real app, this would handle connection pooling (e.g., with SQLAlchemy).
+
+    Connections are pooled per thread: each thread lazily opens one connection and
+    reuses it for every query, so concurrent `NL2SQLPipeline.ask` calls never share
+    a connection and never pay the connect cost twice. A connection is closed as
+    soon as its thread exits, so per-request threads do not accumulate open
+    connections. Each connection keeps an LRU
+    of compiled statements (`statement_cache_size`). With `wal=True` the database
+    is switched to WAL mode so readers are not blocked by a writer; the conversion
+    is written into the database file itself and creates `-wal`/`-shm` files next
+    to it, so it is opt-in and the bundled demo database is left unchanged.
+
+    The `sqlite_master` read behind `get_all_schemas` is cached and keyed by SQLite's
+    `PRAGMA schema_version`, which changes on every DDL statement (from any process),
+    so the cache is invalidated exactly when the schema changes.
+
+    Every statement run through `execute_sql` that modifies data bumps the write
+    version of the tables it names (`table_versions`), which is what the pipeline's
+    query cache uses for invalidation. Writers that bypass this class should call
+    `record_write` with the tables they touched.
     """
     def __init__(self, db_config: Dict[str, Any]):
         self.db_path = db_config['path']
+        self.wal = db_config.get('wal', False)
+        self.busy_timeout = db_config.get('busy_timeout', 5.0)
+        self.statement_cache_size = db_config.get('statement_cache_size', 128)
+        self.fetch_chunk_size = db_config.get('fetch_chunk_size', 500)
+        self.max_rows = db_config.get('max_rows')
+        self.max_result_bytes = db_config.get('max_result_bytes')
+        self.query_timeout = db_config.get('query_timeout')
+
+        self._local = threading.local()
+        self._pool_lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._schema_lock = threading.Lock()
+        self._schema_cache: Optional[Tuple[int, List[TableSchema]]] = None
+        self._schema_cache_hits = 0
+        self._schema_cache_misses = 0
+        self._versions_lock = threading.Lock()
+        self._table_versions: Dict[str, int] = {}
+
         logger.info(f"DBManager initialized for database: {self.db_path}")
         self._init_database()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns this thread's pooled connection, opening it on first use."""
+        holder = getattr(self._local, "holder", None)
+        if holder is not None:
+            return holder.conn
+
+        # check_same_thread=False only so that close() and the thread-exit finalizer
+        # can close it; each connection is still used by its owning thread alone.
+        conn = sqlite3.connect(self.db_path,
+                               timeout=self.busy_timeout,
+                               cached_statements=self.statement_cache_size,
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if self.wal:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Durable at checkpoints, avoids an fsync on every commit
+            conn.execute("PRAGMA synchronous=NORMAL")
+        # The holder lives only in this thread's local storage; when the thread exits
+        # it is freed and the finalizer closes the connection
+        holder = _ConnectionHolder(conn)
+        self._local.holder = holder
+        with self._pool_lock:
+            self._connections.append(conn)
+        weakref.finalize(holder, _release_connection, self._pool_lock, self._connections, conn)
+        logger.info(f"Opened pooled connection #{len(self._connections)} "
+                    f"for thread {threading.current_thread().name}")
+        return conn
+
+    def close(self):
+        """Closes all pooled connections. Threads reconnect on their next query."""
+        with self._pool_lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+        logger.info(f"Closed {len(connections)} pooled connections")
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """Returns connection pool and schema cache statistics."""
+        with self._pool_lock:
+            connections = len(self._connections)
+        return {
+            "connections": connections,
+            "schema_cache_hits": self._schema_cache_hits,
+            "schema_cache_misses": self._schema_cache_misses,
+        }
     
     def _init_database(self):
         """Initializes the database and creates the 5-table enterprise schema if not present."""
         logger.info("Initializing database schema...")
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connection()
         cursor = conn.cursor()
         
         # Check if tables already exist
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sales'")
         if cursor.fetchone():
             logger.info("Database schema already exists. Skipping creation.")
-            conn.close()
             return
 
         logger.info("Creating enterprise BI schema (5 tables)...")
@@ -168,7 +527,6 @@ class DBManager:
         self._insert_sample_data(cursor)
         
         conn.commit()
-        conn.close()
         logger.info("Database initialized successfully.")
 
     def _create_enterprise_schema(self, cursor: sqlite3.Cursor):
@@ -425,12 +783,22 @@ class DBManager:
         logger.info("Complex sample data inserted for 10-table scenario.")
     
     def get_all_schemas(self) -> List[TableSchema]:
-        """Retrieves DDL and descriptions for all tables in the database."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")
-        tables = cursor.fetchall()
-        conn.close()
+        """
+        Retrieves DDL and descriptions for all tables in the database.
+
+        The result is cached until `PRAGMA schema_version` changes, i.e. until a
+        CREATE/ALTER/DROP runs against the database.
+        """
+        conn = self._connection()
+        version = self.schema_version()
+        with self._schema_lock:
+            if self._schema_cache is not None and self._schema_cache[0] == version:
+                self._schema_cache_hits += 1
+                return list(self._schema_cache[1])
+
+        tables = conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()
         
         # Enhanced descriptions for complex scenario
         descriptions = {
@@ -446,56 +814,288 @@ class DBManager:
             'promotions': '促销活动表，管理产品和地区的优惠活动信息。'
         }
 
-        return [TableSchema(name=t[0], ddl=t[1], description=descriptions.get(t[0], '')) for t in tables]
+        schemas = [TableSchema(name=t[0], ddl=t[1], description=descriptions.get(t[0], '')) for t in tables]
+        with self._schema_lock:
+            self._schema_cache = (version, schemas)
+            self._schema_cache_misses += 1
+        logger.info(f"Loaded {len(schemas)} table schemas (schema_version={version})")
+        return list(schemas)
+
+    def invalidate_schema_cache(self):
+        """Drops the cached schemas; the next `get_all_schemas` re-reads sqlite_master."""
+        with self._schema_lock:
+            self._schema_cache = None
+
+    def schema_version(self) -> int:
+        """Returns SQLite's schema cookie, which changes on every DDL statement."""
+        return self._connection().execute("PRAGMA schema_version").fetchone()[0]
 
-    def execute_sql(self, sql: str) -> QueryResult:
-        """Executes a given SQL query and returns the result."""
+    def tables_in_sql(self, sql: str) -> List[str]:
+        """
+        Returns the known tables whose names appear as identifiers in `sql`.
+
+        This over-approximates (a column alias named like a table also matches),
+        which only ever causes extra invalidation, never a stale cache hit.
+        """
+        names = {schema.name.lower(): schema.name for schema in self.get_all_schemas()}
+        identifiers = {token.lower() for token in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", sql)}
+        return sorted(names[token] for token in identifiers & names.keys())
+
+    def table_versions(self, tables: List[str]) -> Dict[str, int]:
+        """Returns the current write version of each table (0 if never written)."""
+        with self._versions_lock:
+            return {table: self._table_versions.get(table, 0) for table in tables}
+
+    def record_write(self, tables: List[str]):
+        """Bumps the write version of `tables`, invalidating cached results that read them."""
+        with self._versions_lock:
+            for table in tables:
+                self._table_versions[table] = self._table_versions.get(table, 0) + 1
+        if tables:
+            logger.info(f"Recorded write to tables: {tables}")
+
+    def stream_sql(self, sql: str,
+                   chunk_size: Optional[int] = None,
+                   max_rows: Optional[int] = None,
+                   max_bytes: Optional[int] = None,
+                   timeout: Optional[float] = None,
+                   read_only: bool = True) -> QueryStream:
+        """
+        Starts executing `sql` and returns a QueryStream yielding chunks of row tuples.
+
+        Limits default to the configured `max_rows`, `max_result_bytes` and
+        `query_timeout`. Close the stream (or use it as a context manager) when
+        done if it was not iterated to the end. Writes are rejected unless
+        `read_only=False`.
+        """
+        return QueryStream(self._connection(), sql,
+                           chunk_size=chunk_size or self.fetch_chunk_size,
+                           max_rows=max_rows if max_rows is not None else self.max_rows,
+                           max_bytes=max_bytes if max_bytes is not None else self.max_result_bytes,
+                           timeout=timeout if timeout is not None else self.query_timeout,
+                           read_only=read_only,
+                           on_close=self._after_statement)
+
+    def _after_statement(self, stream: QueryStream):
+        # Committed statements without a result set (DML/DDL) or with changed rows count as writes
+        if not stream.read_only and (stream.modified or stream.columns == []):
+            self.record_write(self.tables_in_sql(stream.sql))
+
+    def execute_sql(self, sql: str,
+                    max_rows: Optional[int] = None,
+                    max_bytes: Optional[int] = None,
+                    timeout: Optional[float] = None,
+                    read_only: bool = True) -> QueryResult:
+        """
+        Executes a given SQL query and returns a columnar result.
+
+        Rows are streamed with `fetchmany` directly into per-column lists, so no
+        per-row dicts are built. The row, byte and time limits of `stream_sql`
+        apply; a truncated result is still successful and has `truncation_reason` set.
+        As with `stream_sql`, writes fail unless `read_only=False`.
+        """
         logger.info(f"Executing SQL: {sql.strip()}")
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                data = [dict(row) for row in rows]
-                logger.info(f"SQL executed successfully, returned {len(data)} rows.")
-                return QueryResult(success=True, data=data, sql=sql)
+            with self.stream_sql(sql, max_rows=max_rows, max_bytes=max_bytes, timeout=timeout,
+                                 read_only=read_only) as stream:
+                column_values: List[List[Any]] = [[] for _ in stream.columns]
+                for chunk in stream:
+                    for values, column in zip(zip(*chunk), column_values):
+                        column.extend(values)
+            if stream.truncation_reason is not None:
+                logger.warning(f"Result truncated ({stream.truncation_reason}) after {stream.row_count} rows")
+            logger.info(f"SQL executed successfully, returned {stream.row_count} rows.")
+            return QueryResult(success=True, sql=sql, columns=stream.columns, column_values=column_values,
+                               row_count=stream.row_count, truncation_reason=stream.truncation_reason)
         except Exception as e:
             logger.error(f"SQL execution failed: {e}", exc_info=True)
-            return QueryResult(success=False, data=[], error=str(e), sql=sql)
+            return QueryResult(success=False, sql=sql, error=str(e))
+
+class LocalEmbedder:
+    """
+    Deterministic, dependency-free stand-in for the embedding API.
+
+    Hashes ASCII words plus CJK character unigrams and bigrams into a fixed-size,
+    L2-normalized vector. It has no real semantic understanding, but identical texts
+    always get identical vectors and texts sharing table or column names score higher,
+    which is enough to run the pipeline offline and in tests.
+    """
+    def __init__(self, dimensions: int = 1024):
+        self.dimensions = dimensions
+
+    @staticmethod
+    def _features(text: str) -> List[str]:
+        text = text.lower()
+        features = re.findall(r"[a-z0-9_]+", text)
+        cjk = re.findall(r"[\u4e00-\u9fff]", text)
+        features.extend(cjk)
+        features.extend(a + b for a, b in zip(cjk, cjk[1:]))
+        return features
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.md5(feature.encode("utf-8")).digest()[:8], "little")
+                vectors[row, digest % self.dimensions] += 1.0 if (digest >> 63) & 1 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+
+class EmbeddingCache:
+    """
+    Embedding cache keyed by a hash of (model, dimensions, text).
+
+    Because the key is the content hash of the exact text that was embedded, a table's
+    cached vector is reused across restarts and only recomputed when its name,
+    description or DDL changes. Up to `max_entries` vectors live in an in-memory LRU
+    and, if `cache_dir` is set, every vector is also kept as one .npy file on disk.
+    """
+    def __init__(self, model_key: str, dimensions: int, cache_dir: Optional[str] = None,
+                 max_entries: int = 4096):
+        self.model_key = model_key
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_key}\0{self.dimensions}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        key = self._key(text)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        if self.cache_dir:
+            path = self.cache_dir / f"{key}.npy"
+            if path.exists():
+                try:
+                    vector = np.load(path)
+                    with self._lock:
+                        self._remember(key, vector)
+                        self.disk_hits += 1
+                    return vector
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Ignoring unreadable embedding cache file {path}: {e}")
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, text: str, vector: np.ndarray):
+        key = self._key(text)
+        with self._lock:
+            self._remember(key, vector)
+        if self.cache_dir:
+            # Write then rename so concurrent readers never see a partial file
+            path = self.cache_dir / f"{key}.npy"
+            tmp_path = self.cache_dir / f"{key}.{threading.get_ident()}.tmp.npy"
+            np.save(tmp_path, vector)
+            os.replace(tmp_path, path)
+
+    def _remember(self, key: str, vector: np.ndarray):
+        # Caller holds self._lock
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "entries": len(self._entries)}
+
 
 class VectorStore:
     """Handles embedding creation and retrieval of relevant schemas using DashScope."""
-    def __init__(self, model_name: str = "text-embedding-v4"):
-        try:
-            if OpenAI is None:
-                raise ImportError("OpenAI package not installed. Please run 'pip install openai'.")
-            self.model_name = model_name
-            self.client = OpenAI(
-                api_key=os.getenv("DASHSCOPE_API_KEY"),
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-            )
-            logger.info(f"VectorStore initialized with DashScope model: {model_name}")
-        except Exception as e:
-            logger.error(f"Failed to initialize DashScope embedding client: {e}", exc_info=True)
-            raise
+    def __init__(self, model_name: str = "text-embedding-v4",
+                 backend: str = "dashscope",
+                 dimensions: int = 1024,
+                 batch_size: int = 10,
+                 cache_dir: Optional[str] = None,
+                 cache_size: int = 4096):
+        """
+        Args:
+            model_name: DashScope embedding model.
+            backend: "dashscope" for the API, or "local" for the deterministic offline embedder.
+            dimensions: Embedding size.
+            batch_size: Texts sent per embeddings request.
+            cache_dir: Optional directory for the persistent embedding cache.
+            cache_size: Maximum number of vectors kept in memory.
+        """
+        self.model_name = model_name
+        self.backend = backend
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+        self.client = None
+        self.local_embedder: Optional[LocalEmbedder] = None
+        if backend == "local":
+            self.local_embedder = LocalEmbedder(dimensions)
+            logger.info(f"VectorStore initialized with local deterministic embedder ({dimensions} dims)")
+        elif backend == "dashscope":
+            try:
+                if OpenAI is None:
+                    raise ImportError("OpenAI package not installed. Please run 'pip install openai'.")
+                self.client = OpenAI(
+                    api_key=os.getenv("DASHSCOPE_API_KEY"),
+                    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
+                )
+                logger.info(f"VectorStore initialized with DashScope model: {model_name}")
+            except Exception as e:
+                logger.error(f"Failed to initialize DashScope embedding client: {e}", exc_info=True)
+                raise
+        else:
+            raise ValueError(f"Unsupported embedding backend: {backend}")
+        self.cache = EmbeddingCache(f"{backend}:{model_name}", dimensions, cache_dir, cache_size)
         self.schemas: List[TableSchema] = []
         self.schema_embeddings: Optional[np.ndarray] = None
+        # Row-normalized copy of schema_embeddings, so cosine similarity is a single matrix product
+        self._normalized_schema_embeddings: Optional[np.ndarray] = None
 
     def get_embeddings(self, texts: List[str]) -> np.ndarray:
-        """Get embeddings using DashScope API"""
+        """
+        Get embeddings for texts, one row per text.
+
+        Cached texts are served from the content-hash cache; the remaining unique
+        texts are embedded in batches of `batch_size` per request.
+        """
+        vectors: List[Optional[np.ndarray]] = [self.cache.get(text) for text in texts]
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            computed = dict(zip(missing, self._embed_uncached(missing)))
+            for text, vector in computed.items():
+                self.cache.put(text, vector)
+            vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+            logger.info(f"Embedded {len(missing)} texts, {len(texts) - len(missing)} served from cache")
+        if not vectors:
+            return np.empty((0, self.dimensions), dtype=np.float32)
+        return np.array(vectors)
+
+    def _embed_uncached(self, texts: List[str]) -> List[np.ndarray]:
+        """Calls the embedding backend in batches."""
+        if self.local_embedder is not None:
+            return list(self.local_embedder.embed(texts))
         try:
-            # 批量处理文本
             all_embeddings = []
-            for text in texts:
+            for start in range(0, len(texts), self.batch_size):
                 response = self.client.embeddings.create(
                     model=self.model_name,
-                    input=text,
-                    dimensions=1024,
+                    input=texts[start:start + self.batch_size],
+                    dimensions=self.dimensions,
                     encoding_format="float"
                 )
-                all_embeddings.append(response.data[0].embedding)
-            return np.array(all_embeddings)
+                # Results carry their input index; do not rely on response order
+                for item in sorted(response.data, key=lambda d: d.index):
+                    all_embeddings.append(np.array(item.embedding, dtype=np.float32))
+            return all_embeddings
         except Exception as e:
             logger.error(f"Failed to get embeddings: {e}")
             raise
@@ -516,14 +1116,31 @@ class VectorStore:
         
         logger.info(f"Creating embeddings for {len(descriptions)} schemas...")
         self.schema_embeddings = self.get_embeddings(descriptions)
+        self._normalized_schema_embeddings = self._normalize(self.schema_embeddings)
         logger.info(f"Built embeddings for {len(self.schemas)} schemas.")
 
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.where(norms > 0, norms, 1.0)
+
+    def _similarities(self, texts: List[str]) -> np.ndarray:
+        """Cosine similarity of each text against every schema, shape (len(texts), len(schemas))."""
+        return self._normalize(self.get_embeddings(texts)) @ self._normalized_schema_embeddings.T
+
+    @staticmethod
+    def _top_k_indices(similarities: np.ndarray, k: int) -> np.ndarray:
+        """Per-row indices of the k highest scores, best first."""
+        k = min(k, similarities.shape[1])
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1, kind="stable")
+        return np.take_along_axis(top, order, axis=1)
+
     def _extract_columns_from_ddl(self, ddl: str) -> str:
         """Extract column names from DDL for better context."""
         try:
-            lines = ddl.strip().split('\n')
-            column_lines = lines[1:-1] # Exclude CREATE TABLE and closing parenthesis
-            return ", ".join([line.strip().split()[0] for line in column_lines])
+            columns, _ = _parse_ddl("", ddl)
+            return ", ".join(column.name for column in columns)
         except Exception:
             return ""
     
@@ -533,12 +1150,11 @@ class VectorStore:
             logger.warning("Embeddings not built. Cannot retrieve schemas.")
             return []
         
-        question_embedding = self.get_embeddings([question])
-        similarities = cosine_similarity(question_embedding, self.schema_embeddings)[0]
+        similarities = self._similarities([question])
         
         # Get top-k indices, ensuring we don't exceed the number of available schemas
-        k = min(top_k, len(self.schemas))
-        top_indices = np.argsort(similarities)[-k:][::-1]
+        top_indices = self._top_k_indices(similarities, top_k)[0]
+        similarities = similarities[0]
         
         relevant_schemas = [self.schemas[i] for i in top_indices]
         logger.info(f"Retrieved {len(relevant_schemas)} relevant schemas for the question.")
@@ -566,36 +1182,200 @@ orders
 """
         
         logger.info("LLM analyzing query dimensions...")
-        dimensions_text = llm_provider._call_llm(analysis_prompt, "qwen-plus")
+        try:
+            dimensions_text = llm_provider._call_llm(analysis_prompt, "qwen-plus")
+        except LLMCallError as e:
+            logger.warning(f"Query analysis failed ({e}), falling back to single-path retrieval")
+            return self.retrieve_relevant_schemas(question, top_k_per_path)
         
-        # 解析分析结果
-        dimensions = [dim.strip() for dim in dimensions_text.split('\n') if dim.strip()]
+        # 解析分析结果（去重，保持顺序）
+        dimensions = list(dict.fromkeys(dim.strip() for dim in dimensions_text.split('\n') if dim.strip()))
         logger.info(f"Identified {len(dimensions)} query dimensions: {dimensions}")
+        if not dimensions or self._normalized_schema_embeddings is None or not self.schemas:
+            return []
         
-        # 第二步：为每个维度进行向量检索
-        all_retrieved_schemas = []
-        seen_table_names = set()
+        # 第二步：所有维度一次批量编码、一次矩阵乘打分
+        similarities = self._similarities(dimensions)
         
-        for dimension in dimensions:
-            logger.info(f"Retrieving dimension: {dimension}")
-            
-            dimension_embedding = self.get_embeddings([dimension])
-            similarities = cosine_similarity(dimension_embedding, self.schema_embeddings)[0]
-            
-            # 为每个维度检索top_k_per_path个表
-            k = min(top_k_per_path, len(self.schemas))
-            top_indices = np.argsort(similarities)[-k:][::-1]
-            
-            for i in top_indices:
-                schema = self.schemas[i]
-                if schema.name not in seen_table_names:
-                    all_retrieved_schemas.append(schema)
-                    seen_table_names.add(schema.name)
-                    logger.info(f"  Retrieved {schema.name} (Similarity: {similarities[i]:.4f})")
+        # 为每个维度检索top_k_per_path个表，按 维度顺序、维度内分数 展平后保留每个表首次出现的位置
+        top_indices = self._top_k_indices(similarities, top_k_per_path)
+        flat_indices = top_indices.ravel()
+        flat_scores = np.take_along_axis(similarities, top_indices, axis=1).ravel()
+        _, first_positions = np.unique(flat_indices, return_index=True)
+        first_positions = np.sort(first_positions)
+        
+        all_retrieved_schemas = [self.schemas[i] for i in flat_indices[first_positions]]
+        for position in first_positions:
+            dimension = dimensions[position // top_indices.shape[1]]
+            logger.info(f"  Retrieved {self.schemas[flat_indices[position]].name} via '{dimension}' "
+                        f"(Similarity: {flat_scores[position]:.4f})")
         
         logger.info(f"Multi-path retrieval completed, retrieved {len(all_retrieved_schemas)} relevant tables")
         return all_retrieved_schemas
     
+class ColumnIndex:
+    """
+    Column-level schema index used to prune the SQL-generation prompt.
+
+    Every column is indexed by an embedding of "table.column comment" (computed
+    through the VectorStore, so it shares its batching and cache) and by lexical
+    tokens from its name and comment. Foreign keys form an undirected table graph.
+    `build_schema_context` keeps, for each selected table, its primary key, the
+    columns needed for joins and the columns that best match the question, and adds
+    the shortest foreign-key join paths between the selected tables, including any
+    bridge tables those paths go through.
+    """
+    def __init__(self, vector_store: VectorStore,
+                 max_columns_per_table: int = 8,
+                 lexical_weight: float = 0.2):
+        self.vector_store = vector_store
+        self.max_columns_per_table = max_columns_per_table
+        self.lexical_weight = lexical_weight
+        self.columns: Dict[str, List[ColumnSchema]] = {}
+        self.foreign_keys: List[ForeignKey] = []
+        self.graph: Dict[str, List[ForeignKey]] = {}
+        self._column_embeddings: Dict[str, np.ndarray] = {}
+        self._column_tokens: Dict[str, List[set]] = {}
+
+    @staticmethod
+    def _tokens(text: str) -> set:
+        """ASCII words (and their underscore-separated parts) plus CJK bigrams."""
+        text = text.lower()
+        tokens = set()
+        for word in re.findall(r"[a-z0-9_]+", text):
+            tokens.add(word)
+            tokens.update(part for part in word.split("_") if len(part) > 1)
+        for run in re.findall(r"[\u4e00-\u9fff]+", text):
+            tokens.update(a + b for a, b in zip(run, run[1:]))
+        return tokens
+
+    def build(self, schemas: List[TableSchema]):
+        """Parses every table's DDL and embeds all columns in one batched call."""
+        self.columns, self.foreign_keys, self.graph = {}, [], {}
+        for schema in schemas:
+            columns, foreign_keys = _parse_ddl(schema.name, schema.ddl)
+            self.columns[schema.name] = columns
+            self.foreign_keys.extend(foreign_keys)
+
+        for fk in self.foreign_keys:
+            if fk.ref_table in self.columns and fk.ref_table != fk.table:
+                self.graph.setdefault(fk.table, []).append(fk)
+                self.graph.setdefault(fk.ref_table, []).append(fk)
+
+        texts = [f"{c.table}.{c.name} {c.comment}".strip() for cols in self.columns.values() for c in cols]
+        embeddings = VectorStore._normalize(self.vector_store.get_embeddings(texts)) if texts else []
+        offset = 0
+        for table, cols in self.columns.items():
+            self._column_embeddings[table] = embeddings[offset:offset + len(cols)]
+            self._column_tokens[table] = [self._tokens(f"{c.name} {c.comment}") for c in cols]
+            offset += len(cols)
+        logger.info(f"Column index built: {len(texts)} columns, {len(self.foreign_keys)} foreign keys")
+
+    def join_paths(self, tables: List[str]) -> Tuple[List[str], List[ForeignKey]]:
+        """
+        Connects `tables` through the foreign-key graph.
+
+        Each table is linked to the tables already connected by a shortest
+        (breadth-first) path. Returns all tables involved, including bridge
+        tables, and the foreign keys to join on.
+        """
+        tables = [table for table in tables if table in self.columns]
+        if not tables:
+            return [], []
+        connected = [tables[0]]
+        edges: List[ForeignKey] = []
+        for target in tables[1:]:
+            if target in connected:
+                continue
+            previous: Dict[str, Optional[Tuple[str, ForeignKey]]] = {target: None}
+            queue = [target]
+            reached = None
+            while queue and reached is None:
+                next_queue = []
+                for table in queue:
+                    for fk in self.graph.get(table, []):
+                        neighbor = fk.ref_table if fk.table == table else fk.table
+                        if neighbor in previous:
+                            continue
+                        previous[neighbor] = (table, fk)
+                        if neighbor in connected:
+                            reached = neighbor
+                            break
+                        next_queue.append(neighbor)
+                    if reached is not None:
+                        break
+                queue = next_queue
+            if reached is None:
+                # No foreign-key route; the table is still included on its own
+                connected.append(target)
+                continue
+            node = reached
+            while previous[node] is not None:
+                node, fk = previous[node]
+                if fk not in edges:
+                    edges.append(fk)
+                if node not in connected:
+                    connected.append(node)
+        return connected, edges
+
+    def select_columns(self, question_embedding: np.ndarray, question_tokens: set, table: str,
+                       required: set) -> List[ColumnSchema]:
+        """Keeps required and primary-key columns plus the best-scoring rest, in DDL order."""
+        columns = self.columns[table]
+        if len(columns) <= self.max_columns_per_table:
+            return columns
+        scores = self._column_embeddings[table] @ question_embedding
+        for i, tokens in enumerate(self._column_tokens[table]):
+            if tokens & question_tokens:
+                scores[i] += self.lexical_weight
+        keep = {i for i, column in enumerate(columns) if column.primary_key or column.name in required}
+        for i in np.argsort(-scores, kind="stable"):
+            if len(keep) >= self.max_columns_per_table:
+                break
+            keep.add(int(i))
+        return [column for i, column in enumerate(columns) if i in keep]
+
+    def build_schema_context(self, question: str, schemas: List[TableSchema]) -> str:
+        """Builds a pruned DDL context for the selected tables plus their join paths."""
+        tables, edges = self.join_paths([schema.name for schema in schemas])
+        required: Dict[str, set] = {}
+        for fk in edges:
+            required.setdefault(fk.table, set()).add(fk.column)
+            required.setdefault(fk.ref_table, set()).add(fk.ref_column)
+
+        question_embedding = VectorStore._normalize(self.vector_store.get_embeddings([question]))[0]
+        question_tokens = self._tokens(question)
+        selected = {schema.name for schema in schemas}
+        sections = []
+        for table in tables:
+            columns = self.columns[table]
+            if table in selected:
+                kept = self.select_columns(question_embedding, question_tokens, table, required.get(table, set()))
+                header = f"--- Table: {table} ---"
+            else:
+                kept = [c for c in columns if c.primary_key or c.name in required.get(table, set())]
+                header = f"--- Table: {table} (join path only) ---"
+            kept_names = {column.name for column in kept}
+            entries = [(column.definition, column.comment) for column in kept]
+            entries.extend((f"FOREIGN KEY ({fk.column}) REFERENCES {fk.ref_table} ({fk.ref_column})", "")
+                           for fk in self.foreign_keys
+                           if fk.table == table and fk.column in kept_names and fk.ref_table in tables)
+            lines = [f"    {definition}{',' if i < len(entries) - 1 else ''}" + (f" -- {comment}" if comment else "")
+                     for i, (definition, comment) in enumerate(entries)]
+            omitted = [column.name for column in columns if column.name not in kept_names]
+            section = f"{header}\nCREATE TABLE {table} (\n" + "\n".join(lines) + "\n);"
+            if omitted and table in selected:
+                section += f"\n-- Other columns: {', '.join(omitted)}"
+            sections.append(section)
+        if edges:
+            sections.append("--- Join paths ---\n" + "\n".join(fk.join_condition() for fk in edges))
+        return "\n\n".join(sections)
+
+
+class LLMCallError(RuntimeError):
+    """Raised when an LLM API call fails, so failures are never mistaken for model output."""
+
+
 class LLMProvider:
     """A wrapper for LLM API calls using OpenAI-compatible interface."""
     def __init__(self, llm_config: Dict[str, Any]):
@@ -623,7 +1403,7 @@ class LLMProvider:
         logger.info(f"LLMProvider initialized for '{self.provider}'.")
 
     def _call_llm(self, prompt: str, model: str) -> str:
-        """Internal method to make the actual API call."""
+        """Internal method to make the actual API call. Raises LLMCallError on failure."""
         logger.info(f"Calling LLM ({self.provider}, model: {model})...")
         try:
             response = self.client.chat.completions.create(
@@ -634,7 +1414,7 @@ class LLMProvider:
             return response.choices[0].message.content or ""
         except Exception as e:
             logger.error(f"LLM API call failed: {e}", exc_info=True)
-            return f"Error: LLM call failed. {e}"
+            raise LLMCallError(f"LLM call failed. {e}") from e
 
     def generate_sql(self, prompt: str) -> str:
         """Generates SQL from a prompt."""
@@ -650,14 +1430,134 @@ class LLMProvider:
 
 # --- Main Pipeline Orchestrator ----------------------------------------------
 
+class QueryCache:
+    """
+    Question -> answer cache for `NL2SQLPipeline.ask`.
+
+    Entries are keyed by the normalized question and hold the full response (SQL,
+    rows and answer) together with the tables the SQL reads, their write versions
+    and the schema version at execution time. `lookup` drops an entry as soon as
+    `is_fresh` reports that any of these moved. With `semantic_threshold` set, a
+    question without an exact match may reuse the entry whose question embedding
+    has cosine similarity at or above the threshold.
+    """
+    def __init__(self, max_entries: int = 256, semantic_threshold: Optional[float] = None):
+        self.max_entries = max_entries
+        self.semantic_threshold = semantic_threshold
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        """Folds width and case, collapses whitespace and drops trailing punctuation."""
+        text = unicodedata.normalize("NFKC", question).lower()
+        text = re.sub(r"\s+", " ", text).strip()
+        return text.rstrip("?!.。 ")
+
+    def lookup(self, question: str, is_fresh, embedding: Optional[np.ndarray] = None
+               ) -> Optional[Tuple[Dict[str, Any], float]]:
+        """
+        Returns (entry, similarity) for a fresh cached answer, or None.
+
+        Args:
+            question: The incoming question.
+            is_fresh: Callable taking an entry and returning False if its data changed.
+            embedding: Normalized question embedding, used for near-match lookup.
+        """
+        key = self.normalize(question)
+        with self._lock:
+            similarity = 1.0
+            if key not in self._entries:
+                key, similarity = self._nearest(embedding)
+            entry = self._entries.get(key) if key is not None else None
+            if entry is None:
+                self.misses += 1
+                return None
+
+        # The freshness check queries the database; do it without holding the lock
+        fresh = is_fresh(entry)
+
+        with self._lock:
+            if not fresh:
+                # Leave the slot alone if another thread stored a newer answer meanwhile
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+                self.stale += 1
+                self.misses += 1
+                return None
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            if similarity < 1.0:
+                self.semantic_hits += 1
+        return entry, similarity
+
+    def _nearest(self, embedding: Optional[np.ndarray]) -> Tuple[Optional[str], float]:
+        if embedding is None or self.semantic_threshold is None:
+            return None, 0.0
+        keys = [key for key, entry in self._entries.items() if entry["embedding"] is not None]
+        if not keys:
+            return None, 0.0
+        scores = np.stack([self._entries[key]["embedding"] for key in keys]) @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.semantic_threshold:
+            return None, 0.0
+        return keys[best], float(scores[best])
+
+    def put(self, question: str, response: Dict[str, Any], tables: List[str],
+            versions: Dict[str, int], schema_version: int, embedding: Optional[np.ndarray] = None):
+        """Stores a response with the data versions it was computed from."""
+        key = self.normalize(question)
+        with self._lock:
+            self._entries[key] = {
+                "question": question,
+                "response": self.copy_response(response),
+                "tables": tables,
+                "versions": versions,
+                "schema_version": schema_version,
+                "embedding": embedding,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def copy_response(response: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Copies a response so callers cannot mutate the cached one.
+
+        Cell values are immutable SQLite scalars, so copying the per-column lists
+        is enough; no per-cell deep copy is needed.
+        """
+        copied = {key: value.copy() if isinstance(value, (list, dict)) else value
+                  for key, value in response.items()}
+        if "column_values" in copied:
+            copied["column_values"] = [list(values) for values in copied["column_values"]]
+        return copied
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "semantic_hits": self.semantic_hits,
+                    "misses": self.misses, "stale": self.stale}
+
+
 class NL2SQLPipeline:
     """Orchestrates the Text-to-SQL process using modular components."""
     def __init__(self, config: Dict[str, Any]):
         logger.info("Initializing NL2SQL Pipeline...")
         self.db_manager = DBManager(config['database'])
         
-        # Initialize vector store
-        self.vector_store = VectorStore(config['embedding_model'])
+        # Initialize vector store; schema embeddings are served from the persistent
+        # cache on restart unless a table's DDL or description changed
+        self.vector_store = VectorStore(config['embedding_model'], **config.get('embedding', {}))
         logger.info(f"VectorStore initialized with embedding model: {config['embedding_model']}")
         
         # Initialize LLM provider  
@@ -670,11 +1570,67 @@ class NL2SQLPipeline:
         self.vector_store.build_embeddings(all_schemas)
         logger.info(f"Built embeddings for {len(all_schemas)} schemas.")
         
+        # Column-level index for pruning wide tables in the SQL prompt
+        pruning_config = config.get('schema_pruning', {})
+        self.column_index: Optional[ColumnIndex] = None
+        if pruning_config.get('enabled', True):
+            self.column_index = ColumnIndex(self.vector_store,
+                                            pruning_config.get('max_columns_per_table', 8),
+                                            pruning_config.get('lexical_weight', 0.2))
+            self.column_index.build(all_schemas)
+
         # Load prompt templates
         self.sql_prompt_template = config['prompts']['sql_generation']
         self.answer_prompt_template = config['prompts']['answer_generation']
+
+        # Repeat questions are answered from the query cache until a table they read is written
+        cache_config = config.get('query_cache', {})
+        self.query_cache: Optional[QueryCache] = None
+        if cache_config.get('enabled', True):
+            self.query_cache = QueryCache(cache_config.get('max_entries', 256),
+                                          cache_config.get('semantic_threshold'))
         logger.info("NL2SQL Pipeline initialized successfully.")
 
+    def _is_fresh(self, entry: Dict[str, Any]) -> bool:
+        """True if no table the cached SQL reads, nor the schema, changed since it ran."""
+        return (entry["schema_version"] == self.db_manager.schema_version()
+                and self.db_manager.table_versions(entry["tables"]) == entry["versions"])
+
+    def _question_embedding(self, question: str) -> Optional[np.ndarray]:
+        """Normalized question embedding for near-match cache lookups, if enabled."""
+        if self.query_cache is None or self.query_cache.semantic_threshold is None:
+            return None
+        return VectorStore._normalize(self.vector_store.get_embeddings([question]))[0]
+
+    def _cached_response(self, question: str, embedding: Optional[np.ndarray],
+                         start_time: float) -> Optional[Dict[str, Any]]:
+        if self.query_cache is None:
+            return None
+        cached = self.query_cache.lookup(question, self._is_fresh, embedding)
+        if cached is None:
+            return None
+        entry, similarity = cached
+        response = QueryCache.copy_response(entry["response"])
+        response["question"] = question
+        response["cached_question"] = entry["question"]
+        response["cache_similarity"] = similarity
+        total_time = time.time() - start_time
+        response["performance"] = {
+            "retrieval_time": 0,
+            "sql_generation_time": 0,
+            "execution_time": 0,
+            "answer_generation_time": 0,
+            "total_time": total_time,
+            "cache_hit": True
+        }
+        logger.info(f"Query cache hit (similarity {similarity:.4f}) for: {entry['question'][:50]}, "
+                    f"served in {total_time * 1000:.1f}ms")
+        return response
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Returns query cache statistics."""
+        return self.query_cache.stats() if self.query_cache is not None else {}
+
     def ask(self, question: str) -> Dict[str, Any]:
         """
         Executes the full Text-to-SQL pipeline for a given question.
@@ -686,6 +1642,12 @@ class NL2SQLPipeline:
         logger.info(f"Processing question: {question}")
         logger.info("=" * 80)
 
+        # 0. Serve repeat questions from the query cache
+        question_embedding = self._question_embedding(question)
+        cached_response = self._cached_response(question, question_embedding, start_time)
+        if cached_response is not None:
+            return cached_response
+
         # 1. Retrieve relevant schemas using multi-path approach
         logger.info("Step 1: Starting multi-path vector retrieval...")
         retrieval_start = time.time()
@@ -695,7 +1657,10 @@ class NL2SQLPipeline:
         logger.info(f"Vector retrieval completed in {retrieval_time:.2f}s")
         logger.info(f"Retrieved {len(relevant_schemas)} relevant tables: {[s.name for s in relevant_schemas]}")
         
-        schema_context = "\n\n".join([f"--- Table: {s.name} ---\n{s.ddl}" for s in relevant_schemas])
+        if self.column_index is not None:
+            schema_context = self.column_index.build_schema_context(question, relevant_schemas)
+        else:
+            schema_context = "\n\n".join([f"--- Table: {s.name} ---\n{s.ddl}" for s in relevant_schemas])
         logger.info(f"Schema context built, length: {len(schema_context)} characters")
 
         # 2. Generate SQL
@@ -704,7 +1669,28 @@ class NL2SQLPipeline:
         sql_prompt = self.sql_prompt_template.format(schema_context=schema_context, question=question)
         logger.info(f"SQL prompt length: {len(sql_prompt)} characters")
         
-        sql_query = self.llm_provider.generate_sql(sql_prompt)
+        try:
+            sql_query = self.llm_provider.generate_sql(sql_prompt)
+        except LLMCallError as e:
+            logger.error(f"SQL generation failed: {e}")
+            return {
+                'question': question,
+                'relevant_schemas': [s.name for s in relevant_schemas],
+                'sql_query': None,
+                'query_success': False,
+                'query_error': str(e),
+                'columns': [],
+                'column_values': [],
+                'row_count': 0,
+                'answer': "Sorry, the SQL query could not be generated. Please try again later.",
+                'performance': {
+                    'retrieval_time': retrieval_time,
+                    'sql_generation_time': time.time() - sql_start,
+                    'execution_time': 0,
+                    'answer_generation_time': 0,
+                    'total_time': time.time() - start_time
+                }
+            }
         sql_time = time.time() - sql_start
         
         logger.info(f"SQL generation completed in {sql_time:.2f}s")
@@ -719,7 +1705,9 @@ class NL2SQLPipeline:
                 'question': question,
                 'relevant_schemas': [s.name for s in relevant_schemas],
                 'sql_query': None,
-                'data': [],
+                'columns': [],
+                'column_values': [],
+                'row_count': 0,
                 'answer': f"Current database structure cannot satisfy the query requirements. {sql_query.replace('SCHEMA_INSUFFICIENT:', '').strip()}",
                 'query_success': False,
                 'schema_insufficient': True,
@@ -737,14 +1725,18 @@ class NL2SQLPipeline:
         # 3. Execute SQL
         logger.info("Step 3: Starting database query execution...")
         exec_start = time.time()
+        # Snapshot data versions before executing, so a concurrent write marks the result stale
+        read_tables = self.db_manager.tables_in_sql(sql_query)
+        data_versions = self.db_manager.table_versions(read_tables)
+        schema_version = self.db_manager.schema_version()
         query_result = self.db_manager.execute_sql(sql_query)
         exec_time = time.time() - exec_start
         
         if query_result.success:
             logger.info(f"Query executed successfully in {exec_time:.2f}s")
-            logger.info(f"Returned {len(query_result.data)} records")
-            if query_result.data:
-                logger.info(f"Sample data available: {len(query_result.data)} records")
+            logger.info(f"Returned {query_result.row_count} records")
+            if query_result.truncated:
+                logger.warning(f"Result truncated by {query_result.truncation_reason} limit")
         else:
             logger.error(f"Query execution failed in {exec_time:.2f}s")
             logger.error(f"Error: {query_result.error}")
@@ -753,14 +1745,15 @@ class NL2SQLPipeline:
         logger.info("Step 4: Starting natural language answer generation...")
         answer_start = time.time()
         answer = ""
+        answer_error = None
         
         if query_result.success:
-            if not query_result.data:
+            if not query_result.row_count:
                 answer = "I found relevant information, but no data matched your specific conditions."
                 logger.info("Query successful but no data, returning standard prompt")
             else:
                 # 生成数据摘要而不是完整数据，避免数据泄露
-                data_summary = self._create_data_summary(query_result.data)
+                data_summary = self._create_data_summary(query_result)
                 logger.info(f"Preparing answer generation, data summary length: {len(data_summary)} characters")
                 
                 answer_prompt = self.answer_prompt_template.format(
@@ -770,8 +1763,12 @@ class NL2SQLPipeline:
                 )
                 logger.info(f"Answer generation prompt length: {len(answer_prompt)} characters")
                 
-                answer = self.llm_provider.generate_answer(answer_prompt)
-                logger.info(f"Answer length: {len(answer)} characters")
+                try:
+                    answer = self.llm_provider.generate_answer(answer_prompt)
+                    logger.info(f"Answer length: {len(answer)} characters")
+                except LLMCallError as e:
+                    answer_error = str(e)
+                    answer = "Sorry, the query succeeded but the answer could not be generated. Please try again later."
         else:
             answer = f"Sorry, an error occurred while answering your question. Database reported: {query_result.error}"
             logger.info("Due to query failure, returning error message")
@@ -790,48 +1787,56 @@ class NL2SQLPipeline:
         logger.info(f"Question processing completed: {question[:50]}...")
         logger.info("=" * 80)
         
-        return {
+        response = {
             "question": question,
             "relevant_schemas": [s.name for s in relevant_schemas],
             "sql_query": query_result.sql,
             "query_success": query_result.success,
             "query_error": query_result.error,
-            "data": query_result.data,
+            "columns": query_result.columns,
+            "column_values": query_result.column_values,
+            "row_count": query_result.row_count,
+            "truncation_reason": query_result.truncation_reason,
             "answer": answer,
+            "answer_error": answer_error,
             "performance": {
                 "retrieval_time": retrieval_time,
                 "sql_generation_time": sql_time,
                 "execution_time": exec_time,
                 "answer_generation_time": answer_time,
-                "total_time": total_time
+                "total_time": total_time,
+                "cache_hit": False
             }
         }
+        # Only complete answers are cached; a failed answer call is retried on the next ask
+        if query_result.success and answer_error is None and self.query_cache is not None:
+            self.query_cache.put(question, response, read_tables, data_versions, schema_version,
+                                 question_embedding)
+        return response
 
-    def _create_data_summary(self, data: List[Dict[str, Any]]) -> str:
+    def _create_data_summary(self, result: QueryResult) -> str:
         """创建数据摘要，避免泄露敏感信息，只提供结构化统计信息"""
-        if not data:
+        if not result.row_count:
             return "No data available."
 
-        # 提取所有列名和数据类型信息
-        all_columns = set()
+        # 按列提取数据类型信息（取每列第一个非空值的类型）
         column_types = {}
-        
-        for record in data:
-            all_columns.update(record.keys())
-            for key, value in record.items():
-                if key not in column_types:
-                    column_types[key] = type(value).__name__
+        for col, values in zip(result.columns, result.column_values):
+            first_value = next((value for value in values if value is not None), None)
+            column_types.setdefault(col, type(first_value).__name__)
 
         # 生成安全的数据摘要（不包含实际数据值）
         summary_data = {
-            "total_records": len(data),
+            "total_records": result.row_count,
             "columns_info": {
                 col: column_types.get(col, "unknown") 
-                for col in sorted(list(all_columns))
+                for col in sorted(column_types)
             },
             "data_structure": "Multi-table query results with business metrics",
             "privacy_note": "Actual data values omitted for security"
         }
+        if result.truncated:
+            summary_data["truncated"] = f"Result cut off by the {result.truncation_reason} limit; more rows exist"
         
         return json.dumps(summary_data, indent=2, ensure_ascii=False)
 
@@ -928,7 +1933,7 @@ def run_demo():
                 "schema_insufficient": result.get('schema_insufficient', False),
                 "tables_used": len(result['relevant_schemas']),
                 "table_names": result['relevant_schemas'],
-                "data_records": len(result['data']) if result['query_success'] else 0,
+                "data_records": result['row_count'] if result['query_success'] else 0,
                 "execution_time": demo_time,
                 "performance": result.get('performance', {})
             }
@@ -937,7 +1942,7 @@ def run_demo():
             logger.info(f"Demo {i} statistics:")
             logger.info(f"   Success: {result['query_success']}")
             logger.info(f"   Tables used: {len(result['relevant_schemas'])}")
-            logger.info(f"   Data records: {len(result['data']) if result['query_success'] else 0}")
+            logger.info(f"   Data records: {result['row_count'] if result['query_success'] else 0}")
             logger.info(f"   Execution time: {demo_time:.2f}s")
             if result.get('performance'):
                 perf = result['performance']
@@ -957,18 +1962,20 @@ def run_demo():
             print(f"```")
             
             if result['query_success']:
-                print(f"\nQuery executed successfully, returned {len(result['data'])} results")
+                print(f"\nQuery executed successfully, returned {result['row_count']} results")
                 print(f"\nAI Analysis:")
                 print("=" * 50)
                 print(result['answer'])
                 print("=" * 50)
                 
-                if result['data']:
-                    print(f"\nKey Data Summary ({len(result['data'])} records):")
-                    for idx, record in enumerate(result['data'][:5], 1):
-                        print(f"  {idx}. {record}")
-                    if len(result['data']) > 5:
-                        print(f"  ... and {len(result['data']) - 5} more records")
+                if result['row_count']:
+                    print(f"\nKey Data Summary ({result['row_count']} records):")
+                    # Build row dicts only for the records shown
+                    rows = zip(*(values[:5] for values in result['column_values']))
+                    for idx, values in enumerate(rows, 1):
+                        print(f"  {idx}. {dict(zip(result['columns'], values))}")
+                    if result['row_count'] > 5:
+                        print(f"  ... and {result['row_count'] - 5} more records")
             else:
                 print(f"\nQuery execution encountered challenges: {result.get('query_error', result.get('answer', 'Unknown error'))}")
                 print("This type of complex query needs further optimization of SQL generation strategy")
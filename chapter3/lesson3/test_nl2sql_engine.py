@@ -0,0 +1,432 @@
+"""
+Offline tests for the NL2SQL engine.
+
+Everything runs against a temporary SQLite database, the deterministic
+LocalEmbedder and stubbed LLM calls, so no API key or network is needed.
+"""
+import shutil
+import sqlite3
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import nl2sql_engine as ne
+
+
+@pytest.fixture
+def db(tmp_path):
+    manager = ne.DBManager({"path": str(tmp_path / "bi.db")})
+    yield manager
+    manager.close()
+
+
+@pytest.fixture
+def local_store():
+    return ne.VectorStore(backend="local", dimensions=256)
+
+
+# --- Embeddings and retrieval ----------------------------------------------------
+
+def test_local_embedder_is_deterministic_and_normalized():
+    embedder = ne.LocalEmbedder(128)
+    first = embedder.embed(["订单 orders total", "employees salary"])
+    second = embedder.embed(["订单 orders total", "employees salary"])
+    assert np.array_equal(first, second)
+    assert np.allclose(np.linalg.norm(first, axis=1), 1.0)
+
+
+def test_local_store_retrieves_matching_table(db, local_store):
+    local_store.build_embeddings(db.get_all_schemas())
+    names = [schema.name for schema in local_store.retrieve_relevant_schemas("employees salary manager_id", 3)]
+    assert names[0] == "employees"
+
+
+def test_embedding_cache_serves_restarts_from_disk(db, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    schemas = db.get_all_schemas()
+    first = ne.VectorStore(backend="local", dimensions=64, cache_dir=cache_dir)
+    first.build_embeddings(schemas)
+    assert first.cache.stats()["misses"] == len(schemas)
+
+    second = ne.VectorStore(backend="local", dimensions=64, cache_dir=cache_dir)
+    second.build_embeddings(schemas)
+    assert second.cache.stats()["disk_hits"] == len(schemas)
+    assert second.cache.stats()["misses"] == 0
+    assert np.array_equal(first.schema_embeddings, second.schema_embeddings)
+
+    # Only the table whose DDL changed is embedded again
+    schemas[0] = ne.TableSchema(schemas[0].name, schemas[0].ddl + " -- changed", schemas[0].description)
+    third = ne.VectorStore(backend="local", dimensions=64, cache_dir=cache_dir)
+    third.build_embeddings(schemas)
+    assert third.cache.stats()["misses"] == 1
+
+
+def test_embedding_cache_is_bounded_lru():
+    cache = ne.EmbeddingCache("local:test", 4, max_entries=2)
+    cache.put("a", np.ones(4))
+    cache.put("b", np.ones(4))
+    assert cache.get("a") is not None  # "a" becomes most recently used
+    cache.put("c", np.ones(4))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["entries"] == 2
+
+
+def test_get_embeddings_dedupes_and_batches_api_calls(monkeypatch):
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test")
+    store = ne.VectorStore(dimensions=32, batch_size=4)
+    requests = []
+
+    class FakeEmbeddings:
+        def create(self, model, input, dimensions, encoding_format):
+            requests.append(list(input))
+            vectors = ne.LocalEmbedder(dimensions).embed(input)
+            # Out of order on purpose: results must be matched by index
+            data = [type("Item", (), {"index": i, "embedding": list(vectors[i])})()
+                    for i in reversed(range(len(input)))]
+            return type("Response", (), {"data": data})()
+
+    store.client = type("Client", (), {"embeddings": FakeEmbeddings()})()
+    texts = [f"text {i}" for i in range(10)] + ["text 0"]
+    vectors = store.get_embeddings(texts)
+
+    assert [len(batch) for batch in requests] == [4, 4, 2]
+    assert np.allclose(vectors, ne.LocalEmbedder(32).embed(texts), atol=1e-6)
+    store.get_embeddings(texts)
+    assert len(requests) == 3
+
+
+class _DimensionsLLM:
+    def __init__(self, text):
+        self.text = text
+
+    def _call_llm(self, prompt, model):
+        return self.text
+
+
+def test_multi_path_retrieval_matches_per_dimension_search(db, local_store, monkeypatch):
+    local_store.build_embeddings(db.get_all_schemas())
+    dimensions = ["employees salary", "sales amount", "products price", "employees salary"]
+    expected = []
+    for dimension in dict.fromkeys(dimensions):
+        for schema in local_store.retrieve_relevant_schemas(dimension, 2):
+            if schema not in expected:
+                expected.append(schema)
+
+    batches = []
+    get_embeddings = local_store.get_embeddings
+    monkeypatch.setattr(local_store, "get_embeddings", lambda texts: batches.append(texts) or get_embeddings(texts))
+    retrieved = local_store.multi_path_retrieve_schemas("q", _DimensionsLLM("\n".join(dimensions)), top_k_per_path=2)
+    assert [schema.name for schema in retrieved] == [schema.name for schema in expected]
+    assert batches == [["employees salary", "sales amount", "products price"]]  # one batched, deduplicated call
+
+    assert local_store.multi_path_retrieve_schemas("q", _DimensionsLLM("  \n"), top_k_per_path=2) == []
+
+
+# --- Connection pool and schema cache ---------------------------------------------
+
+def test_connections_are_pooled_per_thread(db):
+    conn = db._connection()
+    assert db._connection() is conn
+    others = []
+    thread = threading.Thread(target=lambda: others.extend([db._connection(), db._connection()]))
+    thread.start()
+    thread.join()
+    assert others[0] is others[1] and others[0] is not conn
+    # The connection of a thread that has exited is closed and leaves the pool
+    assert db.pool_stats()["connections"] == 1
+    with pytest.raises(sqlite3.ProgrammingError):
+        others[0].execute("SELECT 1")
+
+    for _ in range(20):  # per-request threads do not accumulate connections
+        thread = threading.Thread(target=lambda: db.execute_sql("SELECT COUNT(*) FROM regions"))
+        thread.start()
+        thread.join()
+    assert db.pool_stats()["connections"] == 1
+
+    db.close()
+    assert db.pool_stats()["connections"] == 0
+    assert db.execute_sql("SELECT COUNT(*) FROM regions").success  # reconnects on demand
+
+
+def test_schema_cache_is_invalidated_by_ddl(db):
+    tables = [schema.name for schema in db.get_all_schemas()]
+    hits = db.pool_stats()["schema_cache_hits"]
+    assert [schema.name for schema in db.get_all_schemas()] == tables
+    assert db.pool_stats()["schema_cache_hits"] == hits + 1
+
+    misses = db.pool_stats()["schema_cache_misses"]
+    assert db.execute_sql("CREATE TABLE scratch (id INTEGER)", read_only=False).success
+    assert "scratch" in [schema.name for schema in db.get_all_schemas()]
+    assert db.pool_stats()["schema_cache_misses"] == misses + 1
+
+
+
+def test_bundled_database_is_not_converted_to_wal(tmp_path):
+    path = tmp_path / "enterprise_bi.db"
+    shutil.copy(Path(ne.__file__).with_name("enterprise_bi.db"), path)
+    before = path.read_bytes()
+    manager = ne.DBManager({**ne.CONFIG["database"], "path": str(path)})
+    assert manager.execute_sql("SELECT COUNT(*) FROM regions").success
+    manager.close()
+    assert path.read_bytes() == before
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["enterprise_bi.db"]
+
+    manager = ne.DBManager({"path": str(path), "wal": True})
+    assert manager._connection().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    manager.close()
+
+# --- Query cache -------------------------------------------------------------------
+
+def test_query_cache_normalizes_questions():
+    cache = ne.QueryCache()
+    cache.put("How many regions?", {"answer": 1}, ["regions"], {"regions": 0}, 1)
+    entry, similarity = cache.lookup("  how many REGIONS？ ", lambda entry: True)
+    assert entry["response"] == {"answer": 1} and similarity == 1.0
+
+
+def test_query_cache_checks_freshness_without_holding_the_lock():
+    cache = ne.QueryCache()
+    cache.put("q", {"answer": 1}, ["regions"], {"regions": 0}, 1)
+
+    def is_fresh(entry):
+        # Would deadlock if lookup still held the (non-reentrant) lock here
+        assert cache._lock.acquire(timeout=1)
+        cache._lock.release()
+        return False
+
+    assert cache.lookup("q", is_fresh) is None
+    assert cache.stats()["stale"] == 1 and cache.stats()["entries"] == 0
+
+
+def test_query_cache_semantic_near_match():
+    embedder = ne.LocalEmbedder(64)
+    stored, near, far = embedder.embed(["how many regions", "how many regions please", "list employees"])
+    cache = ne.QueryCache(semantic_threshold=0.8)
+    cache.put("how many regions", {"answer": 1}, ["regions"], {"regions": 0}, 1, stored)
+    assert cache.lookup("how many regions please", lambda entry: True, near)[1] < 1.0
+    assert cache.lookup("list employees", lambda entry: True, far) is None
+    assert cache.stats()["semantic_hits"] == 1
+
+
+def test_table_versions_bump_only_on_writes(db):
+    before = db.table_versions(["regions", "employees"])
+    db.execute_sql("SELECT * FROM regions")
+    assert db.table_versions(["regions", "employees"]) == before
+    db.execute_sql("UPDATE regions SET name = name", read_only=False)
+    after = db.table_versions(["regions", "employees"])
+    assert after["regions"] == before["regions"] + 1
+    assert after["employees"] == before["employees"]
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """NL2SQLPipeline over a temp database with a stubbed LLM that records its calls."""
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test")
+    config = {
+        **ne.CONFIG,
+        "database": {**ne.CONFIG["database"], "path": str(tmp_path / "bi.db")},
+        "embedding": {"backend": "local", "dimensions": 128, "cache_dir": None},
+    }
+    pipe = ne.NL2SQLPipeline(config)
+    calls = []
+
+    def fake_llm(prompt, model):
+        calls.append(prompt)
+        if "分析这个业务查询" in prompt:
+            return "regions\ncustomers"
+        if "SQL:" in prompt:
+            return "SELECT name, tax_rate FROM regions ORDER BY id"
+        return "stub answer"
+
+    monkeypatch.setattr(pipe.llm_provider, "_call_llm", fake_llm)
+    pipe.llm_calls = calls
+    yield pipe
+    pipe.db_manager.close()
+
+
+def test_repeat_question_is_served_without_llm_calls(pipeline):
+    first = pipeline.ask("各地区的税率是多少？")
+    calls = len(pipeline.llm_calls)
+    second = pipeline.ask("各地区的税率是多少")
+    assert second["performance"]["cache_hit"]
+    assert len(pipeline.llm_calls) == calls
+    assert second["sql_query"] == first["sql_query"]
+
+
+def test_write_to_a_read_table_invalidates_the_cached_answer(pipeline):
+    pipeline.ask("各地区的税率是多少？")
+    pipeline.db_manager.execute_sql("UPDATE customers SET name = name", read_only=False)
+    assert pipeline.ask("各地区的税率是多少？")["performance"]["cache_hit"]
+
+    pipeline.db_manager.execute_sql("UPDATE regions SET tax_rate = tax_rate", read_only=False)
+    calls = len(pipeline.llm_calls)
+    assert not pipeline.ask("各地区的税率是多少？")["performance"]["cache_hit"]
+    assert len(pipeline.llm_calls) > calls
+
+
+
+def test_failed_answer_generation_is_not_cached(pipeline, monkeypatch):
+    call_llm = pipeline.llm_provider._call_llm
+    failures = []
+
+    def flaky_llm(prompt, model):
+        if "分析这个业务查询" not in prompt and "SQL:" not in prompt and not failures:
+            failures.append(prompt)
+            raise ne.LLMCallError("LLM call failed. timeout")
+        return call_llm(prompt, model)
+
+    monkeypatch.setattr(pipeline.llm_provider, "_call_llm", flaky_llm)
+    first = pipeline.ask("各地区的税率是多少？")
+    assert first["query_success"] and first["answer_error"] == "LLM call failed. timeout"
+    assert pipeline.cache_stats()["entries"] == 0
+
+    second = pipeline.ask("各地区的税率是多少？")
+    assert not second["performance"]["cache_hit"] and second["answer_error"] is None
+    assert second["answer"] == "stub answer"
+    assert pipeline.ask("各地区的税率是多少？")["performance"]["cache_hit"]
+
+
+def test_llm_errors_are_raised_not_returned(pipeline, monkeypatch):
+    def broken(**kwargs):
+        raise ConnectionError("connection reset")
+
+    monkeypatch.delattr(pipeline.llm_provider, "_call_llm")  # back to the real call, on a failing client
+    monkeypatch.setattr(pipeline.llm_provider, "client", SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=broken))))
+    with pytest.raises(ne.LLMCallError, match="connection reset"):
+        pipeline.llm_provider.generate_answer("prompt")
+
+    # Failed query analysis falls back to single-path retrieval, failed SQL generation is reported
+    response = pipeline.ask("各地区的税率是多少？")
+    assert not response["query_success"] and "connection reset" in response["query_error"]
+    assert response["relevant_schemas"] and pipeline.cache_stats()["entries"] == 0
+
+# --- Read-only execution -----------------------------------------------------------
+
+def test_execute_sql_rejects_writes_by_default(db):
+    before = db.table_versions(["regions"])
+    for sql in ("UPDATE regions SET name = 'x'", "CREATE TABLE scratch (id INTEGER)"):
+        result = db.execute_sql(sql)
+        assert not result.success and "readonly" in result.error
+    assert db.table_versions(["regions"]) == before
+    assert "x" not in db.execute_sql("SELECT name FROM regions").column_values[0]
+    assert "scratch" not in [schema.name for schema in db.get_all_schemas()]
+
+
+def test_read_only_stream_closed_early_rolls_back(db):
+    with db.stream_sql("SELECT id FROM regions", chunk_size=1) as stream:
+        next(stream)
+    assert not stream.modified
+    # The connection is writable again for explicit write streams
+    assert db.execute_sql("UPDATE regions SET name = name", read_only=False).success
+
+
+def test_ask_returns_columnar_data(pipeline):
+    response = pipeline.ask("各地区的税率是多少？")
+    assert "data" not in response
+    assert response["columns"] == ["name", "tax_rate"]
+    assert len(response["column_values"]) == 2
+    assert len(response["column_values"][0]) == response["row_count"] > 0
+
+    # Mutating a returned response must not leak into the cached copy
+    response["column_values"][0].clear()
+    cached = pipeline.ask("各地区的税率是多少？")
+    assert cached["performance"]["cache_hit"] and len(cached["column_values"][0]) == cached["row_count"]
+
+
+# --- Result limits -----------------------------------------------------------------
+
+def test_max_rows_truncates_only_when_more_rows_exist(db):
+    total = db.execute_sql("SELECT id FROM regions").row_count
+    exact = db.execute_sql("SELECT id FROM regions", max_rows=total)
+    assert exact.row_count == total and not exact.truncated
+
+    limited = db.execute_sql("SELECT id FROM regions ORDER BY id", max_rows=2)
+    assert limited.truncation_reason == "max_rows" and limited.success
+    assert limited.column_values[0] == db.execute_sql("SELECT id FROM regions ORDER BY id").column_values[0][:2]
+
+
+def test_max_bytes_stops_before_the_limit(db):
+    # Ten-character strings: the sixth row would exceed 55 bytes
+    sql = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n LIMIT 100) SELECT printf('%010d', i) FROM n"
+    with db.stream_sql(sql, chunk_size=7, max_bytes=55) as stream:
+        rows = [row for chunk in stream for row in chunk]
+    assert len(rows) == stream.row_count == 5
+    assert stream.truncation_reason == "max_bytes"
+
+
+def test_timeout_interrupts_a_query_without_rows(db):
+    result = db.execute_sql("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) "
+                            "SELECT MAX(i) FROM n", timeout=0.05)
+    assert not result.success and "time limit" in result.error
+    # The progress handler is removed again, so later queries are not interrupted
+    assert db.execute_sql("SELECT COUNT(*) FROM regions").success
+
+
+# --- Column-level schema pruning ---------------------------------------------------
+
+SHOP_SCHEMAS = [
+    ne.TableSchema("regions", """CREATE TABLE regions (
+    id INTEGER PRIMARY KEY,
+    name TEXT -- 地区名称
+)""", ""),
+    ne.TableSchema("customers", """CREATE TABLE customers (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    email TEXT,
+    phone TEXT,
+    region_id INTEGER REFERENCES regions(id)
+)""", ""),
+    ne.TableSchema("orders", """CREATE TABLE orders (
+    id INTEGER PRIMARY KEY,
+    customer_id INTEGER,
+    total REAL, -- 订单金额
+    status TEXT,
+    note TEXT,
+    FOREIGN KEY (customer_id) REFERENCES customers (id)
+)""", ""),
+    ne.TableSchema("audit_log", "CREATE TABLE audit_log (\n    id INTEGER PRIMARY KEY,\n    message TEXT\n)", ""),
+]
+
+
+@pytest.fixture
+def column_index(local_store):
+    index = ne.ColumnIndex(local_store, max_columns_per_table=3)
+    index.build(SHOP_SCHEMAS)
+    return index
+
+
+def test_parse_ddl_reads_columns_comments_and_foreign_keys():
+    columns, foreign_keys = ne._parse_ddl("orders", SHOP_SCHEMAS[2].ddl)
+    assert [column.name for column in columns] == ["id", "customer_id", "total", "status", "note"]
+    assert columns[0].primary_key and not columns[1].primary_key
+    assert columns[2].comment == "订单金额" and columns[2].definition == "total REAL"
+    assert foreign_keys == [ne.ForeignKey("orders", "customer_id", "customers", "id")]
+
+    _, inline = ne._parse_ddl("customers", SHOP_SCHEMAS[1].ddl)
+    assert inline[0].join_condition() == "customers.region_id = regions.id"
+
+
+def test_join_paths_add_bridge_tables(column_index):
+    tables, edges = column_index.join_paths(["orders", "regions"])
+    assert tables == ["orders", "customers", "regions"]
+    assert [fk.join_condition() for fk in edges] == ["orders.customer_id = customers.id",
+                                                    "customers.region_id = regions.id"]
+
+    # Tables without a foreign-key route are kept on their own; unknown tables are dropped
+    tables, edges = column_index.join_paths(["orders", "audit_log", "missing"])
+    assert tables == ["orders", "audit_log"] and edges == []
+
+
+def test_schema_context_keeps_keys_join_columns_and_matches(column_index):
+    context = column_index.build_schema_context("订单金额 total by region", [SHOP_SCHEMAS[2], SHOP_SCHEMAS[0]])
+    orders = context.split("\n\n")[0]
+    assert "id INTEGER PRIMARY KEY" in orders and "customer_id INTEGER" in orders and "total REAL" in orders
+    assert "-- Other columns: status, note" in orders
+    assert "--- Table: customers (join path only) ---" in context
+    assert "email" not in context and "phone" not in context
+    assert context.endswith("--- Join paths ---\norders.customer_id = customers.id\ncustomers.region_id = regions.id")